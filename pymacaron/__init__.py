@@ -1,19 +1,28 @@
 import os
 import sys
 import logging
+import threading
 import click
 import pkg_resources
 from datetime import datetime
 from uuid import uuid4
-from flask import Response, redirect, abort
-from flask_compress import Compress
+from flask import redirect, abort
 from flask_cors import CORS
 from pymacaron.apiloader import load_api_models_and_endpoints
+from pymacaron.apidoc import render_doc
+from pymacaron.compress import init_compression
+from pymacaron.lean import enable_lean_dispatch
+from pymacaron.cors import init_cors
+from pymacaron.background import init_background
 from pymacaron.log import set_level, pymlogger
 from pymacaron.config import get_config
 from pymacaron.monitor import monitor_init
 from pymacaron.crash import set_error_reporter
 from pymacaron.api import add_ping_hook
+from pymacaron.warmup import set_warmup, warmup_app
+from pymacaron.drain import drain_flask_on_sigterm
+from pymacaron.lifecycle import add_worker_start_hook, add_worker_stop_hook
+from pymacaron.lifecycle import start_worker, stop_worker
 
 
 log = pymlogger(__name__)
@@ -152,10 +161,12 @@ class apipool():
             raise Exception(f"Found models with same names but different schemas in different apis: {', '.join(found_names)}")
 
     @classmethod
-    def publish_apis(cls, app, path='doc', toc=None):
+    def publish_apis(cls, app, path='doc', toc=None, max_age=300):
         """Add routes to the Flask app to publish all loaded swagger files under the
-        paths doc/<api_name>.yaml and doc/<api_name>. Optionally add a table of
-        content to all swagger specs.
+        paths doc/<api_name>.yaml, doc/<api_name>.json and doc/<api_name>.
+        Optionally add a table of content to all swagger specs. Specs are
+        rendered and compressed once, and served with ETags and a
+        Cache-Control max-age of max_age seconds.
 
         """
 
@@ -171,29 +182,26 @@ class apipool():
         # Allow cross-origin calls
         CORS(app, resources={r"/%s/*" % path: {"origins": "*"}})
 
-        def doc_endpoint(name=None):
-            api_name = name.replace('.yaml', '')
-            if api_name not in apipool.__api_paths:
-                log.error(f"Unknown api name '{api_name}'")
-                abort(404)
+        # Render all specs now rather than at each request
+        docs = {}
+        for api_name, api_path in apipool.__api_paths.items():
+            docs[api_name] = render_doc(api_path, toc=toc, max_age=max_age)
 
-            api_path = apipool.__api_paths[api_name]
-
-            if name.endswith('.yaml'):
+        def doc_endpoint(name=None):
+            api_name, _, ext = name.partition('.')
+            if api_name not in docs:
+                if api_name not in apipool.__api_paths:
+                    log.error(f"Unknown api name '{api_name}'")
+                    abort(404)
+                # This api was loaded after publish_apis() was called
+                docs[api_name] = render_doc(apipool.__api_paths[api_name], toc=toc, max_age=max_age)
+
+            if ext in ('yaml', 'json'):
                 # Show the swagger file
-                with open(api_path, 'r') as f:
-                    spec = f.read()
+                return docs[api_name][ext].response()
 
-                    if toc:
-                        # Insert the table of content after the first 'description: |'
-                        spec = spec.replace(
-                            'description: |',
-                            f'description: |\n{toc}\n',
-                            1,
-                        )
-
-                    log.info("Returning %s" % api_path)
-                    return Response(spec, mimetype='text/plain')
+            elif ext:
+                abort(404)
 
             else:
                 # Redirect to swagger-UI at petstore, to open this swagger file
@@ -251,7 +259,7 @@ def get_port():
 class API(object):
 
 
-    def __init__(self, app, host='localhost', port=None, debug=False, log_level=logging.DEBUG, json_encoders=None, error_reporter=None, error_callback=None, default_user_id=None, ping_hook=[]):
+    def __init__(self, app, host='localhost', port=None, debug=False, log_level=logging.DEBUG, json_encoders=None, error_reporter=None, error_callback=None, default_user_id=None, ping_hook=[], warmup=True, synthetic_warmup=False, on_worker_start=[], on_worker_stop=[], asgi=False, lean=False):
         """
 
         Configure the Pymacaron microservice prior to starting it. Arguments:
@@ -272,6 +280,18 @@ class API(object):
 
         json_encoders: (optional) custom pydantic json encoders, to use when serializing pymacaron models to json
 
+        warmup : (optional) replay the requests listed under 'x-warmup' in swagger files before accepting traffic (defaults to True)
+
+        synthetic_warmup : (optional) also replay a request to every GET endpoint that takes no parameters (defaults to False)
+
+        on_worker_start : (optional) a function, or list of functions, called with the per-worker resource registry in each worker process before it accepts traffic. Open connection pools here
+
+        on_worker_stop : (optional) a function, or list of functions, called with the per-worker resource registry when a worker process exits. Close connection pools here
+
+        lean : (optional) dispatch requests to the routes generated from swagger files without going through flask's routing (defaults to False). See pymacaron.lean
+
+        asgi : (optional) serve the api with uvicorn instead of flask's server when not running via gunicorn or uvicorn (defaults to False). See pymacaron.asgi
+
         """
         assert app
         assert port
@@ -283,6 +303,13 @@ class API(object):
         self.error_callback = error_callback
         self.error_reporter = error_reporter
         self.ping_hook = ping_hook
+        self.warmup = warmup
+        self.synthetic_warmup = synthetic_warmup
+        self.on_worker_start = on_worker_start if type(on_worker_start) is list else [on_worker_start]
+        self.on_worker_stop = on_worker_stop if type(on_worker_stop) is list else [on_worker_stop]
+        self.lean = lean
+        self.asgi = asgi
+        self._asgi_app = None
         self.app_pkgs = []
 
         if not port:
@@ -300,16 +327,24 @@ class API(object):
         log.info("Initialized API (%s:%s) (Flask debug:%s)" % (host, port, debug))
 
 
-    def publish_apis(self, path='doc', toc=None):
+    def asgi_app(self):
+        """Return an ASGI application serving this api's flask app"""
+        if not self._asgi_app:
+            from pymacaron.asgi import AsgiApp
+            self._asgi_app = AsgiApp(self.app)
+        return self._asgi_app
+
+
+    def publish_apis(self, path='doc', toc=None, max_age=300):
         """Publish all loaded apis on under the uri /<path>/<api-name>, by redirecting
         to http://petstore.swagger.io/. Optionally add a common table of
         content (provided in markdown) to all apis' yaml files.
         """
-        apipool.publish_apis(self.app, path=path, toc=toc)
+        apipool.publish_apis(self.app, path=path, toc=toc, max_age=max_age)
 
 
     def load_builtin_apis(self, names=['ping']):
-        """Load some or all of the builtin apis 'ping' and 'crash'"""
+        """Load some or all of the builtin apis 'ping', 'crash' and 'batch'"""
         for name in names:
             yaml_path = pkg_resources.resource_filename(__name__, 'pymacaron/%s.yaml' % name)
             if not os.path.isfile(yaml_path):
@@ -435,11 +470,19 @@ class API(object):
         if self.ping_hook:
             add_ping_hook(self.ping_hook)
 
+        # Add worker lifecycle hooks if any
+        for h in self.on_worker_start:
+            add_worker_start_hook(h)
+        for h in self.on_worker_stop:
+            add_worker_stop_hook(h)
+
         self.load_builtin_apis()
 
-        # Let's compress returned data when possible
-        compress = Compress()
-        compress.init_app(self.app)
+        # Let's compress returned data when worth it
+        init_compression(self.app)
+
+        # Run @background tasks once requests are done
+        init_background(self.app)
 
         # Now execute Flask code declaring API routes
         for app_pkg in self.app_pkgs:
@@ -450,6 +493,12 @@ class API(object):
                 # local=False,
             )
 
+        if self.lean:
+            enable_lean_dispatch(self.app)
+
+        # Answer preflight requests before any routing
+        init_cors(self.app)
+
         log.debug("Argv is [%s]" % '  '.join(sys.argv))
         if 'celery' in sys.argv[0].lower():
             # This code is loading in a celery worker - Don't start the actual flask app.
@@ -459,21 +508,45 @@ class API(object):
         # Initialize monitoring, if any is defined
         monitor_init(app=self.app, config=conf)
 
-        if os.path.basename(sys.argv[0]) == 'gunicorn':
-            # Gunicorn takes care of spawning workers
-            log.info("Running in Gunicorn - Not starting the Flask app")
+        set_warmup(enabled=self.warmup, synthetic=self.synthetic_warmup)
+
+        if is_app_server():
+            # Gunicorn takes care of spawning workers, and starts and warms
+            # them up in post_worker_init (or the ASGI lifespan)
+            log.info("Running in %s - Not starting the Flask app" % os.path.basename(sys.argv[0]))
             return
 
         # Debug mode is the default when not running via gunicorn
         self.app.debug = self.debug
 
-        self.app.run(host='0.0.0.0', port=self.port)
+        if self.asgi:
+            # The ASGI app starts, warms up and stops the worker in its
+            # lifespan, and uvicorn drains on SIGTERM
+            import uvicorn
+            uvicorn.run(self.asgi_app(), host='0.0.0.0', port=int(self.port), lifespan='on')
+            return
+
+        start_worker()
+        warmup_app(self.app)
+
+        if threading.current_thread() is threading.main_thread():
+            drain_flask_on_sigterm()
+
+        try:
+            self.app.run(host='0.0.0.0', port=self.port)
+        finally:
+            stop_worker()
 
 #
 # Generic code to start server, from command line or via gunicorn
 #
 
 
+def is_app_server():
+    """True if running in gunicorn or uvicorn, which spawn the workers"""
+    return os.path.basename(sys.argv[0]) in ('gunicorn', 'uvicorn')
+
+
 def show_splash():
     log.info("")
     log.info("")
@@ -523,7 +596,7 @@ def letsgo(name, callback=None):
     if name == "__main__":
         main()
 
-    if os.path.basename(sys.argv[0]) == 'gunicorn':
+    if is_app_server():
         show_splash()
         port = get_port()
         callback(port)
@@ -0,0 +1,123 @@
+import os
+import asyncio
+import inspect
+import threading
+import contextvars
+import concurrent.futures
+from flask import _app_ctx_stack, _request_ctx_stack
+from pymacaron.log import pymlogger
+from pymacaron.deadline import remaining_time
+from pymacaron.exceptions import DeadlineExceededError
+
+
+log = pymlogger(__name__)
+
+
+# Async handlers: endpoints implemented with 'async def' return a coroutine,
+# that is run on an event loop shared by all threads of the worker, while the
+# request's thread waits for its result. Within the coroutine, and the tasks
+# it spawns, flask's request, current_app, g and pymacaron.auth behave as in a
+# sync handler.
+#
+# Werkzeug < 2 keys flask's context stacks by thread (or greenlet), and all
+# coroutines run in the loop's thread: the stacks are therefore keyed by a
+# context variable that is unique per request inside the loop, and fall back
+# on the original key everywhere else.
+
+loop = None
+loop_pid = None
+loop_lock = threading.Lock()
+
+# Identifies the request a coroutine is working for, inherited by the tasks
+# it creates
+request_ident = contextvars.ContextVar('pym_request_ident', default=None)
+
+
+def patch_context_stacks():
+    for s in (_app_ctx_stack, _request_ctx_stack):
+        if not hasattr(s, '__ident_func__'):
+            # Werkzeug >= 2 keys locals by context variable already
+            continue
+
+        def get_ident(ident_func=s.__ident_func__):
+            ident = request_ident.get()
+            if ident is not None:
+                return ident
+            return ident_func()
+
+        s.__ident_func__ = get_ident
+
+
+patch_context_stacks()
+
+
+def get_event_loop():
+    """Return this worker's event loop, running in its own thread"""
+    global loop
+    global loop_pid
+    with loop_lock:
+        if loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            t = threading.Thread(target=loop.run_forever, name='pym-asyncio', daemon=True)
+            t.start()
+            loop_pid = os.getpid()
+            log.info(f"Started event loop of worker {loop_pid}")
+    return loop
+
+
+async def with_request_context(coro, app_ctx, req_ctx):
+    request_ident.set(object())
+    if app_ctx:
+        _app_ctx_stack.push(app_ctx)
+    if req_ctx:
+        _request_ctx_stack.push(req_ctx)
+    try:
+        return await coro
+    finally:
+        if req_ctx:
+            _request_ctx_stack.pop()
+        if app_ctx:
+            _app_ctx_stack.pop()
+
+
+def run_coroutine(coro, deadline=True):
+    """Run a coroutine on the worker's event loop, in the current request's
+    contexts, and return its result. Cancel it and raise a
+    DeadlineExceededError if the request's deadline passes first, unless
+    deadline is False"""
+    future = asyncio.run_coroutine_threadsafe(
+        with_request_context(coro, _app_ctx_stack.top, _request_ctx_stack.top),
+        get_event_loop(),
+    )
+    try:
+        return future.result(timeout=remaining_time() if deadline else None)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise DeadlineExceededError("Request deadline exceeded")
+
+
+def iterate_async(agen):
+    """Turn an async generator into an iterator, each step running on the
+    worker's event loop. Like sync streams, it is not bound by the request's
+    deadline"""
+    try:
+        while True:
+            try:
+                yield run_coroutine(agen.__anext__(), deadline=False)
+            except StopAsyncIteration:
+                return
+    finally:
+        try:
+            run_coroutine(agen.aclose(), deadline=False)
+        except Exception as e:
+            log.warning(f"Failed to close async generator {agen}: {e}")
+
+
+def resolve_async(result):
+    """Run the coroutine or async generator returned by an async handler"""
+    # asyncio.iscoroutine() is also true of plain generators before 3.12
+    if inspect.iscoroutine(result):
+        return run_coroutine(result)
+    if hasattr(result, '__anext__'):
+        return iterate_async(result)
+    return result
@@ -6,6 +6,8 @@ from pymacaron.utils import get_container_version
 from pymacaron.utils import get_app_name
 from pymacaron.crash import report_error
 from pymacaron.exceptions import PyMacaronException
+from pymacaron.exceptions import ServerNotReadyError
+from pymacaron.drain import is_draining
 
 
 log = pymlogger(__name__)
@@ -28,6 +30,11 @@ def add_ping_hook(hook):
     ping_hooks.append(hook)
 
 def do_ping():
+    # No need to fail while warming up: workers only accept connections once
+    # warmed up (see pymacaron.warmup)
+    if is_draining():
+        # Tell the load balancer to stop sending traffic before we exit
+        return ServerNotReadyError("Server is draining").jsonify()
     log.debug("Replying ping:ok")
     from pymacaron import apipool
     v = apipool.ping.Ok()
@@ -0,0 +1,92 @@
+import json
+import gzip
+import yaml
+import hashlib
+from flask import request, Response
+from pymacaron.log import pymlogger
+
+
+log = pymlogger(__name__)
+
+
+# Published swagger files are rendered once, when publish_apis() is called, in
+# yaml and json, each with precomputed gzip and brotli variants served with
+# strong ETags
+
+
+def compress_variants(data):
+    """Return a dict of encoding: compressed data, for all encodings we can
+    precompute"""
+    variants = {
+        'gzip': gzip.compress(data, compresslevel=9),
+    }
+    try:
+        import brotli
+        variants['br'] = brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return variants
+
+
+class RenderedDoc():
+    """A swagger file rendered in one format, with all its encodings"""
+
+    def __init__(self, data, mimetype, max_age=300):
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.variants = compress_variants(data)
+        self.variants['identity'] = data
+
+    def choose_encoding(self):
+        """Pick brotli, then gzip, if the client accepts them"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and request.accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+    def response(self):
+        encoding = self.choose_encoding()
+
+        # Same convention as pymacaron.compress: one strong ETag per encoding
+        etag = self.etag if encoding == 'identity' else f'{self.etag}:{encoding}'
+
+        if request.if_none_match.contains_weak(etag):
+            r = Response(status=304)
+        else:
+            r = Response(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                r.headers['Content-Encoding'] = encoding
+
+        r.set_etag(etag)
+        r.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        r.headers['Vary'] = 'Accept-Encoding'
+        return r
+
+
+def render_doc(api_path, toc=None, max_age=300):
+    """Read a swagger file, insert the optional table of content, and return a
+    dict of format ('yaml' or 'json'): RenderedDoc"""
+
+    with open(api_path, 'r') as f:
+        spec = f.read()
+
+    d = yaml.load(spec, Loader=yaml.FullLoader)
+
+    if toc:
+        # Insert the table of content after the first 'description: |'
+        spec = spec.replace(
+            'description: |',
+            f'description: |\n{toc}\n',
+            1,
+        )
+        info = d.setdefault('info', {})
+        info['description'] = f"{toc}\n{info.get('description', '')}"
+
+    docs = {
+        'yaml': RenderedDoc(spec.encode('utf-8'), 'text/plain', max_age=max_age),
+        'json': RenderedDoc(json.dumps(d, default=str).encode('utf-8'), 'application/json', max_age=max_age),
+    }
+
+    log.info(f"Rendered {api_path} ({len(docs['yaml'].variants['identity'])} bytes)")
+    return docs
@@ -29,6 +29,7 @@ def swagger_type_to_pydantic_type(t, models=[]):
         'datetime': 'datetime',
         'date-time': 'datetime',
         'iso-date': 'datetime',
+        'object': 'dict',
     }
 
     assert t in mapping, f"Don't know to map swagger type '{t}' to a python type"
@@ -212,10 +213,19 @@ def generate_endpoints_v2(swagger, app_file, model_file, api_name):
 
     lines_header = [
         '# This is an auto-generated file - DO NOT EDIT!!!',
-        'from flask_cors import cross_origin',
         'from typing import Optional',
         'from pydantic import BaseModel',
         'from pymacaron.endpoint import pymacaron_flask_endpoint',
+        'from pymacaron.warmup import add_warmup_request',
+        'from pymacaron.auth import requires_auth',
+        'from pymacaron.cache import ResponseCache',
+        'from pymacaron.coalesce import RequestCoalescer',
+        'from pymacaron.compress import set_route_compression',
+        'from pymacaron.concurrency import get_endpoint_limit',
+        'from pymacaron.ratelimit import RateLimiter',
+        'from pymacaron.offload import DecoratedHandler',
+        'from pymacaron.offload import add_offloaded_endpoint',
+        'from pymacaron.lean import lean_route',
         'from pymacaron.log import pymlogger',
         '',
         '',
@@ -272,12 +282,14 @@ def generate_endpoints_v2(swagger, app_file, model_file, api_name):
             # What does the endpoint produces?
             assert 'produces' in endpoint_def, f"Missing 'produces' in declaration of endpoint {http_method}:{route} in api '{api_name}'"
             produces = endpoint_def['produces'][0]
-            assert produces == 'application/json'
 
             # Model returned?
             assert 'responses' in endpoint_def, f"Missing 'responses' in declaration of endpoint {http_method}:{route} in api '{api_name}'"
             result_models_lines = []
             for response_type, response_def in endpoint_def['responses'].items():
+                if produces != 'application/json' and '$ref' not in response_def.get('schema', {}):
+                    # Binary or text content, e.g. 'schema: {type: file}'
+                    continue
                 assert 'schema' in response_def, f"Missing 'schema' in response '{response_type}' in declaration of endpoint {http_method}:{route} in api '{api_name}'"
                 assert '$ref' in response_def['schema'], f"Missing '$ref' in response '{response_type}' in declaration of endpoint {http_method}:{route} in api '{api_name}'"
                 s = ref_to_model_name(response_def['schema']['$ref'])
@@ -315,8 +327,16 @@ def generate_endpoints_v2(swagger, app_file, model_file, api_name):
                     '',
                     f'    from {method_path} import {method_name} as {unique_method_name}',
                     f'    from {decorator_pkg} import {decorator_f}',
-                    f'    {unique_method_name} = {decorator_f}({unique_method_name})',
                 ]
+                if 'x-offload' in endpoint_def:
+                    # The decorated method is pickled to the offload pool
+                    lines_imports += [
+                        f'    {unique_method_name} = DecoratedHandler({unique_method_name}, {decorator_f})',
+                    ]
+                else:
+                    lines_imports += [
+                        f'    {unique_method_name} = {decorator_f}({unique_method_name})',
+                    ]
             else:
                 lines_imports += [
                     '',
@@ -371,10 +391,171 @@ def generate_endpoints_v2(swagger, app_file, model_file, api_name):
                         f'                "{name}": "{typ}",',
                     ]
 
+            # Requests to replay when warming up workers: either examples
+            # listed under x-warmup, or a synthetic call for GET endpoints
+            # without parameters
+            warmup_lines = []
+            if 'x-warmup' in endpoint_def:
+                examples = endpoint_def['x-warmup']
+                assert type(examples) is list, f"x-warmup should be a list of examples in endpoint {http_method}:{route} in api '{api_name}'"
+                for example in examples:
+                    assert type(example) is dict, f"x-warmup example {example} should be a dictionary in endpoint {http_method}:{route} in api '{api_name}'"
+                    path = example.get('path', route)
+                    assert '{' not in path, f"x-warmup example {example} must set a 'path' without path parameters in endpoint {http_method}:{route} in api '{api_name}'"
+                    warmup_lines += [
+                        f'    add_warmup_request("{http_method}", "{path}", query={repr(example.get("query"))}, body={repr(example.get("body"))}, headers={repr(example.get("headers"))}, auth={example.get("auth", False) is True})',
+                    ]
+            elif http_method == 'GET' and not path_params and not query_params and str_body_model_name == 'None':
+                warmup_lines += [
+                    f'    add_warmup_request("GET", "{route}", synthetic=True)',
+                ]
+
+            # Response cache declared with x-cache
+            setup_lines = []
+            str_cache = 'None'
+            if 'x-cache' in endpoint_def:
+                c = endpoint_def['x-cache']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert http_method == 'GET', f"x-cache is only supported on GET {err_str}"
+                assert produces == 'application/json', f"x-cache is only supported on endpoints producing application/json {err_str}"
+                assert type(c) is dict and 'ttl' in c, f"x-cache should be a dictionary with at least a 'ttl' {err_str}"
+                # Decorated endpoints may return different data to different
+                # users, so vary on the user by default
+                default_vary = ['path', 'query', 'user'] if 'x-decorate-server' in endpoint_def else ['path', 'query']
+                vary = c.get('vary', default_vary)
+                assert type(vary) is list, f"x-cache vary should be a list {err_str}"
+                # Cache hits skip x-decorate-server, so authenticate by default
+                auth = c.get('auth', 'x-decorate-server' in endpoint_def)
+                str_cache = f'cache_{def_name}'
+                setup_lines = [
+                    f'    {str_cache} = ResponseCache("{operation_id}", ttl={c["ttl"]}, vary={repr(vary)}, max_size={c.get("max_size", 1000)}, auth={auth is True})',
+                ]
+
+            # Single-flight calls declared with x-coalesce
+            str_coalesce = 'None'
+            if 'x-coalesce' in endpoint_def:
+                c = endpoint_def['x-coalesce']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                # Requests with a body would share the result computed for
+                # another body
+                assert http_method == 'GET', f"x-coalesce is only supported on GET {err_str}"
+                if c is True:
+                    c = {}
+                assert type(c) is dict, f"x-coalesce should be true or a dictionary {err_str}"
+                # Identical requests share the result computed for one user,
+                # so decorated endpoints vary on the user by default
+                default_vary = ['path', 'query', 'user'] if 'x-decorate-server' in endpoint_def else ['path', 'query']
+                vary = c.get('vary', default_vary)
+                assert type(vary) is list, f"x-coalesce vary should be a list {err_str}"
+                # Followers skip x-decorate-server, so authenticate by default
+                auth = c.get('auth', 'x-decorate-server' in endpoint_def)
+                str_coalesce = f'coalesce_{def_name}'
+                setup_lines += [
+                    f'    {str_coalesce} = RequestCoalescer("{operation_id}", vary={repr(vary)}, timeout={c.get("timeout", 10)}, auth={auth is True})',
+                ]
+
+            # Endpoints yielding models to stream
+            str_stream = 'None'
+            if 'x-stream' in endpoint_def:
+                fmt = endpoint_def['x-stream']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert fmt in ('ndjson', 'array'), f"x-stream should be 'ndjson' or 'array' {err_str}"
+                assert 'x-cache' not in endpoint_def and 'x-coalesce' not in endpoint_def, f"x-stream cannot be combined with x-cache or x-coalesce {err_str}"
+                str_stream = f'"{fmt}"'
+
+            # Endpoints pushing models as server-sent events
+            if produces == 'text/event-stream':
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert result_models_lines, f"Endpoints producing text/event-stream must return a model with '$ref' {err_str}"
+                for k in ('x-cache', 'x-coalesce', 'x-stream'):
+                    assert k not in endpoint_def, f"{k} cannot be used on endpoints producing text/event-stream {err_str}"
+
+            # Limits of file uploads
+            str_upload = 'None'
+            if 'x-upload' in endpoint_def:
+                u = endpoint_def['x-upload']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert type(u) is dict, f"x-upload should be a dictionary {err_str}"
+                assert form_params, f"x-upload requires formData file parameters {err_str}"
+                upload = {k: u[k] for k in ('max_size', 'spool_size') if k in u}
+                str_upload = repr(upload)
+
+            # CPU-bound endpoints run in a pool of processes
+            str_offload = 'None'
+            if 'x-offload' in endpoint_def:
+                o = endpoint_def['x-offload']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert o == 'process', f"x-offload should be 'process' {err_str}"
+                assert produces != 'text/event-stream', f"x-offload cannot be used on endpoints producing text/event-stream {err_str}"
+                for k in ('x-stream', 'x-upload'):
+                    assert k not in endpoint_def, f"x-offload cannot be combined with {k} {err_str}"
+                str_offload = f'"{o}"'
+                # Workers only fork an offload pool if some endpoint uses it
+                setup_lines += [
+                    f'    add_offloaded_endpoint("{operation_id}")',
+                ]
+
+            # Max number of concurrent calls to this endpoint
+            x_max_concurrency = endpoint_def.get('x-max-concurrency')
+            assert x_max_concurrency is None or type(x_max_concurrency) in (int, dict), f"x-max-concurrency should be an integer or a dictionary in endpoint {http_method}:{route} in api '{api_name}'"
+            str_concurrency = f'concurrency_{def_name}'
+            setup_lines += [
+                f'    {str_concurrency} = get_endpoint_limit("{operation_id}", {repr(x_max_concurrency)})',
+            ]
+
+            # Per-client rate limit
+            str_rate_limit = 'None'
+            if 'x-rate-limit' in endpoint_def:
+                c = endpoint_def['x-rate-limit']
+                err_str = f"in endpoint {http_method}:{route} in api '{api_name}'"
+                assert type(c) is dict and 'limit' in c, f"x-rate-limit should be a dictionary with at least a 'limit' {err_str}"
+                for k in c.keys():
+                    assert k in ('limit', 'period', 'burst', 'key'), f"Unsupported key '{k}' in x-rate-limit {err_str}"
+                str_rate_limit = f'rate_limit_{def_name}'
+                args = ''.join([f', {k}={repr(c[k])}' for k in ('period', 'burst', 'key') if k in c])
+                setup_lines += [
+                    f'    {str_rate_limit} = RateLimiter("{operation_id}", {c["limit"]}{args})',
+                ]
+
+            # Seconds within which the endpoint must reply
+            str_timeout = 'None'
+            if 'x-timeout' in endpoint_def:
+                t = endpoint_def['x-timeout']
+                assert type(t) in (int, float) and t > 0, f"x-timeout should be a positive number of seconds in endpoint {http_method}:{route} in api '{api_name}'"
+                str_timeout = repr(t)
+
+            # Per-route compression policy
+            if 'x-compress' in endpoint_def:
+                c = endpoint_def['x-compress']
+                assert c is False or type(c) is dict, f"x-compress should be false or a dictionary in endpoint {http_method}:{route} in api '{api_name}'"
+                setup_lines += [
+                    f'    set_route_compression("{def_name}", {repr(c)})',
+                ]
+
+            # Hook returning the version of the response, used as etag
+            str_etag = 'None'
+            if 'x-etag' in endpoint_def:
+                assert http_method == 'GET', f"x-etag is only supported on GET in endpoint {http_method}:{route} in api '{api_name}'"
+                s = endpoint_def['x-etag']
+                etag_f = s.split('.')[-1]
+                etag_pkg = '.'.join(s.split('.')[0:-1])
+                str_etag = 'etag_' + s.replace('.', '_')
+                lines_imports += [
+                    f'    from {etag_pkg} import {etag_f} as {str_etag}',
+                ]
+                if 'x-decorate-server' in endpoint_def:
+                    # The hook may return 304 before x-decorate-server runs:
+                    # authenticate first, as x-cache does
+                    lines_imports += [
+                        f'    {str_etag}_auth = requires_auth({str_etag})',
+                    ]
+                    str_etag = f'{str_etag}_auth'
+
             lines_endpoints += [
                 '',
+            ] + setup_lines + [
                 f'    @app.route("{flask_route}", methods=["{http_method}"])',
-                '    @cross_origin(headers=["Content-Type", "Authorization"])',
+                f'    @lean_route(app, "{flask_route}", "{http_method}")',
                 f'    def {def_name}({str_path_params}):',
 
             ] + query_model_lines + [
@@ -394,8 +575,18 @@ def generate_endpoints_v2(swagger, app_file, model_file, api_name):
             ] + result_models_lines + [
                 '            ],',
                 '            error_callback=error_callback,',
+                f'            cache={str_cache},',
+                f'            etag={str_etag},',
+                f'            coalesce={str_coalesce},',
+                f'            stream={str_stream},',
+                f'            upload={str_upload},',
+                f'            offload={str_offload},',
+                f'            concurrency={str_concurrency},',
+                f'            rate_limit={str_rate_limit},',
+                f'            timeout={str_timeout},',
                 '        )',
                 f'    log.info("Binding [{api_name}] {http_method} {route} ==> {operation_id}")',
+            ] + warmup_lines + [
                 '',
             ]
 
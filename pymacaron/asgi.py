@@ -0,0 +1,284 @@
+import os
+import sys
+import asyncio
+import inspect
+import contextvars
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from flask.signals import request_started
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.aio import request_ident
+from pymacaron.deadline import remaining_time
+from pymacaron.endpoint import DeferredEndpoint, defer_endpoints
+from pymacaron.lifecycle import start_worker, stop_worker
+from pymacaron.warmup import warmup_app
+from pymacaron.drain import start_draining, flush
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron import cors
+
+
+log = pymlogger(__name__)
+
+
+# ASGI mode: AsgiApp serves a pymacaron flask app from an ASGI server (uvicorn,
+# or gunicorn with pymacaron.gunicorn_asgi), with one event loop per worker
+# holding thousands of connections. Requests are parsed, validated and
+# serialized on the loop. Endpoints implemented with 'async def' run on the
+# loop too, while sync endpoints run in a pool of 'asgi_threads' threads
+# (pym-config). Plain flask views, and the endpoints' auth decorators, run on
+# the loop and must not block.
+
+# Request bodies above this size are spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+executor = None
+executor_pid = None
+
+
+def get_executor():
+    global executor
+    global executor_pid
+    if executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(
+            max_workers=get_config().asgi_threads,
+            thread_name_prefix='pym-asgi',
+        )
+        executor_pid = os.getpid()
+    return executor
+
+
+def run_in_thread(f, *args):
+    """Run f in the worker's thread pool, with the current context variables,
+    hence in the current request's flask contexts"""
+    ctx = contextvars.copy_context()
+    # Flask apps called from within the handler (batch...) run synchronously
+    ctx.run(defer_endpoints.set, False)
+    return asyncio.get_running_loop().run_in_executor(get_executor(), ctx.run, f, *args)
+
+
+async def run_handler(call):
+    """Run a HandlerCall, on the loop if its implementation is a coroutine
+    function, or else in the worker's thread pool, and return its result"""
+    if not call.coalesce and not call.offload and inspect.iscoroutinefunction(inspect.unwrap(call.f)):
+        awaitable = call.f(*call.args, **call.kwargs)
+    else:
+        awaitable = run_in_thread(call.run)
+    try:
+        return await asyncio.wait_for(awaitable, remaining_time())
+    except asyncio.TimeoutError:
+        if remaining_time() == 0:
+            raise DeadlineExceededError("Request deadline exceeded")
+        raise
+
+
+async def run_steps_async(steps):
+    """Like pymacaron.endpoint.run_steps, without blocking the loop"""
+    try:
+        call = next(steps)
+        while True:
+            try:
+                result = await run_handler(call)
+            except asyncio.CancelledError:
+                steps.close()
+                raise
+            except (BaseException, Exception) as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+async def read_body(receive):
+    """Read the request's body into a file, or return None if the client
+    disconnected"""
+    body = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        body.write(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    body.seek(0)
+    return body
+
+
+def get_environ(scope, body):
+    """Return the WSGI environ of an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class AsgiApp():
+    """An ASGI application serving the flask app of a pymacaron api"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            raise Exception(f"Unsupported ASGI scope type {scope['type']}")
+
+    async def lifespan(self, receive, send):
+        """Start, warm up and stop the worker, as pymacaron.gunicorn does for
+        WSGI workers"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    start_worker()
+                    warmup_app(self.app)
+                except Exception as e:
+                    log.error(f"Failed to start worker {os.getpid()}: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                # The server has already stopped accepting connections and
+                # waited for in-flight requests: /ping never failed to let
+                # load balancers stop sending traffic first (see README)
+                start_draining('shutdown')
+                flush()
+                stop_worker()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        if scope['method'] == 'OPTIONS' and cors.policy:
+            # Answer preflight requests before routing, as
+            # pymacaron.cors.CorsPreflight does for WSGI
+            headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope.get('headers', [])}
+            if cors.is_preflight('OPTIONS', headers.get('origin'), headers.get('access-control-request-method')):
+                headers = cors.policy.get_preflight_headers(headers['origin'], headers.get('access-control-request-headers'))
+                await send({
+                    'type': 'http.response.start',
+                    'status': 204,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+                })
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        environ = get_environ(scope, body)
+
+        # Give the request its own flask context stacks (see pymacaron.aio)
+        ident_token = request_ident.set(object())
+        try:
+            defer_token = defer_endpoints.set(True)
+            try:
+                response = await self.dispatch(environ)
+            finally:
+                defer_endpoints.reset(defer_token)
+            await self.send_response(response, environ, receive, send)
+        finally:
+            request_ident.reset(ident_token)
+            body.close()
+
+    async def dispatch(self, environ):
+        """Same as flask's wsgi_app and full_dispatch_request, but awaits
+        pymacaron endpoints"""
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                try:
+                    app.try_trigger_before_first_request_functions()
+                    request_started.send(app)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = app.dispatch_request()
+                        if isinstance(rv, DeferredEndpoint):
+                            rv = rv.copy_headers(await run_steps_async(rv.steps))
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                return app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+        finally:
+            if app.should_ignore_error(error):
+                error = None
+            ctx.auto_pop(error)
+
+    async def send_response(self, response, environ, receive, send):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        })
+
+        # ASGI servers only accept bytes bodies: bytes(chunk) is chunk itself
+        # if it is bytes already
+        if isinstance(app_iter, (list, tuple)):
+            for chunk in app_iter:
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        # Streamed bodies, and files, are read in the thread pool, until the
+        # client disconnects
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        it = iter(app_iter)
+        try:
+            while not disconnected.is_set():
+                chunk = await run_in_thread(next, it, None)
+                if chunk is None:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+        finally:
+            watcher.cancel()
+            if hasattr(app_iter, 'close'):
+                await run_in_thread(app_iter.close)
@@ -2,11 +2,13 @@ import jwt
 from urllib.parse import unquote_plus
 from contextlib import contextmanager
 from functools import wraps
-from flask import request
+from flask import request, has_request_context
 from pymacaron.log import pymlogger
 from pymacaron.exceptions import AuthInvalidTokenError
 from pymacaron.exceptions import AuthTokenExpiredError
 from pymacaron.exceptions import AuthMissingHeaderError
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron.deadline import remaining_time, get_deadline_headers
 from pymacaron.utils import timenow, to_epoch
 from pymacaron.config import get_config
 
@@ -19,6 +21,11 @@ except ImportError:
 log = pymlogger(__name__)
 
 
+# Key of the request environ holding a token payload already verified by the
+# server itself (e.g. by a /batch request, for its sub-requests)
+VERIFIED_TOKEN_ENVIRON = 'pymacaron.verified_token'
+
+
 #
 # Decorators used to add authentication to endpoints in swagger specs
 #
@@ -38,13 +45,23 @@ def requires_auth(f):
 
 
 def add_auth(f):
-    """A decorator that adds the authentication header to requests arguments"""
+    """A decorator that adds the authentication header to requests arguments,
+    and forwards the current request's deadline, if any"""
 
     def add_auth_decorator(*args, **kwargs):
         token = get_user_token()
         if 'headers' not in kwargs:
             kwargs['headers'] = {}
         kwargs['headers']['Authorization'] = f"Bearer {token}"
+
+        remaining = remaining_time()
+        if remaining is not None:
+            if remaining == 0:
+                raise DeadlineExceededError("Request deadline exceeded before calling another service")
+            kwargs['headers'].update(get_deadline_headers())
+            if kwargs.get('timeout'):
+                kwargs['timeout'] = min(kwargs['timeout'], remaining)
+
         return f(*args, **kwargs)
 
     return add_auth_decorator
@@ -58,6 +75,14 @@ def load_auth_token(token, load=True):
     """Validate an auth0 token. Returns the token's payload, or an exception
     of the type:"""
 
+    # Reuse the payload of a token verified earlier on in this request
+    verified = request.environ.get(VERIFIED_TOKEN_ENVIRON) if has_request_context() else None
+    if verified and verified.get('token') == token:
+        payload = dict(verified)
+        if load:
+            stack.top.current_user = payload
+        return payload
+
     conf = get_config()
 
     assert conf.jwt_secret, "No JWT secret configured for pymacaron"
@@ -110,6 +135,10 @@ def load_auth_token(token, load=True):
     if load:
         stack.top.current_user = payload
 
+    # Don't verify the token again if asked later on in this request
+    if has_request_context():
+        request.environ[VERIFIED_TOKEN_ENVIRON] = dict(payload)
+
     return payload
 
 def authenticate_http_request(token=None):
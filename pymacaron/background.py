@@ -0,0 +1,171 @@
+import os
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app, has_app_context, has_request_context
+from pymacaron.log import pymlogger
+from pymacaron.utils import timenow
+from pymacaron.aio import resolve_async
+from pymacaron.config import get_config
+from pymacaron.crash import postmortem
+from pymacaron.drain import add_drain_hook, drain_hooks, get_flush_time_left
+from pymacaron.metrics import incr
+from pymacaron.offload import get_request_copy
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = pymlogger(__name__)
+
+
+# Fire-and-forget tasks (sending emails, audit writes, cache warming...):
+# functions decorated with @background return at once, and run later in a
+# thread pool of the worker. Tasks scheduled while serving a request are
+# submitted when the request is torn down, once its response is ready, so
+# that they add nothing to its latency.
+#
+# Tasks run in a copy of their request's context (path, query string,
+# headers, authenticated user and token), without its deadline. Their
+# failures are reported like those of endpoints. When the worker exits,
+# pending tasks get background_drain_timeout seconds to complete, within the
+# time left to flush (see pymacaron.drain).
+
+executor = None
+executor_pid = None
+
+# Number of tasks submitted and not yet completed in this worker
+pending = 0
+pending_done = threading.Condition()
+
+# The flask app tasks run in when scheduled outside of any app context
+default_app = None
+
+
+def get_executor():
+    global executor
+    global executor_pid
+    global pending
+    if executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(
+            max_workers=get_config().background_threads,
+            thread_name_prefix='pym-background',
+        )
+        executor_pid = os.getpid()
+        pending = 0
+    return executor
+
+
+class BackgroundTask():
+    """A call to a @background function, with a copy of the context it was
+    scheduled in"""
+
+    def __init__(self, f, args, kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.app = current_app._get_current_object() if has_app_context() else None
+        self.request_copy = get_request_copy()
+        user = getattr(stack.top, 'current_user', None)
+        self.user = dict(user) if user else None
+
+    def run(self):
+        global default_app
+        app = self.app
+        if not app:
+            if not default_app:
+                default_app = Flask(__name__)
+            app = default_app
+        with app.test_request_context(**(self.request_copy or {})):
+            if self.user:
+                stack.top.current_user = self.user
+            t0 = timenow()
+            try:
+                resolve_async(self.f(*self.args, **self.kwargs))
+                incr('background.completed', task=self.f.__name__)
+            except Exception as e:
+                incr('background.failed', task=self.f.__name__)
+                postmortem(f=self.f, t0=t0, t1=timenow(), exception=e)
+
+
+def run_task(task):
+    global pending
+    try:
+        task.run()
+    finally:
+        with pending_done:
+            pending -= 1
+            pending_done.notify_all()
+
+
+def submit(tasks):
+    """Queue tasks in the worker's thread pool, or drop them if too many are
+    pending already"""
+    global pending
+    executor = get_executor()
+    max_pending = get_config().background_max_pending
+    for task in tasks:
+        with pending_done:
+            if pending >= max_pending:
+                log.error(f"Dropping background task {task.f.__name__}: {pending} tasks pending already")
+                incr('background.dropped', task=task.f.__name__)
+                continue
+            pending += 1
+        executor.submit(run_task, task)
+
+
+def submit_request_tasks(exception=None):
+    """Teardown hook submitting the tasks scheduled by the request"""
+    tasks = getattr(stack.top, 'pym_background_tasks', None)
+    if tasks:
+        stack.top.pym_background_tasks = None
+        submit(tasks)
+
+
+def schedule(f, args, kwargs):
+    """Run f(*args, **kwargs) in the background, after the current request if
+    any"""
+    task = BackgroundTask(f, args, kwargs)
+    if has_request_context() and submit_request_tasks in current_app.teardown_request_funcs.get(None, []):
+        if getattr(stack.top, 'pym_background_tasks', None) is None:
+            stack.top.pym_background_tasks = []
+        stack.top.pym_background_tasks.append(task)
+    else:
+        submit([task])
+
+
+def background(f):
+    """Decorate a function so that calling it schedules it to run in the
+    worker's background thread pool and returns None at once"""
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        schedule(f, args, kwargs)
+
+    return wrapper
+
+
+def wait_for_tasks(timeout=None):
+    """Wait until all pending tasks have completed, or until timeout seconds
+    have passed. Return True if no task is pending"""
+    if timeout is None:
+        timeout = get_config().background_drain_timeout
+        time_left = get_flush_time_left()
+        if time_left is not None:
+            timeout = min(timeout, time_left)
+    with pending_done:
+        done = pending_done.wait_for(lambda: pending == 0 or executor_pid != os.getpid(), timeout=timeout)
+        if not done:
+            log.warning(f"Giving up waiting for {pending} background tasks")
+    return done
+
+
+def init_background(app):
+    """Submit the tasks scheduled by requests when they are torn down, and
+    wait for pending tasks when the worker exits"""
+    if submit_request_tasks not in app.teardown_request_funcs.get(None, []):
+        app.teardown_request(submit_request_tasks)
+    if wait_for_tasks not in drain_hooks:
+        add_drain_hook(wait_for_tasks)
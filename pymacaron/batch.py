@@ -0,0 +1,114 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, current_app
+from werkzeug.test import EnvironBuilder
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.auth import authenticate_http_request
+from pymacaron.auth import VERIFIED_TOKEN_ENVIRON
+from pymacaron.deadline import get_deadline_headers
+from pymacaron.concurrency import SUBREQUEST_ENVIRON
+from pymacaron.exceptions import InvalidParameterError
+
+
+log = pymlogger(__name__)
+
+
+# Headers of the batch request passed on to every sub-request
+FORWARDED_HEADERS = ['Authorization', 'Cookie', 'Accept-Language', 'User-Agent']
+
+
+# Thread pool executing parallel sub-requests, created in each worker
+executor = None
+executor_pid = None
+
+
+def get_executor():
+    global executor
+    global executor_pid
+    if executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(
+            max_workers=get_config().batch_max_threads,
+            thread_name_prefix='pym-batch',
+        )
+        executor_pid = os.getpid()
+    return executor
+
+
+def dispatch(app, sub, headers, payload):
+    """Execute one sub-request through the Flask app, in its own request and
+    application contexts, and return its SubResponse"""
+    builder = EnvironBuilder(
+        path=sub.path,
+        method=(sub.method or 'GET').upper(),
+        query_string=sub.query,
+        json=sub.body,
+        headers=dict(headers, **(sub.headers or {})),
+    )
+    environ = builder.get_environ()
+    # Skip the worker's concurrency limit: the batch request holds a slot
+    environ[SUBREQUEST_ENVIRON] = True
+    if payload:
+        # Let authenticate_http_request() skip verifying the token again
+        environ[VERIFIED_TOKEN_ENVIRON] = payload
+
+    with app.app_context():
+        with app.request_context(environ):
+            r = app.full_dispatch_request()
+            try:
+                if r.is_streamed or r.direct_passthrough:
+                    # Server-sent events, x-stream and file responses can't
+                    # be held in a batch response
+                    error = InvalidParameterError(f"{sub.path} returns a streamed response, that cannot be batched")
+                    return get_sub_response(error.jsonify())
+                return get_sub_response(r)
+            finally:
+                # Release what the response holds: stream slot, file...
+                r.close()
+
+
+def get_sub_response(r):
+    from pymacaron import apipool
+
+    body = None
+    if r.is_json:
+        body = json.loads(r.get_data())
+
+    return apipool.batch.SubResponse(
+        status=r.status_code,
+        headers={k: v for k, v in r.headers.items() if k in ('Content-Type', 'ETag', 'Cache-Control')},
+        body=body,
+    )
+
+
+def do_batch(batch):
+    """Execute a list of sub-requests and return their responses"""
+    from pymacaron import apipool
+
+    conf = get_config()
+    if len(batch.requests) > conf.batch_max_requests:
+        raise InvalidParameterError(f"A batch may contain at most {conf.batch_max_requests} requests")
+
+    for sub in batch.requests:
+        if sub.path.split('?')[0].rstrip('/') == request.path.rstrip('/'):
+            raise InvalidParameterError("Batches cannot be nested")
+
+    headers = {k: request.headers[k] for k in FORWARDED_HEADERS if k in request.headers}
+
+    # Verify the caller's token once for all sub-requests
+    payload = None
+    if 'Authorization' in headers:
+        payload = authenticate_http_request()
+
+    app = current_app._get_current_object()
+
+    # Sub-requests share the batch's deadline
+    if batch.parallel and len(batch.requests) > 1:
+        headers.update(get_deadline_headers())
+        futures = [get_executor().submit(dispatch, app, sub, headers, payload) for sub in batch.requests]
+        responses = [f.result() for f in futures]
+    else:
+        responses = [dispatch(app, sub, dict(headers, **get_deadline_headers()), payload) for sub in batch.requests]
+
+    return apipool.batch.BatchResponse(responses=responses)
@@ -0,0 +1,165 @@
+import time
+import threading
+from collections import OrderedDict
+from flask import request, Response
+from pymacaron.log import pymlogger
+from pymacaron.metrics import incr
+
+
+log = pymlogger(__name__)
+
+
+# Response caches declared with 'x-cache' in swagger files, keyed by the
+# endpoint's x-bind-server/operationId. Caches are in-process: each worker
+# has its own.
+caches = {}
+
+
+def get_operation_id(f):
+    """Return the operation id of an endpoint, given either as a string or as
+    the method implementing it"""
+    if callable(f):
+        return f'{f.__module__}.{f.__name__}'
+    return f
+
+
+def get_request_key(vary, path_args, auth=False):
+    """Return a key identifying the current request after vary, a list of
+    'path' (path arguments), 'query' (query arguments), 'user' (the
+    authenticated user id) and 'claim:<name>' (a claim in the user's token).
+    Authenticate the request first if auth is true, which is required to vary
+    on the user or claims"""
+    key = []
+    if auth:
+        # Raises an error if the request is not authenticated
+        from pymacaron.auth import authenticate_http_request
+        payload = authenticate_http_request()
+
+    for v in vary:
+        if v == 'path':
+            key.append(tuple(sorted(path_args.items())))
+        elif v == 'query':
+            key.append(tuple(sorted(request.args.items(multi=True))))
+        elif v == 'user':
+            key.append(payload.get('sub'))
+        else:
+            key.append(str(payload.get(v[len('claim:'):])))
+
+    return tuple(key)
+
+
+def check_vary(vary, name):
+    for v in vary:
+        assert v in ('path', 'query', 'user') or v.startswith('claim:'), f"Unsupported vary '{v}' in {name}"
+
+
+def vary_requires_auth(vary):
+    return 'user' in vary or len([v for v in vary if v.startswith('claim:')]) > 0
+
+
+class ResponseCache():
+    """An LRU of serialized json responses returned by one endpoint.
+
+    ttl: seconds during which a cached response is served
+
+    vary: what the cache key is made of. A list of 'path' (path arguments),
+    'query' (query arguments), 'user' (the authenticated user id) and
+    'claim:<name>' (a claim in the user's token)
+
+    max_size: max number of responses kept in cache
+
+    auth: authenticate the request before serving it from cache, since the
+    endpoint's x-decorate-server is skipped on hits
+    """
+
+    def __init__(self, operation_id, ttl, vary=['path', 'query'], max_size=1000, auth=False):
+        assert ttl > 0, f"x-cache ttl of {operation_id} must be a positive number of seconds"
+        check_vary(vary, f'x-cache of {operation_id}')
+
+        self.operation_id = operation_id
+        self.ttl = ttl
+        self.vary = vary
+        self.max_size = max_size
+        self.auth = auth or vary_requires_auth(vary)
+
+        # key -> (expiry time, path args, serialized response)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        caches[operation_id] = self
+
+    def get_key(self, path_args):
+        """Return the cache key of the current request"""
+        return get_request_key(self.vary, path_args, auth=self.auth)
+
+    def get(self, key):
+        """Return a flask response from cache, or None"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+
+        if not entry:
+            incr('cache.miss', endpoint=self.operation_id)
+            return None
+
+        incr('cache.hit', endpoint=self.operation_id)
+        data, status, mimetype, etag = entry[2]
+        r = Response(data, status=status, mimetype=mimetype)
+        r.headers['X-Cache'] = 'HIT'
+        if etag:
+            r.headers['ETag'] = etag
+        return r
+
+    def set(self, key, path_args, response):
+        """Cache a successful json response"""
+        if response.status_code != 200 or response.is_streamed:
+            return
+        entry = (
+            time.monotonic() + self.ttl,
+            dict(path_args),
+            (response.get_data(), response.status_code, response.mimetype, response.headers.get('ETag')),
+        )
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                incr('cache.eviction', endpoint=self.operation_id)
+        response.headers['X-Cache'] = 'MISS'
+
+    def invalidate(self, **path_args):
+        """Drop all cached responses, or only those whose path arguments match
+        path_args"""
+        with self.lock:
+            if not path_args:
+                self.entries.clear()
+                return
+            for key in list(self.entries.keys()):
+                args = self.entries[key][1]
+                if all(args.get(k) == v for k, v in path_args.items()):
+                    del self.entries[key]
+
+
+def invalidate_cache(f=None, **path_args):
+    """Invalidate cached responses of the endpoint implemented by f (a method or
+    its operation id), optionally only those for the given path
+    arguments. Invalidate all caches if f is None. Only affects the current
+    worker process.
+
+        invalidate_cache(do_get_item, item_id=item_id)
+    """
+    if f is None:
+        for c in caches.values():
+            c.invalidate()
+        return
+
+    operation_id = get_operation_id(f)
+    if operation_id not in caches:
+        log.warning(f"Endpoint {operation_id} has no x-cache")
+        return
+    caches[operation_id].invalidate(**path_args)
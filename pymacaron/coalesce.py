@@ -0,0 +1,88 @@
+import threading
+from flask import Response
+from pymacaron.log import pymlogger
+from pymacaron.metrics import incr
+from pymacaron.deadline import remaining_time
+from pymacaron.cache import get_request_key
+from pymacaron.cache import check_vary
+from pymacaron.cache import vary_requires_auth
+from pymacaron.exceptions import CoalesceTimeoutError
+
+
+log = pymlogger(__name__)
+
+
+class Flight():
+    """A call to an endpoint's implementation, shared by identical requests"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class RequestCoalescer():
+    """Single-flight calls to the implementation of an endpoint declaring
+    'x-coalesce': the first request with a given key calls it, and identical
+    requests arriving in the same worker meanwhile wait for and share its
+    result, or its exception.
+
+    vary: what identifies identical requests (see pymacaron.cache.get_request_key)
+
+    timeout: seconds after which waiting requests give up with a
+    CoalesceTimeoutError, or earlier if their deadline is closer
+    """
+
+    def __init__(self, operation_id, vary=['path', 'query'], timeout=10, auth=False):
+        check_vary(vary, f'x-coalesce of {operation_id}')
+        self.operation_id = operation_id
+        self.vary = vary
+        self.timeout = timeout
+        self.auth = auth or vary_requires_auth(vary)
+
+        # key -> Flight
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, path_args):
+        return get_request_key(self.vary, path_args, auth=self.auth)
+
+    def call(self, key, f, *args, **kwargs):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if leader:
+            incr('coalesce.leader', endpoint=self.operation_id)
+            try:
+                flight.result = f(*args, **kwargs)
+                return flight.result
+            except BaseException as e:
+                flight.exception = e
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+
+        incr('coalesce.follower', endpoint=self.operation_id)
+        log.info(f"Waiting for identical call to {self.operation_id}")
+        timeout = self.timeout
+        remaining = remaining_time()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        if not flight.done.wait(timeout):
+            incr('coalesce.timeout', endpoint=self.operation_id)
+            raise CoalesceTimeoutError(f"Timed out after {self.timeout}s waiting for identical call to {self.operation_id}")
+
+        if flight.exception is not None:
+            raise flight.exception
+
+        if isinstance(flight.result, Response):
+            # A flask response belongs to one request: don't share it
+            return f(*args, **kwargs)
+
+        return flight.result
@@ -0,0 +1,229 @@
+import gzip
+import time
+from flask import request
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.metrics import incr
+
+
+log = pymlogger(__name__)
+
+
+# Responses are compressed after each request according to a policy set in
+# pym-config (compress_enabled, compress_min_size, compress_algorithms,
+# compress_levels, compress_large_size), which endpoints may override with
+# 'x-compress' in their swagger declaration:
+#
+#   x-compress: false
+#
+#   x-compress:
+#     min_size: 4096
+#     algorithms: [gzip]
+#     levels:
+#       gzip: [9, 6]
+
+# Flask endpoint name -> the x-compress of that route
+route_policies = {}
+
+# Flask endpoint name -> CompressPolicy, built on first use, after pym-config
+# is loaded
+policies = {}
+
+# Mimetypes worth compressing, besides text/*
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/x-yaml',
+    'image/svg+xml',
+)
+
+
+def get_compressors():
+    """Return a dict of encoding: function(data, level) returning compressed
+    data, for all encodings whose library is installed"""
+    compressors = {
+        'gzip': lambda data, level: gzip.compress(data, compresslevel=level),
+    }
+
+    try:
+        import brotli
+        compressors['br'] = lambda data, level: brotli.compress(data, quality=level)
+    except ImportError:
+        pass
+
+    zstd = None
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            from backports import zstd
+        except ImportError:
+            pass
+    if zstd:
+        compressors['zstd'] = lambda data, level: zstd.compress(data, level=level)
+    else:
+        try:
+            import zstandard
+            compressors['zstd'] = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+        except ImportError:
+            pass
+
+    return compressors
+
+
+compressors = get_compressors()
+
+
+class CompressPolicy():
+    """How to compress responses.
+
+    min_size: responses smaller than this many bytes are sent uncompressed
+
+    algorithms: encodings to choose from, in order of preference, among those
+    accepted by the client
+
+    levels: a dict of encoding: [level, fast_level]. Responses larger than
+    large_size bytes are compressed with fast_level, since compression time
+    grows with size while the ratio barely improves at higher levels
+    """
+
+    def __init__(self, enabled=True, min_size=1024, algorithms=['br', 'zstd', 'gzip'], levels={}, large_size=256 * 1024):
+        self.enabled = enabled
+        self.min_size = min_size
+        self.algorithms = [a for a in algorithms if a in compressors]
+        self.levels = {
+            'gzip': [6, 1],
+            'br': [5, 1],
+            'zstd': [6, 1],
+        }
+        self.levels.update(levels)
+        self.large_size = large_size
+
+        for a in algorithms:
+            if a not in ('gzip', 'br', 'zstd'):
+                raise Exception(f"Unsupported compression algorithm '{a}'")
+            if a not in compressors:
+                log.warning(f"Cannot compress with '{a}': library not installed")
+
+    def choose_encoding(self):
+        """Return the client's preferred encoding among our algorithms, or
+        None. Ties go to the order of our algorithms"""
+        best, best_q = None, 0
+        for a in self.algorithms:
+            q = request.accept_encodings[a]
+            if q > best_q:
+                best, best_q = a, q
+        return best
+
+    def get_level(self, encoding, size):
+        level, fast_level = self.levels[encoding]
+        return fast_level if size > self.large_size else level
+
+
+def get_policy_args(endpoint=None):
+    """Return the arguments of the policy of a flask endpoint: pym-config's,
+    overriden by the endpoint's x-compress"""
+    conf = get_config()
+    kwargs = {
+        'enabled': conf.compress_enabled,
+        'min_size': conf.compress_min_size,
+        'algorithms': conf.compress_algorithms,
+        'levels': dict(conf.compress_levels or {}),
+        'large_size': conf.compress_large_size,
+    }
+    override = route_policies.get(endpoint, {})
+    for k, v in override.items():
+        if k == 'levels':
+            kwargs['levels'].update(v)
+        else:
+            kwargs[k] = v
+    return kwargs
+
+
+def set_route_compression(endpoint, x_compress):
+    """Override the compression policy of a flask endpoint with its
+    x-compress declaration: false, or a dict of min_size, algorithms, levels
+    and large_size"""
+    policies.pop(endpoint, None)
+    if x_compress is False:
+        route_policies[endpoint] = {'enabled': False}
+        return
+    assert type(x_compress) is dict, f"x-compress of {endpoint} should be false or a dictionary"
+    for k in x_compress.keys():
+        assert k in ('min_size', 'algorithms', 'levels', 'large_size'), f"Unsupported key '{k}' in x-compress of {endpoint}"
+    route_policies[endpoint] = x_compress
+
+
+def get_policy(endpoint):
+    if endpoint not in policies:
+        policies[endpoint] = CompressPolicy(**get_policy_args(endpoint))
+    return policies[endpoint]
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code >= 300 or response.status_code in (204, 206):
+        return False
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if 'no-transform' in response.headers.get('Cache-Control', ''):
+        return False
+    mimetype = response.mimetype or ''
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress_response(response):
+    """An after_request hook compressing the response according to the
+    policy of the requested endpoint"""
+    if not is_compressible(response):
+        return response
+
+    endpoint = request.url_rule.endpoint if request.url_rule else None
+    policy = get_policy(endpoint)
+    if not policy.enabled:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.content_length is not None and response.content_length < policy.min_size:
+        return response
+
+    encoding = policy.choose_encoding()
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    size = len(data)
+    if size < policy.min_size:
+        return response
+
+    level = policy.get_level(encoding, size)
+    t0 = time.thread_time()
+    compressed = compressors[encoding](data, level)
+    cpu_us = int((time.thread_time() - t0) * 1000000)
+
+    route = request.url_rule.rule if request.url_rule else None
+    incr('compress.cpu_us', cpu_us, encoding=encoding, route=route)
+    if len(compressed) >= size:
+        return response
+
+    incr('compress.responses', encoding=encoding, route=route)
+    incr('compress.bytes_in', size, encoding=encoding, route=route)
+    incr('compress.bytes_saved', size - len(compressed), encoding=encoding, route=route)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # One strong etag per encoding, as '<etag>:<encoding>'
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}:{encoding}', weak=weak)
+
+    return response
+
+
+def init_compression(app):
+    """Compress all responses of the app"""
+    app.after_request(compress_response)
@@ -0,0 +1,160 @@
+import threading
+from flask import request, has_request_context
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.metrics import incr
+from pymacaron.deadline import remaining_time
+from pymacaron.exceptions import ServerOverloadedError
+
+
+log = pymlogger(__name__)
+
+
+# Load shedding: a worker serves at most 'max_concurrency' requests at once
+# (pym-config), and each endpoint at most its 'x-max-concurrency' (swagger) or
+# the value set for its operation id in 'endpoint_max_concurrency'
+# (pym-config). Requests beyond a limit wait briefly in a small queue, then
+# get a 503 with a Retry-After header, instead of piling up behind busy
+# threads until clients time out.
+
+# Apis whose endpoints are exempt from the worker's limit, so that load
+# balancers can still ping an overloaded worker
+EXEMPT_APIS = ('ping', )
+
+# Key of the request environ marking a sub-request dispatched by a /batch
+# request, which already holds a slot of the worker's limit
+SUBREQUEST_ENVIRON = 'pymacaron.subrequest'
+
+worker_limit = None
+
+
+class ConcurrencyLimit():
+    """Limit how many requests run at once.
+
+    limit: max number of requests running at once
+
+    queue: max number of requests waiting for a slot. Further ones are
+    rejected right away
+
+    queue_timeout: seconds a request may wait for a slot before being rejected
+
+    retry_after: seconds the client is told to wait before retrying
+    """
+
+    def __init__(self, name, limit, queue=0, queue_timeout=0.5, retry_after=1):
+        assert type(limit) is int and limit > 0, f"Concurrency limit of {name} must be a positive integer"
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def reject(self):
+        incr('concurrency.shed', limit=self.name)
+        e = ServerOverloadedError(f"Too many concurrent requests to {self.name} (max {self.limit})")
+        return e.with_headers({'Retry-After': str(self.retry_after)})
+
+    def acquire(self, wait=True):
+        """Take a slot, waiting for one if the queue has room and wait is True,
+        or raise a ServerOverloadedError"""
+        with self.cond:
+            if self.running < self.limit:
+                self.running += 1
+                return
+
+            if not wait or self.waiting >= self.queue:
+                raise self.reject()
+
+            incr('concurrency.queued', limit=self.name)
+            timeout = self.queue_timeout
+            remaining = remaining_time()
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+            self.waiting += 1
+            try:
+                ok = self.cond.wait_for(lambda: self.running < self.limit, timeout=timeout)
+            finally:
+                self.waiting -= 1
+            if not ok:
+                raise self.reject()
+            self.running += 1
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+
+def new_limit(name, value):
+    """Return a ConcurrencyLimit from an int (the limit) or a dict of limit,
+    queue, queue_timeout and retry_after"""
+    if type(value) is int:
+        value = {'limit': value}
+    assert type(value) is dict and 'limit' in value, f"Concurrency limit of {name} should be an integer or a dictionary with a 'limit'"
+    conf = get_config()
+    return ConcurrencyLimit(
+        name,
+        value['limit'],
+        queue=value.get('queue', conf.max_concurrency_queue),
+        queue_timeout=value.get('queue_timeout', conf.max_concurrency_queue_timeout),
+        retry_after=value.get('retry_after', conf.max_concurrency_retry_after),
+    )
+
+
+def get_endpoint_limit(operation_id, x_max_concurrency=None):
+    """Return the ConcurrencyLimit of an endpoint, or None. pym-config's
+    endpoint_max_concurrency overrides the swagger's x-max-concurrency"""
+    value = (get_config().endpoint_max_concurrency or {}).get(operation_id, x_max_concurrency)
+    if not value:
+        return None
+    log.info(f"Limiting concurrent calls to {operation_id} to {value}")
+    return new_limit(operation_id, value)
+
+
+def get_worker_limit():
+    """Return the ConcurrencyLimit of this worker, or None"""
+    global worker_limit
+    value = get_config().max_concurrency
+    if not value:
+        return None
+    if worker_limit is None:
+        worker_limit = new_limit('worker', value)
+    return worker_limit
+
+
+def is_subrequest():
+    return has_request_context() and request.environ.get(SUBREQUEST_ENVIRON, False)
+
+
+class concurrency_slots():
+    """Take a slot in the worker's limit, unless api_name is exempt, and in
+    the endpoint's limit, if any, for the duration of a request. If wait is
+    False, reject the request instead of queueing it when a limit is full"""
+
+    def __init__(self, api_name, endpoint_limit=None, wait=True):
+        self.limits = []
+        if api_name not in EXEMPT_APIS and not is_subrequest():
+            self.limits.append(get_worker_limit())
+        self.limits.append(endpoint_limit)
+        self.limits = [lim for lim in self.limits if lim]
+        self.acquired = []
+        self.wait = wait
+
+    def __enter__(self):
+        for lim in self.limits:
+            try:
+                lim.acquire(wait=self.wait)
+            except ServerOverloadedError:
+                self.release()
+                raise
+            self.acquired.append(lim)
+
+    def release(self):
+        while self.acquired:
+            self.acquired.pop().release()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
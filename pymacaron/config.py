@@ -25,6 +25,71 @@ class PyMacaronConfig(object):
         # Default time-limit for the slow-call report
         self.report_call_exceeding_ms = 1000
 
+        # When to recycle a gunicorn worker (see pymacaron.recycle)
+        self.recycle_max_rss_mb = None
+        self.recycle_latency_drift = 2.0
+        self.recycle_latency_floor_ms = 100
+        self.recycle_min_interval = 30
+
+        # Limits of the builtin /batch endpoint (see pymacaron.batch)
+        self.batch_max_requests = 20
+        self.batch_max_threads = 4
+
+        # Max number of server-sent event streams per worker, and seconds
+        # between heartbeats (see pymacaron.sse)
+        self.sse_max_streams = 2
+        self.sse_heartbeat = 15
+
+        # How to compress responses (see pymacaron.compress)
+        self.compress_enabled = True
+        self.compress_min_size = 1024
+        self.compress_algorithms = ['br', 'zstd', 'gzip']
+        self.compress_levels = None
+        self.compress_large_size = 256 * 1024
+
+        # Load shedding (see pymacaron.concurrency): max requests served at
+        # once by a worker, max requests per endpoint (operation id: limit),
+        # and how long requests beyond a limit may wait before getting a 503
+        self.max_concurrency = None
+        self.endpoint_max_concurrency = None
+        self.max_concurrency_queue = 2
+        self.max_concurrency_queue_timeout = 0.5
+        self.max_concurrency_retry_after = 1
+
+        # Number of rate-limit buckets shared by a container's workers (see
+        # pymacaron.ratelimit)
+        self.rate_limit_slots = 65536
+
+        # Number of proxies in front of the service that append the address
+        # they got a request from to its X-Forwarded-For header. Clients are
+        # rate-limited by the address the outermost one got (see
+        # pymacaron.ratelimit)
+        self.trusted_proxy_count = 0
+
+        # Which cross-origin requests to allow (see pymacaron.cors). No
+        # cors_origins disallows all
+        self.cors_origins = ['*']
+        self.cors_headers = ['Content-Type', 'Authorization']
+        self.cors_methods = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE']
+        self.cors_expose_headers = []
+        self.cors_credentials = False
+        self.cors_max_age = 86400
+
+        # Threads running sync endpoints in each ASGI worker (see
+        # pymacaron.asgi)
+        self.asgi_threads = 32
+
+        # Threads running @background tasks in each worker, max tasks queued,
+        # and seconds pending tasks get to complete when the worker exits
+        # (see pymacaron.background)
+        self.background_threads = 4
+        self.background_max_pending = 1000
+        self.background_drain_timeout = 10
+
+        # Threads running concurrent calls to other services in each worker
+        # (see pymacaron.fanout)
+        self.fanout_threads = 16
+
 
     def load_pym_config(self, path=None, env=None):
         """Search for a pym-config file and load it if found, otherwise raise an error
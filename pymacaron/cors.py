@@ -0,0 +1,148 @@
+from flask import request
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+
+
+log = pymlogger(__name__)
+
+
+# Cross-origin requests are allowed according to one policy, set in
+# pym-config (cors_origins, cors_headers, cors_methods, cors_expose_headers,
+# cors_credentials, cors_max_age) and compiled once into header values.
+# Preflight requests are answered before routing, and the CORS headers of
+# other requests are added after each request.
+
+ALLOW_ORIGIN = 'Access-Control-Allow-Origin'
+
+# The policy of this process, set by init_cors()
+policy = None
+
+
+class CorsPolicy():
+    """Which cross-origin requests to allow.
+
+    origins: allowed origins, or ['*'] for any
+
+    headers: request headers allowed in cross-origin requests, or ['*'] for
+    any
+
+    methods: methods allowed in cross-origin requests
+
+    expose_headers: response headers readable by cross-origin clients
+
+    credentials: allow requests with cookies or http auth
+
+    max_age: seconds during which browsers may cache a preflight response
+    """
+
+    def __init__(self, origins=['*'], headers=['Content-Type', 'Authorization'], methods=['GET'], expose_headers=[], credentials=False, max_age=86400):
+        self.any_origin = '*' in origins
+        self.origins = frozenset(origins)
+        self.any_header = '*' in headers
+
+        # The allowed origin varies with the request's Origin, unless it is
+        # always '*'
+        self.static_origin = '*' if self.any_origin and not credentials else None
+        self.vary = self.static_origin is None
+
+        credentials_headers = [('Access-Control-Allow-Credentials', 'true')] if credentials else []
+
+        self.preflight_headers = credentials_headers + [
+            ('Access-Control-Allow-Methods', ', '.join(methods)),
+            ('Access-Control-Max-Age', str(max_age)),
+        ]
+        if self.vary:
+            self.preflight_headers.append(('Vary', 'Origin'))
+        if not self.any_header:
+            self.preflight_headers.append(('Access-Control-Allow-Headers', ', '.join(headers)))
+
+        self.response_headers = credentials_headers
+        if expose_headers:
+            self.response_headers.append(('Access-Control-Expose-Headers', ', '.join(expose_headers)))
+
+    def allow_origin(self, origin):
+        """Return the Access-Control-Allow-Origin of a request from origin, or
+        None if it is not allowed"""
+        if not origin:
+            return None
+        if self.static_origin:
+            return self.static_origin
+        if self.any_origin or origin in self.origins:
+            return origin
+        return None
+
+    def get_preflight_headers(self, origin, request_headers=None):
+        """Return the headers of the response to a preflight request"""
+        allowed = self.allow_origin(origin)
+        if not allowed:
+            return [('Vary', 'Origin')] if self.vary else []
+        headers = [(ALLOW_ORIGIN, allowed)] + self.preflight_headers
+        if self.any_header and request_headers:
+            headers.append(('Access-Control-Allow-Headers', request_headers))
+        return headers
+
+
+def get_policy():
+    """Return the CorsPolicy set in pym-config, or None if cross-origin
+    requests are not allowed"""
+    conf = get_config()
+    if not conf.cors_origins:
+        return None
+    return CorsPolicy(
+        origins=conf.cors_origins,
+        headers=conf.cors_headers,
+        methods=conf.cors_methods,
+        expose_headers=conf.cors_expose_headers,
+        credentials=conf.cors_credentials,
+        max_age=conf.cors_max_age,
+    )
+
+
+def is_preflight(method, origin, request_method):
+    return method == 'OPTIONS' and origin and request_method
+
+
+def preflight_response(environ, start_response):
+    headers = policy.get_preflight_headers(environ['HTTP_ORIGIN'], environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS'))
+    start_response('204 No Content', headers + [('Content-Length', '0')])
+    return [b'']
+
+
+class CorsPreflight():
+    """WSGI middleware answering preflight requests before routing"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if is_preflight(environ['REQUEST_METHOD'], environ.get('HTTP_ORIGIN'), environ.get('HTTP_ACCESS_CONTROL_REQUEST_METHOD')):
+            return preflight_response(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def add_cors_headers(response):
+    """Add CORS headers to the response of a cross-origin request"""
+    origin = request.headers.get('Origin')
+    if not origin or ALLOW_ORIGIN in response.headers:
+        return response
+    if policy.vary:
+        response.vary.add('Origin')
+    allowed = policy.allow_origin(origin)
+    if allowed:
+        response.headers[ALLOW_ORIGIN] = allowed
+        response.headers.extend(policy.response_headers)
+    return response
+
+
+def init_cors(app):
+    """Apply pym-config's CORS policy to the app. Call it after any other
+    wrapping of app.wsgi_app"""
+    global policy
+    policy = get_policy()
+    if not policy:
+        log.info("Cross-origin requests are not allowed")
+        return
+    if add_cors_headers not in app.after_request_funcs.get(None, []):
+        app.after_request(add_cors_headers)
+    if not isinstance(app.wsgi_app, CorsPreflight):
+        app.wsgi_app = CorsPreflight(app.wsgi_app)
@@ -0,0 +1,77 @@
+import time
+from flask import request, has_app_context, has_request_context
+from pymacaron.log import pymlogger
+from pymacaron.exceptions import DeadlineExceededError
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = pymlogger(__name__)
+
+
+# Request deadlines: an endpoint declaring 'x-timeout' must reply within that
+# many seconds, and a caller may tell how many milliseconds it will wait for
+# a reply in the DEADLINE_HEADER header. The earliest of both is the request's
+# deadline, that handlers may check with remaining_time() or check_deadline(),
+# and that add_auth forwards to outgoing calls. Python threads cannot be
+# interrupted, so a handler still busy at its deadline runs to completion, but
+# its result is replaced by a 504 DEADLINE_EXCEEDED error.
+
+DEADLINE_HEADER = 'X-Pym-Deadline-Ms'
+
+
+def set_deadline(timeout):
+    """Set the current request's deadline to timeout seconds from now, unless
+    it already has an earlier one"""
+    deadline = time.monotonic() + timeout
+    current = get_deadline()
+    if current is None or deadline < current:
+        stack.top.pym_deadline = deadline
+
+
+def get_deadline():
+    """Return the current request's deadline, in time.monotonic() time, or
+    None"""
+    if not has_app_context():
+        return None
+    return getattr(stack.top, 'pym_deadline', None)
+
+
+def start_deadline(timeout=None):
+    """Set the deadline of the incoming request, after the endpoint's
+    x-timeout and the caller's DEADLINE_HEADER"""
+    if has_request_context() and DEADLINE_HEADER in request.headers:
+        try:
+            set_deadline(int(request.headers[DEADLINE_HEADER]) / 1000)
+        except ValueError:
+            log.warning(f"Ignoring invalid {DEADLINE_HEADER} header [{request.headers[DEADLINE_HEADER]}]")
+    if timeout:
+        set_deadline(timeout)
+
+
+def remaining_time():
+    """Return the seconds left before the current request's deadline (0 if
+    passed), or None if it has no deadline"""
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def check_deadline():
+    """Raise a DeadlineExceededError if the current request's deadline has
+    passed. Call it between steps of long handlers to give up early"""
+    if remaining_time() == 0:
+        raise DeadlineExceededError("Request deadline exceeded")
+
+
+def get_deadline_headers():
+    """Return the headers forwarding the current request's deadline to an
+    outgoing call, if it has one"""
+    remaining = remaining_time()
+    if remaining is None:
+        return {}
+    return {DEADLINE_HEADER: str(int(remaining * 1000))}
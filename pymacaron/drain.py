@@ -0,0 +1,170 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from pymacaron.log import pymlogger
+
+
+log = pymlogger(__name__)
+
+
+# Draining: when a worker is told to stop (SIGTERM) or is recycled, /ping
+# starts failing so that load balancers stop sending traffic, the worker
+# finishes its in-flight requests, then flushes queued logs, metrics and
+# error reports before exiting.
+
+draining = False
+
+# Number of requests currently being served by this worker
+inflight = 0
+inflight_lock = threading.Lock()
+
+# Functions to call to flush whatever the service has queued
+drain_hooks = []
+
+# When the current flush must be done by, if flushing
+flush_deadline = None
+
+
+def get_drain_delay():
+    """Seconds during which /ping fails but requests are still served after
+    SIGTERM, to give load balancers time to stop sending traffic"""
+    return float(os.environ.get('PYM_DRAIN_DELAY', 5))
+
+
+def get_drain_timeout():
+    """Max seconds to wait for in-flight requests to complete"""
+    return float(os.environ.get('PYM_DRAIN_TIMEOUT', 30))
+
+
+def get_flush_timeout():
+    """Max seconds drain hooks may take to flush when a worker exits"""
+    return float(os.environ.get('PYM_FLUSH_TIMEOUT', 10))
+
+
+def get_graceful_timeout():
+    """Seconds a gunicorn worker needs to drain after SIGTERM: the drain delay,
+    then at most the drain timeout for in-flight requests, then the flush"""
+    return int(get_drain_delay() + get_drain_timeout() + get_flush_timeout()) + 1
+
+
+def add_drain_hook(hook):
+    """Register a function to call when a worker exits, to flush queued data"""
+    assert callable(hook), "Drain hook %s should be a function" % str(hook)
+    drain_hooks.append(hook)
+
+
+def is_draining():
+    return draining
+
+
+def start_draining(reason):
+    global draining
+    if not draining:
+        log.info(f"Draining worker {os.getpid()} ({reason})")
+        draining = True
+
+
+class inflight_request():
+    """Count the requests being served by this worker"""
+
+    def __enter__(self):
+        global inflight
+        with inflight_lock:
+            inflight += 1
+
+    def __exit__(self, type, value, traceback):
+        global inflight
+        with inflight_lock:
+            inflight -= 1
+
+
+def wait_for_inflight(timeout):
+    """Wait until all in-flight requests have completed, or until timeout
+    seconds have passed. Return True if no request is in-flight"""
+    t_end = time.time() + timeout
+    while inflight > 0 and time.time() < t_end:
+        time.sleep(0.1)
+    if inflight > 0:
+        log.warning(f"Giving up waiting for {inflight} in-flight requests")
+    return inflight == 0
+
+
+def get_flush_time_left():
+    """Return the seconds drain hooks have left to flush, or None if not
+    flushing. Drain hooks that wait must not wait longer"""
+    if flush_deadline is None:
+        return None
+    return max(flush_deadline - time.time(), 0)
+
+
+def flush():
+    """Call all drain hooks, then flush all log handlers"""
+    global flush_deadline
+    flush_deadline = time.time() + get_flush_timeout()
+    try:
+        for h in drain_hooks:
+            try:
+                h()
+            except Exception as e:
+                log.error(f"Drain hook {h} failed: {e}")
+    finally:
+        flush_deadline = None
+
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+#
+# Drain gunicorn workers
+#
+
+def drain_on_sigterm(worker):
+    """Called in gunicorn's post_worker_init: on SIGTERM, fail /ping at once but
+    keep serving for get_drain_delay() seconds, then stop accepting
+    connections. The worker then waits for in-flight requests up to
+    get_drain_timeout() seconds, and flushes in worker_exit: all within the
+    master's graceful_timeout (see get_graceful_timeout())"""
+
+    # The worker waits for in-flight requests up to its own graceful_timeout,
+    # counted from when it stops accepting connections, while the master
+    # counts from SIGTERM
+    worker.cfg.set('graceful_timeout', get_drain_timeout())
+
+    def stop_worker():
+        log.info(f"Worker {worker.pid} stops accepting connections")
+        worker.alive = False
+
+    def handle_sigterm(sig, frame):
+        start_draining('SIGTERM')
+        threading.Timer(get_drain_delay(), stop_worker).start()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def drain_on_exit(worker):
+    """Called in gunicorn's worker_exit, after the worker's in-flight requests
+    have completed or timed out"""
+    if os.getpid() != worker.pid:
+        # gunicorn also calls worker_exit in the master for workers already gone
+        return
+    start_draining('exit')
+    flush()
+
+
+#
+# Drain Flask's own server (when not running in gunicorn)
+#
+
+def drain_flask_on_sigterm():
+    """On SIGTERM, fail /ping, wait for in-flight requests, flush and exit"""
+
+    def handle_sigterm(sig, frame):
+        start_draining('SIGTERM')
+        wait_for_inflight(get_drain_timeout())
+        flush()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
@@ -1,6 +1,12 @@
+import io
 import os
 import json
-from flask import request, jsonify
+import hashlib
+import contextvars
+from itertools import chain
+from flask import request, jsonify, Response, stream_with_context, send_file
+from werkzeug.wsgi import wrap_file
+from flask import json as flask_json
 from werkzeug import FileStorage
 from werkzeug.exceptions import ClientDisconnected
 from pydantic.error_wrappers import ValidationError
@@ -10,32 +16,49 @@ from pymacaron import apipool
 from pymacaron import jsonencoders
 from pymacaron.model import PymacaronBaseModel
 from pymacaron.crash import postmortem
+from pymacaron.drain import inflight_request
+from pymacaron.recycle import STREAMED_ENVIRON
+from pymacaron.concurrency import concurrency_slots
+from pymacaron.deadline import start_deadline, check_deadline, remaining_time
+from pymacaron.upload import parse_upload
+from pymacaron.sse import sse_response
+from pymacaron.aio import resolve_async
+from pymacaron.offload import run_in_process
 from pymacaron.exceptions import PyMacaronException
 from pymacaron.exceptions import UnhandledServerError
 from pymacaron.exceptions import InvalidParameterError
 from pymacaron.exceptions import BadResponseException
 from pymacaron.exceptions import InternalValidationError
 from pymacaron.exceptions import RequestTimeout
+from pymacaron.exceptions import ServerOverloadedError
+from pymacaron.exceptions import RateLimitedError
+from pymacaron.exceptions import DeadlineExceededError
 
 
 log = pymlogger(__name__)
 
 
-def get_form_data(form_args=None):
-    # Just extract whatever we can from that form, data or file alike
+def get_form_data(form_args=None, upload=None):
+    # Just extract whatever we can from that form, data or file alike. If the
+    # endpoint declares x-upload, files are passed as spooled file-like
+    # objects instead of bytes
 
     try:
-        kwargs = request.form.to_dict()
+        if upload:
+            form, files = parse_upload(**upload)
+        else:
+            form, files = request.form, request.files
+        kwargs = form.to_dict()
     except ClientDisconnected:
         raise RequestTimeout()
 
     # Go through all the objects passed in form-data and try converting to something json-friendly
-    files = request.files.to_dict()
+    files = files.to_dict()
     for k in list(files.keys()):
         v = files[k]
         if isinstance(v, FileStorage):
             name = v.name
-            kwargs[name] = v.read()
+            kwargs[name] = v if upload else v.read()
         else:
             raise Exception("Support for multipart/form-data containing %s is not implemented" % type(v))
 
@@ -54,8 +77,10 @@ def get_request_body(api_name, model_name):
 
     kwargs = {}
 
-    # If the request contained no data, no need to analyze it further
-    if len(request.get_data()) != 0:
+    # If the request contained no data, no need to analyze it further. Don't
+    # read the body just to find out
+    has_body = request.content_length or request.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+    if has_body:
 
         # Let's try to convert whatever content-type we got in the request to something json-like
         ctype = request.content_type
@@ -96,8 +121,147 @@ def get_path_and_query_parameters(query_model, path_args):
     return d
 
 
-def pymacaron_flask_endpoint(api_name=None, f=None, error_callback=None, query_model=None, body_model_name=None, form_args={}, path_args={}, produces='application/json', result_models=[]):
+def etag_matches(etag):
+    """Return true if the request's If-None-Match header matches this etag,
+    including the '<etag>:<encoding>' variants set by pymacaron.compress"""
+    tags = request.if_none_match
+    if tags.star_tag:
+        return True
+    for tag in tags.as_set(include_weak=True):
+        if tag == etag or tag.rsplit(':', 1)[0] == etag:
+            return True
+    return False
+
+
+def not_modified(etag):
+    r = Response(status=304)
+    r.set_etag(etag)
+    return r
+
+
+def get_version_etag(version):
+    """Turn a version returned by an x-etag hook into an etag for the
+    current url"""
+    return hashlib.sha1(f'{request.full_path}|{version}'.encode('utf-8')).hexdigest()
+
+
+def error_response(e, error_callback=None):
+    """Return a flask response for the PyMacaronException e, formatted by the
+    error_callback, if any"""
+    status = e.status
+
+    if error_callback:
+        # The error_callback takes the error instance and returns a json
+        # dictionary back
+        d = error_callback(e)
+        log.info(f"Returning API error (status:{status}): {json.dumps(d, indent=4, sort_keys=True)}")
+        r = jsonify(d)
+        r.status_code = status
+        if e.headers:
+            r.headers.extend(e.headers)
+        return r
+
+    return e.jsonify()
+
+
+# Set by pymacaron.asgi while it dispatches a request, to get endpoints to
+# return a DeferredEndpoint instead of blocking its event loop
+defer_endpoints = contextvars.ContextVar('pym_defer_endpoints', default=False)
+
+
+class HandlerCall():
+    """A call to an endpoint's implementation, yielded by call_f_steps to let
+    its caller decide where to run it"""
+
+    def __init__(self, f, args, kwargs, coalesce=None, coalesce_key=None, offload=None):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.coalesce_key = coalesce_key
+        self.offload = offload
+
+    def call(self):
+        if self.offload:
+            return run_in_process(self.f, self.args, self.kwargs)
+        # Async handlers run on the worker's event loop
+        return resolve_async(self.f(*self.args, **self.kwargs))
+
+    def run(self):
+        """Call the implementation in the current thread and return its result"""
+        if self.coalesce:
+            # Share the result of an identical request in progress, if any
+            return self.coalesce.call(self.coalesce_key, self.call)
+        return self.call()
+
+
+class DeferredEndpoint(Response):
+    """A placeholder response holding the steps of an endpoint call, left to
+    pymacaron.asgi to run. Headers that view decorators (flask_cors...) add
+    to it are copied to the actual response"""
+
+    def __init__(self, steps):
+        super().__init__()
+        self.steps = steps
+        self.default_headers = set(self.headers.keys())
+
+    def copy_headers(self, r):
+        for k, v in self.headers.items():
+            if k not in self.default_headers and k not in r.headers:
+                r.headers.add(k, v)
+        return r
+
+
+def run_steps(steps):
+    """Run the steps of an endpoint call in the current thread, and return
+    the flask response they end with"""
+    try:
+        call = next(steps)
+        while True:
+            try:
+                result = call.run()
+            except (BaseException, Exception) as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+def pymacaron_flask_endpoint(api_name=None, f=None, error_callback=None, query_model=None, body_model_name=None, form_args={}, path_args={}, produces='application/json', result_models=[], cache=None, etag=None, coalesce=None, stream=None, upload=None, concurrency=None, rate_limit=None, timeout=None, offload=None):
     """Call endpoint in a try/catch loop handling exceptions"""
+    deferred = defer_endpoints.get()
+    steps = endpoint_steps(
+        api_name=api_name,
+        f=f,
+        error_callback=error_callback,
+        query_model=query_model,
+        body_model_name=body_model_name,
+        form_args=form_args,
+        path_args=path_args,
+        produces=produces,
+        result_models=result_models,
+        cache=cache,
+        etag=etag,
+        coalesce=coalesce,
+        stream=stream,
+        upload=upload,
+        concurrency=concurrency,
+        rate_limit=rate_limit,
+        timeout=timeout,
+        offload=offload,
+        # An event loop must not wait for concurrency slots
+        wait=not deferred,
+    )
+    if deferred:
+        return DeferredEndpoint(steps)
+    return run_steps(steps)
+
+
+def endpoint_steps(api_name=None, f=None, error_callback=None, query_model=None, body_model_name=None, form_args={}, path_args={}, produces='application/json', result_models=[], cache=None, etag=None, coalesce=None, stream=None, upload=None, concurrency=None, rate_limit=None, timeout=None, offload=None, wait=True):
+    """The steps of pymacaron_flask_endpoint: yield the HandlerCalls of the
+    endpoint's x-etag hook and implementation, get sent their results, and
+    return the flask response"""
 
     endpoint_method = request.method
     endpoint_path = request.path
@@ -110,16 +274,46 @@ def pymacaron_flask_endpoint(api_name=None, f=None, error_callback=None, query_m
     log.info(" ")
 
     try:
-        return call_f(
-            api_name=api_name,
-            f=f,
-            query_model=query_model,
-            body_model_name=body_model_name,
-            path_args=path_args,
-            form_args=form_args,
-            produces=produces,
-            result_models=result_models,
-        )
+        with inflight_request():
+            start_deadline(timeout)
+            limit_headers = rate_limit.check() if rate_limit else None
+
+            with concurrency_slots(api_name, concurrency, wait=wait):
+                # Don't start working on a request whose caller gave up
+                check_deadline()
+                r = yield from call_f_steps(
+                    api_name=api_name,
+                    f=f,
+                    query_model=query_model,
+                    body_model_name=body_model_name,
+                    path_args=path_args,
+                    form_args=form_args,
+                    produces=produces,
+                    result_models=result_models,
+                    cache=cache,
+                    etag=etag,
+                    coalesce=coalesce,
+                    stream=stream,
+                    upload=upload,
+                    offload=offload,
+                )
+
+            if remaining_time() == 0 and not (isinstance(r, Response) and r.is_streamed):
+                # The caller has given up on this response
+                raise DeadlineExceededError(f"{f.__name__} replied after its deadline")
+
+            if limit_headers and isinstance(r, Response):
+                r.headers.extend(limit_headers)
+            return r
+
+    except (ServerOverloadedError, RateLimitedError) as e:
+        # Shed load as cheaply as possible: no postmortem
+        log.warning(f"Rejecting call to {f.__name__}: {str(e)}")
+        return error_response(e, error_callback)
+
+    except GeneratorExit:
+        # The steps were abandoned by their caller
+        raise
 
     # Catch ALL exceptions
     except (BaseException, Exception) as e:
@@ -143,18 +337,7 @@ def pymacaron_flask_endpoint(api_name=None, f=None, error_callback=None, query_m
         if not isinstance(e, PyMacaronException):
             e = UnhandledServerError(str(e))
 
-        status = e.status
-
-        if error_callback:
-            # The error_callback takes the error instance and returns a json
-            # dictionary back
-            d = error_callback(e)
-            log.info(f"Returning API error (status:{status}): {json.dumps(d, indent=4, sort_keys=True)}")
-            r = jsonify(d)
-            r.status_code = status
-            return r
-
-        return e.jsonify()
+        return error_response(e, error_callback)
 
     finally:
         log.info(" ")
@@ -163,12 +346,188 @@ def pymacaron_flask_endpoint(api_name=None, f=None, error_callback=None, query_m
         log.info(" ")
 
 
-def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_model_name=None, form_args={}, path_args={}, produces='application/json', result_models=[]):
+def check_iterator(result):
+    if isinstance(result, (PymacaronBaseModel, Response)) or not hasattr(result, '__iter__'):
+        raise BadResponseException(f'Expected to return an iterator of models but got {result} of type {type(result)}')
+
+
+def serialize_item(item, result_models):
+    """Validate and serialize one model yielded by a streaming endpoint"""
+    if not [m for m in result_models if isinstance(item, m)]:
+        str_result_models = ' or '.join([str(m) for m in result_models])
+        raise BadResponseException(f'Expected to yield instances of {str_result_models}, but got a {item}')
+    return flask_json.dumps(item.to_json(
+        exclude_unset=True,
+        exclude_none=False,
+        keep_nullable=True,
+        keep_datetime=False,
+        datetime_encoder=jsonencoders.get_datetime_encoder(),
+    ), separators=(',', ':'))
+
+
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'array': 'application/json',
+}
+
+
+def stream_response(f, result, result_models, stream):
+    """Return a flask response streaming the models yielded by an x-stream
+    endpoint, validated and serialized one at a time, either as one json
+    document per line (ndjson) or as a json array (array). The wsgi server
+    pulls the next item only once the previous one was sent, so a slow
+    client slows down the endpoint instead of filling memory.
+    """
+    assert stream in STREAM_MIMETYPES, f"Unsupported x-stream format '{stream}'"
+
+    check_iterator(result)
+
+    def serialize(item):
+        return serialize_item(item, result_models)
+
+    # Get the first item before sending headers, so that errors raised early
+    # get a proper error response
+    items = iter(result)
+    try:
+        item = next(items)
+        first = [serialize(item)]
+    except StopIteration:
+        first = []
+
+    def generate():
+        t0 = timenow()
+        with inflight_request():
+            try:
+                i = 0
+                if stream == 'array':
+                    yield '['
+                for s in chain(first, (serialize(item) for item in items)):
+                    if stream == 'array':
+                        yield s if i == 0 else ',' + s
+                    else:
+                        yield s + '\n'
+                    i += 1
+                if stream == 'array':
+                    yield ']'
+            except GeneratorExit:
+                log.info(f"Client disconnected while streaming {f.__name__}")
+                raise
+            except (BaseException, Exception) as e:
+                # Headers are sent: all we can do is report the error and cut
+                # the response short
+                log.error(f"Method {f.__name__} raised exception while streaming [{str(e)}]")
+                postmortem(f=f, t0=t0, t1=timenow(), exception=e)
+                raise
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+
+    # Don't count the stream's duration as the worker's latency
+    request.environ[STREAMED_ENVIRON] = True
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream])
+
+
+# Size of the chunks in which bytearray and memoryview responses are sent
+BUFFER_CHUNK_SIZE = 64 * 1024
+
+
+class BufferChunks():
+    """Iterate over a buffer in bytes chunks, as WSGI servers require, without
+    copying the whole buffer: only the chunk being sent is copied. Seekable,
+    so that range requests skip to their first byte"""
+
+    def __init__(self, data, chunk_size=BUFFER_CHUNK_SIZE):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= self.data.nbytes:
+            raise StopIteration()
+        chunk = bytes(self.data[self.pos:self.pos + self.chunk_size])
+        self.pos += len(chunk)
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+
+def file_response(result, produces):
+    """Return a flask response serving the binary or text content returned by an
+    endpoint that produces something else than json: a file path, a file
+    object, bytes or a memoryview. Files are passed to the wsgi server's
+    file_wrapper (sendfile with gunicorn) without being read in python, and
+    Range requests are supported.
+    """
+
+    if isinstance(result, Response):
+        return result
+
+    if isinstance(result, (str, os.PathLike)):
+        path = os.fspath(result)
+        if not os.path.isfile(path):
+            raise BadResponseException(f'Expected to return the path of a file but {path} is not one')
+        return send_file(path, mimetype=produces, conditional=True)
+
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        # WSGI servers only accept bytes chunks (gunicorn raises a TypeError
+        # otherwise): bytes are sent as they are, other buffers one chunk at a
+        # time
+        if isinstance(result, bytes):
+            size = len(result)
+            r = Response([result], mimetype=produces, direct_passthrough=True)
+        else:
+            data = memoryview(result).cast('B')
+            size = data.nbytes
+            r = Response(BufferChunks(data), mimetype=produces, direct_passthrough=True)
+        r.content_length = size
+        return r.make_conditional(request, accept_ranges=True, complete_length=size)
+
+    if hasattr(result, 'read'):
+        size = None
+        try:
+            offset = result.tell()
+            try:
+                size = os.fstat(result.fileno()).st_size - offset
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                size = result.getbuffer().nbytes - offset
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            offset = None
+        r = Response(wrap_file(request.environ, result), mimetype=produces, direct_passthrough=True)
+        if size is None:
+            return r
+        r.content_length = size
+        # Ranges are relative to the start of the file
+        return r.make_conditional(request, accept_ranges=offset == 0, complete_length=size)
+
+    raise BadResponseException(f'Expected to return a file path, file object, bytes or a flask Response for {produces} but got {type(result)}')
+
+
+def call_f(**kwargs):
+    """Call a pymacaron endpoint implementation in the current thread and
+    return the flask response. See call_f_steps"""
+    return run_steps(call_f_steps(**kwargs))
+
+
+def call_f_steps(api_name=None, f=None, error_callback=None, query_model=None, body_model_name=None, form_args={}, path_args={}, produces='application/json', result_models=[], cache=None, etag=None, coalesce=None, stream=None, upload=None, offload=None):
     """A generic flask endpoint that calls a given pymacaron endpoint
     implementation and handle conversion between query/body parameters,
     pymacaron models and flask response. Also handle error handling and
     optional decoration.
 
+    The calls to the x-etag hook, if any, and to the implementation are
+    yielded as HandlerCalls, whose results are sent back.
+
     api_name: name of the api to which this endpoint belongs
 
     f: reference to the method that implements this endpoint in the pymacaron microservice
@@ -177,11 +536,40 @@ def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_mo
 
     body_model_name: name of the model that defines the HTTP body data expected by this endpoint (None if none)
 
+    cache: the ResponseCache declared by this endpoint's x-cache, if any
+
+    etag: the x-etag hook of this endpoint, if any. Called with the same
+    arguments as f, it returns a version of the response (or None if it can't
+    tell), used as etag without calling f
+
+    coalesce: the RequestCoalescer declared by this endpoint's x-coalesce, if
+    any
+
+    stream: 'ndjson' or 'array' if the endpoint declares x-stream, in which
+    case f returns an iterator of models that are serialized one at a time
+
+    upload: a dict of parse_upload() arguments if the endpoint declares
+    x-upload, in which case files are passed to f as file-like objects
+
+    offload: 'process' if the endpoint declares x-offload, in which case f
+    runs in the worker's pool of processes (see pymacaron.offload)
+
     """
 
     if os.environ.get('PYM_DEBUG', None) == '1':
         log.debug("PYM_DEBUG: Request headers are: %s" % dict(request.headers))
 
+    conditional = request.method == 'GET'
+
+    if cache:
+        # Serve cached bytes, skipping both the endpoint and serialization
+        cache_key = cache.get_key(path_args)
+        r = cache.get(cache_key)
+        if r:
+            if conditional and etag_matches(r.get_etag()[0]):
+                return not_modified(r.get_etag()[0])
+            return r
+
     args = []
     if body_model_name:
         args.append(get_request_body(api_name, body_model_name))
@@ -189,18 +577,43 @@ def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_mo
     kwargs = get_path_and_query_parameters(query_model, path_args)
 
     if form_args:
-        kwargs.update(get_form_data(form_args))
+        kwargs.update(get_form_data(form_args, upload=upload))
 
     if os.environ.get('PYM_DEBUG', None) == '1':
         log.debug("PYM_DEBUG: Request args are: [args: %s] [kwargs: %s]" % (args, kwargs))
 
+    version_etag = None
+    if etag and conditional:
+        # Let the endpoint tell cheaply if the client's version is current.
+        # The hook may block (database lookup...): yield it like f, for
+        # pymacaron.asgi to run it off the event loop
+        version = yield HandlerCall(etag, args, kwargs)
+        if version is not None:
+            version_etag = get_version_etag(version)
+            if etag_matches(version_etag):
+                return not_modified(version_etag)
+
     try:
-        result = f(*args, **kwargs)
+        result = yield HandlerCall(
+            f,
+            args,
+            kwargs,
+            coalesce=coalesce,
+            coalesce_key=coalesce.get_key(path_args) if coalesce else None,
+            offload=offload,
+        )
     except ValidationError as e:
         # A pydantic validation error occuring inside the endpoint is actually
         # a fatal crash. We re-raise it but changed its type
         raise InternalValidationError(str(e)) from e
 
+    if stream:
+        return stream_response(f, result, result_models, stream)
+
+    if produces == 'text/event-stream':
+        check_iterator(result)
+        return sse_response(f, result, lambda item: serialize_item(item, result_models))
+
     if produces == 'application/json':
         assert result_models, "BUG: no result models specified"
         str_result_models = ' or '.join([str(m) for m in result_models])
@@ -217,7 +630,7 @@ def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_mo
             if not found:
                 raise BadResponseException(f'Expected to return an instance of {str_result_models}, but got a {result}')
 
-            return jsonify(result.to_json(
+            r = jsonify(result.to_json(
                 exclude_unset=True,
                 exclude_none=False,
                 keep_nullable=True,
@@ -225,6 +638,20 @@ def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_mo
                 datetime_encoder=jsonencoders.get_datetime_encoder(),
             ))
 
+            if conditional:
+                if version_etag:
+                    r.set_etag(version_etag)
+                else:
+                    r.add_etag()
+
+            if cache:
+                cache.set(cache_key, path_args, r)
+
+            if conditional and etag_matches(r.get_etag()[0]):
+                return not_modified(r.get_etag()[0])
+
+            return r
+
         elif ".".join([result.__module__, result.__class__.__name__]) == 'flask.wrappers.Response':
             # result is already a flask response
             return result
@@ -233,13 +660,4 @@ def call_f(api_name=None, f=None, error_callback=None, query_model=None, body_mo
             raise BadResponseException(f'Expected to return an instance of {str_result_models} but got {result} of type {type(result)}')
 
     else:
-        # TODO: implement support for returning html content
-        #     if type(result) is not tuple:
-        #         e = error_callback(PyMacaronCoreException("Method %s should return %s but returned %s" %
-        #                                                   (endpoint.handler_server, endpoint.produces, type(result))))
-        #         return _responsify(api_spec, e, 500)
-
-        #     # Return an html page
-        #     return result
-
-        assert 0, "Support for returning '{produces}' not implemented yet!"
+        return file_response(result, produces)
@@ -12,6 +12,7 @@ class PyMacaronException(BaseException):
     error_id = None
     user_message = None
     error_caught = None
+    headers = None
 
     def __str__(self):
         return f'{self.__class__.__name__}({self.status}|{self.code}|{self.user_message})'
@@ -23,6 +24,11 @@ class PyMacaronException(BaseException):
         self.error_caught = error
         return self
 
+    def with_headers(self, headers):
+        """Set HTTP headers to add to the error reply"""
+        self.headers = headers
+        return self
+
     def jsonify(self):
         """Return a Flask reply object describing this error"""
         data = {
@@ -42,6 +48,8 @@ class PyMacaronException(BaseException):
 
         r = jsonify(data)
         r.status_code = self.status
+        if self.headers:
+            r.headers.extend(self.headers)
 
         if str(self.status) != "200":
             log.warn("ERROR: caught error %s %s [%s]" % (self.status, self.code, str(self)))
@@ -110,6 +118,13 @@ add_error('InternalServerError', 'SERVER_ERROR', 500)
 add_error('AuthMissingHeaderError', 'AUTHORIZATION_HEADER_MISSING', 401)
 add_error('AuthTokenExpiredError', 'TOKEN_EXPIRED', 401)
 add_error('AuthInvalidTokenError', 'TOKEN_INVALID', 401)
+add_error('ServerNotReadyError', 'SERVER_NOT_READY', 503)
+add_error('CoalesceTimeoutError', 'COALESCE_TIMEOUT', 504)
+add_error('RequestTooLargeError', 'REQUEST_TOO_LARGE', 413)
+add_error('TooManyStreamsError', 'TOO_MANY_STREAMS', 503)
+add_error('ServerOverloadedError', 'SERVER_OVERLOADED', 503)
+add_error('RateLimitedError', 'RATE_LIMITED', 429)
+add_error('DeadlineExceededError', 'DEADLINE_EXCEEDED', 504)
 # add_error('ValidationError', 'INVALID_PARAMETER', 400)
 
 
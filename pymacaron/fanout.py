@@ -0,0 +1,202 @@
+import os
+import time
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app, has_app_context
+from pymacaron.log import pymlogger
+from pymacaron.aio import resolve_async
+from pymacaron.auth import add_auth
+from pymacaron.config import get_config
+from pymacaron.deadline import remaining_time, check_deadline, set_deadline
+from pymacaron.metrics import incr
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron.offload import get_request_copy
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = pymlogger(__name__)
+
+
+# Fan-out: a handler calling several other services runs the calls at once,
+# in a thread pool shared by all requests of the worker, and waits for the
+# slowest one instead of their sum. Calls run in a copy of the context of the
+# request that fans out (path, query string, headers, user and token), with
+# its deadline: they forward them (see pymacaron.auth.add_auth), and stop
+# being waited for at the deadline.
+#
+# Python threads can't be interrupted: a call still running at the deadline
+# keeps its thread of the pool until it returns, after its request is gone,
+# and delays the fan-outs of the next requests. Calls should give up once
+# remaining_time() is 0, as HttpCall does.
+
+THREAD_NAME_PREFIX = 'pym-fanout'
+
+executor = None
+executor_pid = None
+
+session = None
+session_pid = None
+
+# The flask app calls run in when fanned out outside of any app context
+default_app = None
+
+
+def get_executor():
+    global executor
+    global executor_pid
+    if executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(
+            max_workers=get_config().fanout_threads,
+            thread_name_prefix=THREAD_NAME_PREFIX,
+        )
+        executor_pid = os.getpid()
+    return executor
+
+
+def get_session():
+    """Return this worker's requests session, pooling connections to other
+    services"""
+    global session
+    global session_pid
+    if session_pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=get_config().fanout_threads)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session_pid = os.getpid()
+    return session
+
+
+class HttpCall():
+    """An http request to run in a fan-out, with the current user's token and
+    the request's deadline. Its result is the response's decoded json, or the
+    response itself if it is not json. Error statuses raise a
+    requests.HTTPError.
+
+    method: 'GET', 'POST'...
+
+    url: the url to call
+
+    timeout: seconds to wait for the response, capped by the request's
+    deadline
+
+    kwargs: any other argument of requests.request (params, json, headers...)
+    """
+
+    def __init__(self, method, url, timeout=30, **kwargs):
+        self.method = method
+        self.url = url
+        self.kwargs = dict(kwargs, timeout=timeout)
+
+    def __call__(self):
+        # add_auth adds headers to a copy of the call's own
+        kwargs = dict(self.kwargs, headers=dict(self.kwargs.get('headers') or {}))
+        r = add_auth(get_session().request)(self.method, self.url, **kwargs)
+        r.raise_for_status()
+        if 'json' in r.headers.get('Content-Type', ''):
+            return r.json()
+        return r
+
+    def __repr__(self):
+        return f'HttpCall({self.method} {self.url})'
+
+
+def get_call_name(call):
+    return getattr(call, '__name__', None) or type(call).__name__
+
+
+def run_call(call, app, request_copy, user, deadline):
+    """Run a call in a thread of the pool, in a copy of the context of the
+    request that fanned it out: that request may be torn down before the call
+    completes"""
+    global default_app
+    if not app:
+        if not default_app:
+            default_app = Flask(__name__)
+        app = default_app
+    with app.test_request_context(**(request_copy or {})):
+        if user:
+            stack.top.current_user = user
+        if deadline is not None:
+            set_deadline(deadline - time.monotonic())
+        return resolve_async(call())
+
+
+def get_outcome(future):
+    """Return the result of a completed call, or the exception it raised"""
+    try:
+        return future.result(timeout=0)
+    except Exception as e:
+        return e
+
+
+def fanout(calls, timeout=None):
+    """Run calls concurrently and return their results, in the same order, or
+    as a dict with the same keys if calls is a dict. A call that failed has
+    the exception it raised as result.
+
+    calls: functions taking no argument, HttpCall instances, or a dict of
+    them
+
+    timeout: max seconds to wait for all calls, if shorter than the time left
+    before the request's deadline. Calls still running then have a
+    DeadlineExceededError as result, and see remaining_time() return 0
+    """
+    check_deadline()
+
+    keys = None
+    if isinstance(calls, dict):
+        keys = list(calls.keys())
+        calls = list(calls.values())
+
+    incr('fanout.calls', len(calls))
+
+    if threading.current_thread().name.startswith(THREAD_NAME_PREFIX):
+        # A call fanning out in turn would wait for threads of the same
+        # pool, possibly all busy waiting too: run its calls one by one
+        outcomes = []
+        for call in calls:
+            try:
+                outcomes.append(resolve_async(call()))
+            except Exception as e:
+                outcomes.append(e)
+    else:
+        wait = remaining_time()
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+
+        app = current_app._get_current_object() if has_app_context() else None
+        request_copy = get_request_copy()
+        user = getattr(stack.top, 'current_user', None)
+        user = dict(user) if user else None
+        deadline = time.monotonic() + wait if wait is not None else None
+
+        executor = get_executor()
+        futures = [executor.submit(run_call, call, app, request_copy, user, deadline) for call in calls]
+        concurrent.futures.wait(futures, timeout=wait)
+
+        outcomes = []
+        for call, future in zip(calls, futures):
+            if future.done():
+                outcomes.append(get_outcome(future))
+            else:
+                # Python threads can't be interrupted: a call already started
+                # completes, but its result is dropped
+                future.cancel()
+                outcomes.append(DeadlineExceededError(f"{get_call_name(call)} did not complete before the deadline"))
+
+    for call, outcome in zip(calls, outcomes):
+        if isinstance(outcome, Exception):
+            log.warning(f"Fan-out call {get_call_name(call)} failed: {outcome}")
+            incr('fanout.failed', call=get_call_name(call))
+
+    if keys is not None:
+        return dict(zip(keys, outcomes))
+    return outcomes
@@ -1,5 +1,8 @@
 import sys
+import time
 from pymacaron.resources import get_gunicorn_worker_count
+from pymacaron.resources import get_gunicorn_max_requests
+from pymacaron.drain import get_graceful_timeout
 
 sys.path.append('.')
 
@@ -20,8 +23,16 @@ worker_connections = 1000
 timeout = 180
 keepalive = 2
 
-max_requests = 2500
-max_requests_jitter = 500
+# On SIGTERM, workers keep serving for PYM_DRAIN_DELAY seconds while /ping
+# fails, then wait up to PYM_DRAIN_TIMEOUT seconds for in-flight requests,
+# then get PYM_FLUSH_TIMEOUT seconds to flush (see pymacaron.drain)
+graceful_timeout = get_graceful_timeout()
+
+# Workers are recycled when their memory or latency degrades (see
+# pre_request/post_request below). Recycling after a number of requests is
+# only a fallback.
+max_requests = get_gunicorn_max_requests()
+max_requests_jitter = int(max_requests / 10)
 
 preload = True
 
@@ -32,12 +43,59 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 
 proc_name = None
 
+def on_starting(server):
+    # Create the rate-limit buckets shared by all workers
+    from pymacaron.ratelimit import init_shared_buckets
+    init_shared_buckets()
+
 def pre_fork(server, worker):
     pass
 
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
 
+def post_worker_init(worker):
+    # Fork the worker's pool for x-offload endpoints first, while the worker
+    # has loaded the app but not started any thread, if any endpoint uses it.
+    # If a pool process dies, the worker recycles itself rather than fork again
+    from pymacaron.offload import start_offload_pool, is_offload_enabled
+    if is_offload_enabled():
+        start_offload_pool(worker.wsgi, recycle=True)
+
+    # Open the worker's own resources (connection pools...). This runs after
+    # the app is loaded, hence after API.start() registered the hooks, even
+    # without preload
+    from pymacaron.lifecycle import start_worker
+    start_worker()
+
+    # Warm up the worker before it accepts traffic
+    from pymacaron.warmup import warmup_app
+    warmup_app(worker.wsgi)
+
+    # And drain it gracefully on SIGTERM
+    from pymacaron.drain import drain_on_sigterm
+    drain_on_sigterm(worker)
+
+def worker_exit(server, worker):
+    from pymacaron.drain import drain_on_exit
+    drain_on_exit(worker)
+
+    # Close the worker's resources once in-flight requests are done
+    from pymacaron.lifecycle import stop_worker
+    stop_worker()
+
+    from pymacaron.offload import stop_offload_pool
+    stop_offload_pool()
+
+def pre_request(worker, req):
+    req.pym_t0 = time.time()
+
+def post_request(worker, req, environ, resp):
+    # Streamed responses last as long as their client wants
+    from pymacaron.recycle import check_worker_health, STREAMED_ENVIRON
+    if not environ.get(STREAMED_ENVIRON):
+        check_worker_health(worker, time.time() - req.pym_t0)
+
 def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
@@ -0,0 +1,38 @@
+from pymacaron.gunicorn import *  # noqa: F401,F403
+
+
+# Configuration file for gunicorn, serving a pymacaron api in ASGI mode with
+# uvicorn workers (see pymacaron.asgi)
+#
+# Run with:
+#
+# gunicorn --bind 127.0.0.1:8080 --config python:pymacaron.gunicorn_asgi server:asgi
+#
+# where server.py defines 'asgi = AsgiApp(app)' next to its flask app.
+
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Sync endpoints run in the ASGI app's own thread pool (see asgi_threads in
+# pym-config)
+threads = 1
+
+# Uvicorn workers start, warm up and stop themselves in the ASGI lifespan,
+# handle SIGTERM on their own, and do not call pre_request/post_request:
+# workers are only recycled after max_requests
+
+def post_worker_init(worker):
+    # Fork the worker's pool for x-offload endpoints before the event loop
+    # starts any thread, if any endpoint uses it
+    from pymacaron.offload import start_offload_pool, is_offload_enabled
+    if is_offload_enabled():
+        start_offload_pool(worker.wsgi.app, recycle=True)
+
+def worker_exit(server, worker):
+    from pymacaron.offload import stop_offload_pool
+    stop_offload_pool()
+
+def pre_request(worker, req):
+    pass
+
+def post_request(worker, req, environ, resp):
+    pass
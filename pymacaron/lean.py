@@ -0,0 +1,120 @@
+from werkzeug.routing import Map, Rule
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import cached_property
+from flask import _request_ctx_stack
+from flask.ctx import RequestContext
+from pymacaron.log import pymlogger
+
+
+log = pymlogger(__name__)
+
+
+# Lean dispatch: the routes generated from swagger files are also compiled
+# into a werkzeug Map of their own, and requests to them are dispatched
+# straight to their endpoint, skipping what flask does for any route: url
+# matching against all routes, session handling and request signals.
+# Everything else (routes that are not generated, 404s and 405s) goes to the
+# flask app as usual. before_request and after_request hooks still run.
+
+EXTENSION = 'pymacaron.lean'
+
+
+class LeanRequestContext(RequestContext):
+    """A flask request context for a request already routed by the lean
+    dispatcher: no session, and no url adapter unless url_for() needs one"""
+
+    def __init__(self, app, environ, rule, view_args):
+        self.app = app
+        self.request = app.request_class(environ)
+        self.request.url_rule = rule
+        self.request.view_args = view_args
+        self.flashes = None
+        self.session = app.session_interface.make_null_session(app)
+        self._implicit_app_ctx_stack = []
+        self.preserved = False
+        self._preserved_exc = None
+        self._after_request_functions = []
+
+    @cached_property
+    def url_adapter(self):
+        return self.app.create_url_adapter(self.request)
+
+    def push(self):
+        app_ctx = self.app.app_context()
+        app_ctx.push()
+        self._implicit_app_ctx_stack.append(app_ctx)
+        _request_ctx_stack.push(self)
+
+
+class LeanDispatcher():
+    """A WSGI app dispatching the generated routes of a flask app, and
+    forwarding all other requests to the flask app's own wsgi_app"""
+
+    def __init__(self, app):
+        self.app = app
+        self.url_map = Map(converters=app.url_map.converters)
+        self.views = {}
+        self.flask_wsgi_app = None
+
+    def add_route(self, rule, method, view):
+        self.url_map.add(Rule(rule, endpoint=view.__name__, methods=[method]))
+        self.views[view.__name__] = view
+
+    def __call__(self, environ, start_response):
+        try:
+            rule, view_args = self.url_map.bind_to_environ(environ).match(return_rule=True)
+        except HTTPException:
+            return self.flask_wsgi_app(environ, start_response)
+        return self.dispatch(rule, view_args, environ)(environ, start_response)
+
+    def dispatch(self, rule, view_args, environ):
+        """Same as flask's wsgi_app and full_dispatch_request, minus url
+        matching, sessions and signals"""
+        app = self.app
+        ctx = LeanRequestContext(app, environ, rule, view_args)
+        error = None
+        try:
+            try:
+                ctx.push()
+                try:
+                    app.try_trigger_before_first_request_functions()
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = self.views[rule.endpoint](**view_args)
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                return app.process_response(app.make_response(rv))
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+        finally:
+            if app.should_ignore_error(error):
+                error = None
+            ctx.auto_pop(error)
+
+
+def get_dispatcher(app):
+    """Return the LeanDispatcher of a flask app"""
+    if EXTENSION not in app.extensions:
+        app.extensions[EXTENSION] = LeanDispatcher(app)
+    return app.extensions[EXTENSION]
+
+
+def lean_route(app, rule, method):
+    """Decorator adding a generated endpoint to the lean routes of app. Put
+    it below flask's route decorators, to register the undecorated view"""
+
+    def decorator(view):
+        get_dispatcher(app).add_route(rule, method, view)
+        return view
+
+    return decorator
+
+
+def enable_lean_dispatch(app):
+    """Serve the generated routes of app with its LeanDispatcher"""
+    dispatcher = get_dispatcher(app)
+    if app.wsgi_app is not dispatcher:
+        dispatcher.flask_wsgi_app = app.wsgi_app
+        app.wsgi_app = dispatcher
+        log.info(f"Dispatching {len(dispatcher.views)} generated routes without flask")
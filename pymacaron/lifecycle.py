@@ -0,0 +1,112 @@
+import os
+from pymacaron.log import pymlogger
+
+
+log = pymlogger(__name__)
+
+
+# Functions called in each worker process after it is forked and before it
+# accepts traffic, and when it exits. Start hooks are where database, Redis or
+# http connection pools should be opened: anything opened in the master
+# process would be shared across forked workers.
+
+worker_start_hooks = []
+worker_stop_hooks = []
+
+
+class WorkerResources():
+    """Per-worker registry of resources (connection pools, clients...), set by
+    worker start hooks and reachable from endpoint implementations:
+
+        from pymacaron.lifecycle import resources
+
+        def open_pools(resources):
+            resources.db = create_engine(...)
+
+        def do_get_item(item_id):
+            with resources.db.connect() as c:
+                ...
+    """
+
+    def __init__(self):
+        # Pid of the process in which the start hooks ran
+        object.__setattr__(self, '_pid', None)
+        object.__setattr__(self, '_resources', {})
+
+    def __setattr__(self, name, value):
+        self._resources[name] = value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._pid != os.getpid():
+            raise AttributeError(f"Worker resource '{name}' accessed outside of a started worker (see API(on_worker_start=...))")
+        if name not in self._resources:
+            raise AttributeError(f"No worker resource named '{name}' (did an on_worker_start hook set it?)")
+        return self._resources[name]
+
+    def __contains__(self, name):
+        return self._pid == os.getpid() and name in self._resources
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self else default
+
+    def is_started(self):
+        return self._pid == os.getpid()
+
+
+resources = WorkerResources()
+
+
+def get_resources():
+    return resources
+
+
+def add_worker_start_hook(hook):
+    """Register a function to call with the worker's resources in each new
+    worker process"""
+    assert callable(hook), "Worker start hook %s should be a function" % str(hook)
+    worker_start_hooks.append(hook)
+
+
+def add_worker_stop_hook(hook):
+    """Register a function to call with the worker's resources when a worker
+    process exits"""
+    assert callable(hook), "Worker stop hook %s should be a function" % str(hook)
+    worker_stop_hooks.append(hook)
+
+
+def start_worker():
+    """Run all worker start hooks in the current process. A failing start hook
+    is fatal: the worker would otherwise serve requests without its
+    resources"""
+    pid = os.getpid()
+    if resources._pid == pid:
+        return
+
+    # Drop whatever was inherited from a parent process without closing it:
+    # the parent still owns those sockets
+    object.__setattr__(resources, '_resources', {})
+    object.__setattr__(resources, '_pid', pid)
+
+    for h in worker_start_hooks:
+        log.info(f"Calling worker start hook {h} (pid: {pid})")
+        h(resources)
+
+
+def stop_worker():
+    """Run all worker stop hooks, in reverse order of registration, if the start
+    hooks ran in the current process"""
+    pid = os.getpid()
+    if resources._pid != pid:
+        return
+
+    for h in reversed(worker_stop_hooks):
+        log.info(f"Calling worker stop hook {h} (pid: {pid})")
+        try:
+            h(resources)
+        except Exception as e:
+            log.error(f"Worker stop hook {h} failed: {e}")
+
+    object.__setattr__(resources, '_resources', {})
+    object.__setattr__(resources, '_pid', None)
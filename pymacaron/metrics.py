@@ -0,0 +1,62 @@
+import threading
+from pymacaron.log import pymlogger
+from pymacaron.drain import add_drain_hook
+
+
+log = pymlogger(__name__)
+
+
+# Per-worker counters, keyed by metric name and tags, e.g.:
+#
+#   incr('cache.hit', endpoint='myservice.items.do_get_item')
+#
+# Reporters registered with add_metrics_reporter() get a snapshot of all
+# counters each time report_metrics() is called, and when the worker drains.
+
+counters = {}
+counters_lock = threading.Lock()
+
+metrics_reporters = []
+
+
+def incr(name, value=1, **tags):
+    key = (name, tuple(sorted(tags.items())))
+    with counters_lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def get_counter(name, **tags):
+    return counters.get((name, tuple(sorted(tags.items()))), 0)
+
+
+def get_counters():
+    """Return a list of (name, tags, value) for all counters"""
+    with counters_lock:
+        return [(name, dict(tags), value) for (name, tags), value in counters.items()]
+
+
+def reset_counters():
+    with counters_lock:
+        counters.clear()
+
+
+def add_metrics_reporter(reporter):
+    """Register a function that takes a list of (name, tags, value) and sends them
+    wherever is relevant"""
+    assert callable(reporter), "Metrics reporter %s should be a function" % str(reporter)
+    metrics_reporters.append(reporter)
+
+
+def report_metrics():
+    if not metrics_reporters:
+        return
+    snapshot = get_counters()
+    for r in metrics_reporters:
+        try:
+            r(snapshot)
+        except Exception as e:
+            log.error(f"Metrics reporter {r} failed: {e}")
+
+
+# Don't lose the last counts when a worker exits
+add_drain_hook(report_metrics)
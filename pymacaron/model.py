@@ -8,6 +8,15 @@ from pymacaron.utils import prune_none as do_prune_none
 log = pymlogger(__name__)
 
 
+def unpickle_model(api_name, model_name, state):
+    """Recreate a model instance pickled by PymacaronBaseModel.__reduce__"""
+    from pymacaron import apipool
+    cls = getattr(apipool.get_model(api_name), model_name)
+    o = cls.__new__(cls)
+    o.__setstate__(state)
+    return o
+
+
 class PymacaronBaseModel(object):
     """The base class from which all pymacaron model classes inherit. Some of these
     methods are redundant with pydantic, but kept for backward compatibility
@@ -33,6 +42,12 @@ class PymacaronBaseModel(object):
         return f'{self.get_model_name()}(self.dict())'
 
 
+    def __reduce__(self):
+        """Pickle model instances by api and model name, as the modules their
+        classes are generated in may not be importable (see pymacaron.offload)"""
+        return (unpickle_model, (self.get_model_api(), self.get_model_name(), self.__getstate__()))
+
+
     def __set_nullable(self, j, o):
         # Set x-nullable keys to None if they are missing
         for k in o.get_nullable_properties():
@@ -41,11 +56,12 @@ class PymacaronBaseModel(object):
         for k in list(j.keys()):
             v = j[k]
             if type(v) is dict:
-                self.__set_nullable(v, getattr(o, k))
+                if isinstance(getattr(o, k), PymacaronBaseModel):
+                    self.__set_nullable(v, getattr(o, k))
             elif type(v) is list:
                 for i in range(len(v)):
                     jj = v[i]
-                    if type(jj) is dict:
+                    if type(jj) is dict and isinstance(getattr(o, k)[i], PymacaronBaseModel):
                         self.__set_nullable(jj, getattr(o, k)[i])
 
 
@@ -0,0 +1,228 @@
+import os
+import signal
+import asyncio
+import inspect
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, has_request_context
+from pymacaron.log import pymlogger
+from pymacaron.metrics import incr
+from pymacaron.aio import resolve_async
+from pymacaron.resources import get_offload_process_count
+from pymacaron.concurrency import new_limit
+from pymacaron.deadline import remaining_time, set_deadline
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron.exceptions import UnhandledServerError
+from pymacaron.exceptions import ServerNotReadyError
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = pymlogger(__name__)
+
+
+# Endpoints declaring 'x-offload: process' run in a pool of processes forked
+# from the worker, so that CPU-bound handlers do not hold the worker's GIL.
+# Their arguments and result are pickled. In the pool, handlers get a copy of
+# the request's method, path, query string and headers (but not its body,
+# which they get as arguments), the authenticated user and the deadline.
+#
+# Each gunicorn worker starts its own pool in post_worker_init, once it has
+# loaded the app and before it has any thread (see pymacaron.gunicorn). At most as many requests as the pool has
+# processes wait for it, plus a short queue: further ones get a 503, instead
+# of holding the threads that other endpoints need.
+#
+# If a pool process dies, the pool is broken for good: forking a new one from
+# a worker already running threads is unsafe. Offloaded endpoints then fail
+# with a 503 while the worker drains and gunicorn replaces it.
+
+# Operation ids of the endpoints declaring x-offload, registered by the
+# generated endpoint code. Workers only fork a pool if there is any.
+offloaded_endpoints = set()
+
+pool = None
+pool_pid = None
+pool_limit = None
+pool_broken = False
+pool_broken_lock = threading.Lock()
+
+# Whether to recycle the worker when its pool breaks
+recycle_on_broken = False
+
+# The flask app handlers run in, in pool processes
+pool_app = None
+
+
+def add_offloaded_endpoint(operation_id):
+    offloaded_endpoints.add(operation_id)
+
+
+def is_offload_enabled():
+    """Return True if workers should fork an offload pool: some endpoint
+    declares x-offload, and PYM_OFFLOAD_PROCESS_COUNT is not 0"""
+    return len(offloaded_endpoints) > 0 and get_offload_process_count() > 0
+
+
+def start_offload_pool(app=None, processes=None, recycle=False):
+    """Fork this worker's pool of processes. Call it while the worker has no
+    thread, as forking a multithreaded process is unsafe. If recycle is True,
+    the worker recycles itself when its pool breaks"""
+    global pool
+    global pool_pid
+    global pool_limit
+    global pool_app
+    global pool_broken
+    global recycle_on_broken
+    if pool_pid == os.getpid():
+        return
+    if not processes:
+        processes = get_offload_process_count()
+    if isinstance(app, Flask):
+        pool_app = app
+    pool = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=init_offload_process,
+    )
+    # Fork all processes now
+    pool.submit(os.getpid).result()
+    pool_pid = os.getpid()
+    pool_limit = new_limit('offload', processes)
+    pool_broken = False
+    recycle_on_broken = recycle
+    log.info(f"Started {processes} offload processes for worker {pool_pid}")
+
+
+def init_offload_process():
+    # Forget the signal handlers of gunicorn's master and worker: the pool
+    # exits with its worker
+    for s in (signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2, signal.SIGTTIN, signal.SIGTTOU, signal.SIGWINCH, signal.SIGCHLD):
+        signal.signal(s, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def stop_offload_pool():
+    global pool
+    global pool_pid
+    global pool_broken
+    if pool and pool_pid == os.getpid():
+        pool.shutdown(wait=not pool_broken, cancel_futures=True)
+    pool = None
+    pool_pid = None
+    pool_broken = False
+
+
+def get_pool():
+    if pool_pid != os.getpid():
+        log.warning("Offload pool not started with the worker: starting it now")
+        start_offload_pool()
+    if pool_broken:
+        raise ServerNotReadyError("Offload pool is broken: waiting for the worker to be recycled")
+    return pool
+
+
+def recycle_worker():
+    """Drain and stop this worker as on SIGTERM (see pymacaron.drain), for
+    gunicorn to fork a new one"""
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def break_pool(executor):
+    """Mark the pool broken after one of its processes died"""
+    global pool_broken
+    with pool_broken_lock:
+        if executor is not pool or pool_broken:
+            return
+        pool_broken = True
+    executor.shutdown(wait=False)
+    if recycle_on_broken:
+        log.error(f"Offload pool of worker {os.getpid()} is broken: recycling the worker")
+        recycle_worker()
+    else:
+        log.error(f"Offload pool of worker {os.getpid()} is broken")
+
+
+def get_request_copy():
+    """Return what the pool needs to recreate the current request"""
+    if not has_request_context():
+        return None
+    return {
+        'path': request.path,
+        'method': request.method,
+        'query_string': request.query_string,
+        'headers': list(request.headers.items()),
+    }
+
+
+class DecoratedHandler():
+    """An offloaded handler wrapped by its x-decorate-server decorator. The
+    wrapper itself can't be pickled: this pickles as the handler and the
+    decorator, and decorates the handler again in the pool process"""
+
+    def __init__(self, f, decorator):
+        self.f = f
+        self.decorator = decorator
+        self.decorated = decorator(f)
+        functools.update_wrapper(self, f)
+
+    def __call__(self, *args, **kwargs):
+        return self.decorated(*args, **kwargs)
+
+    def __reduce__(self):
+        return (DecoratedHandler, (self.f, self.decorator))
+
+
+def run_offloaded(f, args, kwargs, request_copy, user, remaining):
+    """Call f in a pool process, in a copy of the request's context"""
+    global pool_app
+    if not pool_app:
+        pool_app = Flask(__name__)
+    with pool_app.test_request_context(**(request_copy or {})):
+        if user:
+            stack.top.current_user = user
+        if remaining is not None:
+            set_deadline(remaining)
+        result = f(*args, **kwargs)
+        if inspect.iscoroutine(result):
+            result = asyncio.run(result)
+        return result
+
+
+def run_in_process(f, args, kwargs):
+    """Call f in the worker's pool of processes and return its result, or in
+    the current thread if offloading is disabled"""
+    if get_offload_process_count() == 0:
+        return resolve_async(f(*args, **kwargs))
+    executor = get_pool()
+    limit = pool_limit
+    limit.acquire()
+    try:
+        incr('offload.calls', endpoint=f.__name__)
+        future = executor.submit(
+            run_offloaded,
+            f,
+            args,
+            kwargs,
+            get_request_copy(),
+            getattr(stack.top, 'current_user', None),
+            remaining_time(),
+        )
+        try:
+            return future.result(timeout=remaining_time())
+        except concurrent.futures.TimeoutError:
+            # The process completes the call, but the caller gave up
+            future.cancel()
+            raise DeadlineExceededError(f"{f.__name__} did not complete before the request's deadline")
+        except BrokenProcessPool as e:
+            incr('offload.crashed', endpoint=f.__name__)
+            break_pool(executor)
+            raise UnhandledServerError(f"Offload process died while running {f.__name__}").caught(e) from e
+    finally:
+        limit.release()
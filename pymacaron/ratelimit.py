@@ -0,0 +1,208 @@
+import math
+import mmap
+import time
+import struct
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from flask import request
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.metrics import incr
+from pymacaron.exceptions import RateLimitedError
+from pymacaron.exceptions import AuthMissingHeaderError
+from pymacaron.exceptions import AuthInvalidTokenError
+from pymacaron.exceptions import AuthTokenExpiredError
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = pymlogger(__name__)
+
+
+# Endpoints declaring 'x-rate-limit' allow each client (authenticated user, or
+# IP address) a number of calls per period, with a token bucket per client and
+# endpoint. Buckets live in a table of shared memory created in the gunicorn
+# master (see pymacaron.gunicorn.on_starting) and inherited by all its
+# workers, or in a per-process table otherwise.
+
+# The shared table, if any
+shared_buckets = None
+
+
+def refill(tokens, t, now, rate, capacity):
+    """Return the tokens in a bucket last updated at time t"""
+    return min(capacity, tokens + (now - t) * rate)
+
+
+class SharedBuckets():
+    """A fixed-size table of token buckets in an anonymous shared memory map,
+    indexed by a hash of their key. Collisions are resolved by probing a few
+    slots, then evicting the least recently updated one"""
+
+    # key hash, tokens, time of last update
+    SLOT = struct.Struct('=Qdd')
+    PROBES = 8
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.mm = mmap.mmap(-1, slots * self.SLOT.size)
+        self.lock = multiprocessing.Lock()
+
+    def find_slot(self, h, capacity, now):
+        """Return (offset, tokens, time of last update) of the bucket for hash h,
+        or of an empty or evicted slot for it"""
+        i0 = h % self.slots
+        victim = None
+        for p in range(self.PROBES):
+            offset = ((i0 + p) % self.slots) * self.SLOT.size
+            kh, tokens, t = self.SLOT.unpack_from(self.mm, offset)
+            if kh == h:
+                return offset, tokens, t
+            if kh == 0:
+                return offset, capacity, now
+            if victim is None or t < victim[1]:
+                victim = (offset, t)
+        return victim[0], capacity, now
+
+    def take(self, key, rate, capacity):
+        """Take a token from the bucket of key. Return (allowed, tokens left),
+        or None if the table is locked by a worker that probably died"""
+        h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        if not self.lock.acquire(timeout=0.1):
+            return None
+        try:
+            now = time.monotonic()
+            offset, tokens, t = self.find_slot(h, capacity, now)
+            tokens = refill(tokens, t, now, rate, capacity)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.SLOT.pack_into(self.mm, offset, h, tokens, now)
+        finally:
+            self.lock.release()
+        return allowed, tokens
+
+
+class LocalBuckets():
+    """Token buckets of this process only, in an LRU of max_size keys"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key -> (tokens, time of last update)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        with self.lock:
+            now = time.monotonic()
+            tokens, t = self.buckets.get(key, (capacity, now))
+            tokens = refill(tokens, t, now, rate, capacity)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        return allowed, tokens
+
+
+local_buckets = None
+
+
+def init_shared_buckets(slots=None):
+    """Create the table of buckets shared by all processes forked after this
+    call. Call it in the gunicorn master"""
+    global shared_buckets
+    if not slots:
+        slots = get_config().rate_limit_slots
+    shared_buckets = SharedBuckets(slots)
+    log.info(f"Created shared table of {slots} rate-limit buckets")
+
+
+def take_token(key, rate, capacity):
+    global shared_buckets
+    global local_buckets
+    if shared_buckets:
+        res = shared_buckets.take(key, rate, capacity)
+        if res is not None:
+            return res
+        # The lock is held by a worker that probably died: don't wait for it
+        # on every request
+        log.error("Rate-limit table is locked: using per-process buckets in this worker from now on")
+        incr('ratelimit.table_locked')
+        shared_buckets = None
+    if local_buckets is None:
+        local_buckets = LocalBuckets(get_config().rate_limit_slots)
+    return local_buckets.take(key, rate, capacity)
+
+
+def get_client_ip():
+    """Return the address of the client, as seen by the outermost of the
+    trusted proxies if any. Addresses further left in X-Forwarded-For are set
+    by the client, and can't be trusted"""
+    proxies = get_config().trusted_proxy_count
+    if proxies:
+        forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+        if forwarded:
+            return forwarded[-min(proxies, len(forwarded))]
+    return request.remote_addr
+
+
+def get_client_key(key):
+    """Return who is calling: the authenticated user if key is 'user' and the
+    request has a valid token, or else the client's IP address"""
+    if key == 'user':
+        user = getattr(stack.top, 'current_user', None)
+        if not user and (request.headers.get('Authorization') or request.cookies.get('token')):
+            from pymacaron.auth import authenticate_http_request
+            try:
+                user = authenticate_http_request()
+            except (AuthMissingHeaderError, AuthInvalidTokenError, AuthTokenExpiredError):
+                # Whether the endpoint requires auth is up to its own
+                # decorator, that runs later
+                user = None
+        if user and user.get('sub'):
+            return f"user:{user['sub']}"
+    return f'ip:{get_client_ip()}'
+
+
+class RateLimiter():
+    """Allow each client limit calls per period seconds to an endpoint, in
+    bursts of up to burst calls (defaults to limit).
+
+    key: 'user' to identify clients by the 'sub' of their token, or by IP
+    address if the request is not authenticated, or 'ip' to always use the IP
+    address
+    """
+
+    def __init__(self, operation_id, limit, period=60, burst=None, key='user'):
+        assert limit > 0 and period > 0, f"x-rate-limit of {operation_id} must have a positive limit and period"
+        assert key in ('user', 'ip'), f"x-rate-limit key of {operation_id} must be 'user' or 'ip'"
+        self.operation_id = operation_id
+        self.limit = limit
+        self.rate = limit / period
+        self.capacity = burst or limit
+        self.key = key
+
+    def check(self):
+        """Take a token for the current request's client, or raise a
+        RateLimitedError. Return the rate-limit headers to add to the
+        response"""
+        client = get_client_key(self.key)
+        allowed, tokens = take_token(f'{self.operation_id}|{client}', self.rate, self.capacity)
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(int(tokens)),
+            'X-RateLimit-Reset': str(math.ceil((self.capacity - tokens) / self.rate)),
+        }
+        if not allowed:
+            incr('ratelimit.rejected', endpoint=self.operation_id)
+            headers['Retry-After'] = str(math.ceil((1 - tokens) / self.rate))
+            raise RateLimitedError(f"Too many calls to {self.operation_id} by {client}").with_headers(headers)
+        return headers
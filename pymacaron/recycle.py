@@ -0,0 +1,187 @@
+import os
+import time
+import fcntl
+import threading
+from collections import deque
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.resources import load_memory_profile
+from pymacaron.drain import start_draining
+
+
+log = pymlogger(__name__)
+
+
+# Lock file shared by the gunicorn workers of one master, used to recycle at
+# most one of them at a time. Its path includes the master's pid, so that
+# several gunicorn servers on the same host don't block each other.
+RECYCLE_LOCK_PATH = '/tmp/pym-gunicorn-recycle-%s.lock'
+
+
+# Set on the environ of streamed responses (server-sent events, x-stream),
+# whose duration is up to their client: it is not the worker's latency
+STREAMED_ENVIRON = 'pymacaron.streamed'
+
+
+def get_lock_path():
+    return RECYCLE_LOCK_PATH % os.getppid()
+
+
+def get_rss_mb():
+    """Return the current resident memory of this process in Mb, or None if it
+    cannot be measured"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values"""
+    values = sorted(values)
+    i = int(round((len(values) - 1) * p / 100.0))
+    return values[i]
+
+
+class WorkerHealthMonitor():
+    """Record the latency of every request served by a gunicorn worker, and tell
+    when the worker should be recycled: either because its memory exceeds
+    max_rss_mb, or because its p99 latency drifted above latency_drift times
+    its baseline: the median p99 of its last baseline_windows windows.
+    """
+
+    def __init__(self, max_rss_mb=None, latency_drift=2.0, latency_floor_ms=100, window=500, check_every=50, min_interval=30, lock_path=None, baseline_windows=10):
+        self.max_rss_mb = max_rss_mb
+        self.latency_drift = latency_drift
+        self.latency_floor = latency_floor_ms / 1000.0
+        self.window = window
+        self.check_every = check_every
+        self.min_interval = min_interval
+        self.lock_path = lock_path or get_lock_path()
+
+        self.latencies = deque(maxlen=window)
+        self.baseline_p99 = None
+        self.past_p99s = deque(maxlen=baseline_windows)
+        self.last_window = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.lock_fd = None
+
+    @classmethod
+    def from_config(cls, config=None):
+        """Return a monitor configured after the recycle_* keys in pym-config"""
+        if not config:
+            config = get_config()
+
+        max_rss_mb = config.recycle_max_rss_mb
+        if not max_rss_mb:
+            # Default to 1.5 times the memory measured by pymprofile, if any
+            profile = load_memory_profile()
+            if profile and 'measured' in profile['gunicorn']:
+                max_rss_mb = int(profile['gunicorn']['measured']['warm']['rss_mb'] * 1.5)
+
+        if max_rss_mb:
+            log.info(f"Recycling workers above {max_rss_mb}Mb or with p99 latency drifting x{config.recycle_latency_drift}")
+        else:
+            log.info(f"Recycling workers with p99 latency drifting x{config.recycle_latency_drift}")
+
+        return cls(
+            max_rss_mb=max_rss_mb,
+            latency_drift=config.recycle_latency_drift,
+            latency_floor_ms=config.recycle_latency_floor_ms,
+            min_interval=config.recycle_min_interval,
+        )
+
+    def record(self, latency):
+        """Record the latency (in seconds) of a request. Return a string telling why
+        this worker should be recycled, or None if it is healthy"""
+        with self.lock:
+            self.latencies.append(latency)
+            self.count += 1
+            if self.count % self.check_every != 0:
+                return None
+            return self.check()
+
+    def check(self):
+        if self.max_rss_mb:
+            rss = get_rss_mb()
+            if rss and rss > self.max_rss_mb:
+                return f"rss {rss:.0f}Mb exceeds {self.max_rss_mb}Mb"
+
+        if len(self.latencies) < self.window:
+            return None
+
+        p99 = percentile(self.latencies, 99)
+        if self.baseline_p99 is not None and p99 > self.latency_floor and p99 > self.baseline_p99 * self.latency_drift:
+            return f"p99 latency {p99 * 1000:.0f}ms drifted above {self.latency_drift} x {self.baseline_p99 * 1000:.0f}ms"
+
+        # The baseline follows the worker's normal latency, as traffic changes,
+        # from the p99 of each full window of requests. Neither a fast burst
+        # nor the slow warm-up requests of the first window can skew it.
+        if self.count - self.last_window >= self.window:
+            self.last_window = self.count
+            self.past_p99s.append(p99)
+            self.baseline_p99 = percentile(self.past_p99s, 50)
+
+        return None
+
+    def acquire_recycle_slot(self):
+        """Return True if this worker may recycle now. Only one worker per container
+        gets to recycle at a time, and not less than min_interval seconds after
+        the previous one, to give its replacement time to warm up. The slot is
+        held until this worker exits.
+        """
+        if self.lock_fd is not None:
+            return True
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        last = os.read(fd, 32).decode('utf-8').strip()
+        now = time.time()
+        if last and now - float(last) < self.min_interval:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return False
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(now).encode('utf-8'))
+        self.lock_fd = fd
+        return True
+
+
+# One monitor per worker process, created after fork
+monitor = None
+
+
+def check_worker_health(worker, latency):
+    """Called by gunicorn after each request: record the request's latency and
+    stop the worker gracefully (gunicorn then spawns a new one) if it is
+    unhealthy and no other worker is being recycled"""
+    global monitor
+    if not monitor:
+        monitor = WorkerHealthMonitor.from_config()
+
+    reason = monitor.record(latency)
+    if not reason:
+        return
+
+    if not monitor.acquire_recycle_slot():
+        log.info(f"Worker {worker.pid} should recycle ({reason}) but another worker is recycling")
+        return
+
+    log.warning(f"Recycling worker {worker.pid}: {reason}")
+    start_draining('recycle')
+    worker.alive = False
@@ -1,8 +1,10 @@
 import os
+import yaml
 import multiprocessing
 from math import ceil
 from pymacaron.log import pymlogger
 from pymacaron.config import get_config
+from pymacaron.config import get_config_path
 
 
 log = pymlogger(__name__)
@@ -21,6 +23,27 @@ def get_gunicorn_worker_count(cpu_count=None):
     return multiprocessing.cpu_count() * 2 + 1
 
 
+def get_gunicorn_max_requests():
+    """Return after how many requests gunicorn should recycle a worker. Workers are
+    normally recycled by pymacaron.recycle when their memory or latency
+    degrades: this is only a fallback"""
+    if os.environ.get('PYM_GUNICORN_MAX_REQUESTS', None):
+        return int(os.environ['PYM_GUNICORN_MAX_REQUESTS'])
+    return 25000
+
+
+def get_offload_process_count(cpu_count=None):
+    """Return the number of processes each gunicorn worker forks to run
+    offloaded endpoints (see pymacaron.offload): the container's cpus shared
+    among workers, and at least one. Setting PYM_OFFLOAD_PROCESS_COUNT to 0
+    disables offloading: offloaded endpoints then run in the worker"""
+    if os.environ.get('PYM_OFFLOAD_PROCESS_COUNT', None):
+        return int(os.environ['PYM_OFFLOAD_PROCESS_COUNT'])
+    if not cpu_count:
+        cpu_count = multiprocessing.cpu_count()
+    return max(1, cpu_count // int(get_gunicorn_worker_count(cpu_count)))
+
+
 def get_celery_worker_count(cpu_count=None):
     """Return the number of celery workers to run on this container hardware"""
     conf = get_config()
@@ -36,18 +59,124 @@ def get_celery_worker_count(cpu_count=None):
     return c
 
 
-# Memory required, in Mb, by one gunicorn or celery worker:
+# Memory required, in Mb, by one gunicorn or celery worker, when no memory
+# profile has been measured for this service (see bin/pymprofile):
 GUNICORN_WORKER_MEM = 250
 CELERY_WORKER_MEM = 150
 
-def get_memory_limit(default_celery_worker_count=None, cpu_count=None):
-    """Return the memory in Megabytes required to run pymacaron on this container hardware"""
+# Name of the memory profile file written by pymprofile, next to pym-config.yaml
+MEMORY_PROFILE_NAME = 'pym-memory.yaml'
+
+
+def load_memory_profile(path=None):
+    """Find and load the memory profile written by pymprofile. Return it as a
+    dictionary, or None if this service has no memory profile"""
+    profile_path = get_config_path(MEMORY_PROFILE_NAME, path=path)
+    if not profile_path:
+        return None
+
+    with open(profile_path, 'r') as stream:
+        profile = yaml.load(stream, Loader=yaml.FullLoader)
+
+    if not profile or 'gunicorn' not in profile:
+        log.warning(f"Ignoring invalid memory profile at {profile_path}")
+        return None
+
+    log.info(f"Using memory profile at {profile_path}")
+    return profile
+
+
+def get_memory_limit(default_celery_worker_count=None, cpu_count=None, profile=None):
+    """Return the memory in Megabytes required to run pymacaron on this container
+    hardware. If a memory profile is available, use the measured memory of
+    the gunicorn master (whose preloaded pages are shared by all workers) plus
+    the measured private memory of each worker. Otherwise, fallback on fixed
+    estimates per worker.
+    """
     # Let's calculate how much memory this pymacaron config requires for 1 container
     celery_count = default_celery_worker_count
     if not celery_count:
         celery_count = get_celery_worker_count(cpu_count=cpu_count)
-    return ceil(get_gunicorn_worker_count(cpu_count=cpu_count) * GUNICORN_WORKER_MEM + celery_count * CELERY_WORKER_MEM)
+    gunicorn_count = int(get_gunicorn_worker_count(cpu_count=cpu_count))
+
+    if not profile:
+        profile = load_memory_profile()
+
+    if not profile:
+        return ceil(gunicorn_count * GUNICORN_WORKER_MEM + celery_count * CELERY_WORKER_MEM)
+
+    p = profile['gunicorn']
+    celery_mem = profile.get('celery', {}).get('worker_mb', CELERY_WORKER_MEM)
+    return ceil(p['shared_mb'] + gunicorn_count * p['worker_mb'] + celery_count * celery_mem)
 
 
 def get_celery_worker_memory_limit():
     return CELERY_WORKER_MEM * 1024
+
+
+#
+# Measure the memory used by gunicorn workers (used by pymprofile)
+#
+
+def measure_process_memory(pid):
+    """Return the rss, uss and pss memory (in Mb) of the process with this pid.
+    Requires psutil. pss is only available on linux (0 elsewhere)"""
+    import psutil
+    info = psutil.Process(pid).memory_full_info()
+    mb = 1024 * 1024
+    return {
+        'rss_mb': round(info.rss / mb, 1),
+        'uss_mb': round(info.uss / mb, 1),
+        'pss_mb': round(getattr(info, 'pss', 0) / mb, 1),
+    }
+
+
+def measure_gunicorn_memory(master_pid):
+    """Return the memory of a gunicorn master and the memory of each of its
+    workers, measured with measure_process_memory(). A worker's memory
+    includes that of the processes it forked (see pymacaron.offload)"""
+    import psutil
+    workers = {}
+    for p in psutil.Process(master_pid).children():
+        mem = measure_process_memory(p.pid)
+        for c in p.children(recursive=True):
+            for k, v in measure_process_memory(c.pid).items():
+                mem[k] = round(mem[k] + v, 1)
+        workers[p.pid] = mem
+    return measure_process_memory(master_pid), workers
+
+
+def compile_memory_profile(master, baseline, warm, headroom=0.25):
+    """Take the memory measured on a gunicorn master and on its workers right
+    after fork (baseline) and after warm-up (warm), and return the memory
+    profile to save in pym-memory.yaml"""
+
+    def worst(workers, key):
+        return max([w[key] for w in workers.values()]) if workers else 0
+
+    # Pages loaded by the master before fork (preload) are shared by all
+    # workers: they are counted once. Each worker then adds its private
+    # memory (uss), as measured after warm-up, plus some headroom for growth.
+    worker_uss = worst(warm, 'uss_mb')
+
+    return {
+        'gunicorn': {
+            'shared_mb': ceil(master['rss_mb']),
+            'worker_mb': ceil(worker_uss * (1 + headroom)),
+            'headroom': headroom,
+            'measured': {
+                'master': master,
+                'baseline': {
+                    'uss_mb': worst(baseline, 'uss_mb'),
+                    'pss_mb': worst(baseline, 'pss_mb'),
+                    'rss_mb': worst(baseline, 'rss_mb'),
+                },
+                'warm': {
+                    'uss_mb': worker_uss,
+                    'pss_mb': worst(warm, 'pss_mb'),
+                    'rss_mb': worst(warm, 'rss_mb'),
+                },
+                'worker_count': len(warm),
+            },
+        },
+    }
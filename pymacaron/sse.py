@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+from flask import Response, request, stream_with_context
+from flask import _app_ctx_stack, _request_ctx_stack
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+from pymacaron.utils import timenow
+from pymacaron.crash import postmortem
+from pymacaron.drain import inflight_request
+from pymacaron.drain import is_draining
+from pymacaron.recycle import STREAMED_ENVIRON
+from pymacaron.exceptions import TooManyStreamsError
+
+
+log = pymlogger(__name__)
+
+
+# Server-sent events: endpoints producing 'text/event-stream' return an
+# iterator of models, that a producer thread pulls and serializes into a
+# bounded queue, while the request's thread sends them to the client as SSE
+# frames, interleaved with heartbeats. A write failing on a closed connection
+# stops the producer at the iterator's next yield. An iterator blocked waiting
+# for events should check is_stream_closed() between waits: its stream keeps
+# its slot until the producer thread has exited.
+
+# Number of event streams open in this worker
+open_streams = 0
+open_streams_lock = threading.Lock()
+
+# Frames queued between the producer and the client
+QUEUE_SIZE = 16
+
+END = object()
+
+# The stop event of the stream that the current producer thread feeds
+producer = threading.local()
+
+
+def acquire_stream_slot():
+    """Return True if this worker may open another event stream, without
+    starving regular requests of worker threads"""
+    global open_streams
+    with open_streams_lock:
+        if open_streams >= get_config().sse_max_streams:
+            return False
+        open_streams += 1
+        return True
+
+
+def release_stream_slot():
+    global open_streams
+    with open_streams_lock:
+        open_streams -= 1
+
+
+def is_stream_closed():
+    """Return True if the client of the event stream produced by the current
+    thread is gone. Endpoints waiting for events should check it between waits
+    and return when it is True"""
+    stop = getattr(producer, 'stop', None)
+    return stop is not None and stop.is_set()
+
+
+def sse_response(f, result, serialize):
+    """Return a flask response streaming the models yielded by f as server-sent
+    events, serialized by the serialize function"""
+
+    if not acquire_stream_slot():
+        raise TooManyStreamsError(f"Worker {os.getpid()} already serves {get_config().sse_max_streams} event streams")
+
+    # The slot is released once the response is closed and the producer
+    # thread has exited
+    done = {'closed': False, 'produced': False}
+    done_lock = threading.Lock()
+
+    def release(what):
+        with done_lock:
+            if done[what]:
+                return
+            done[what] = True
+            if not all(done.values()):
+                return
+        release_stream_slot()
+
+    heartbeat = get_config().sse_heartbeat
+    items = iter(result)
+    frames = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+
+    # The endpoint runs in the producer thread, with the request's contexts
+    app_ctx = _app_ctx_stack.top
+    req_ctx = _request_ctx_stack.top
+
+    def put(frame):
+        """Queue a frame, unless the client is gone. Return False if it is"""
+        while not stop.is_set():
+            try:
+                frames.put(frame, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        producer.stop = stop
+        _app_ctx_stack.push(app_ctx)
+        _request_ctx_stack.push(req_ctx)
+        try:
+            for item in items:
+                if not put(f'data: {serialize(item)}\n\n'):
+                    break
+            put(END)
+        except (BaseException, Exception) as e:
+            put(e)
+        finally:
+            try:
+                if hasattr(items, 'close'):
+                    items.close()
+            finally:
+                _request_ctx_stack.pop()
+                _app_ctx_stack.pop()
+                producer.stop = None
+                release('produced')
+
+    thread = threading.Thread(target=produce, name='pym-sse', daemon=True)
+
+    def close():
+        stop.set()
+        if thread.ident is None:
+            # The producer never started
+            release('produced')
+        release('closed')
+
+    def generate():
+        t0 = timenow()
+        with inflight_request():
+            try:
+                # Send headers right away
+                yield ': connected\n\n'
+                thread.start()
+                while True:
+                    if is_draining():
+                        # Clients reconnect, hopefully to another worker
+                        log.info(f"Closing event stream of {f.__name__}: worker is draining")
+                        return
+                    try:
+                        frame = frames.get(timeout=heartbeat)
+                    except queue.Empty:
+                        yield ': heartbeat\n\n'
+                        continue
+                    if frame is END:
+                        return
+                    if isinstance(frame, BaseException):
+                        log.error(f"Method {f.__name__} raised exception while streaming events [{str(frame)}]")
+                        postmortem(f=f, t0=t0, t1=timenow(), exception=frame)
+                        return
+                    yield frame
+            except GeneratorExit:
+                log.info(f"Client disconnected from event stream of {f.__name__}")
+                raise
+            finally:
+                close()
+
+    # Don't count the stream's duration as the worker's latency
+    request.environ[STREAMED_ENVIRON] = True
+
+    r = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    r.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer events
+    r.headers['X-Accel-Buffering'] = 'no'
+    r.call_on_close(close)
+    return r
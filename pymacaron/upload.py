@@ -0,0 +1,50 @@
+from tempfile import SpooledTemporaryFile
+from flask import request
+from werkzeug.formparser import parse_form_data
+from werkzeug.exceptions import RequestEntityTooLarge
+from pymacaron.log import pymlogger
+from pymacaron.exceptions import RequestTooLargeError
+
+
+log = pymlogger(__name__)
+
+
+# Bytes of an uploaded file kept in memory before it is spooled to a
+# temporary file
+DEFAULT_SPOOL_SIZE = 512 * 1024
+
+
+def parse_upload(max_size=None, spool_size=DEFAULT_SPOOL_SIZE):
+    """Parse the current request's form data, spooling uploaded files to
+    temporary files above spool_size bytes. Raise a RequestTooLargeError as
+    soon as more than max_size bytes are announced in Content-Length, or have
+    been received. Return (form, files) multidicts.
+    """
+    if max_size and request.content_length and request.content_length > max_size:
+        raise RequestTooLargeError(f"Request body exceeds {max_size} bytes")
+
+    received = [0]
+
+    class LimitedSpooledFile(SpooledTemporaryFile):
+        """Count bytes written across all files of the request"""
+
+        def write(self, data):
+            received[0] += len(data)
+            if max_size and received[0] > max_size:
+                raise RequestTooLargeError(f"Request body exceeds {max_size} bytes")
+            return super().write(data)
+
+    def stream_factory(total_content_length, filename, content_type, content_length=None):
+        return LimitedSpooledFile(max_size=spool_size, mode='wb+')
+
+    try:
+        _, form, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_form_memory_size=max_size,
+            max_content_length=max_size,
+        )
+    except RequestEntityTooLarge:
+        raise RequestTooLargeError(f"Request body exceeds {max_size} bytes")
+
+    return form, files
@@ -0,0 +1,87 @@
+import time
+from flask import Response
+from werkzeug.test import Client
+from pymacaron.log import pymlogger
+from pymacaron.config import get_config
+
+
+log = pymlogger(__name__)
+
+
+# Header set on warm-up requests, for endpoints to tell them from real ones
+# (to skip side effects, metrics...)
+WARMUP_HEADER = 'X-Pym-Warmup'
+
+
+# Requests to replay in-process before a worker accepts traffic, declared by
+# the generated endpoint code, either from 'x-warmup' examples in swagger
+# files, or synthetic ones for GET endpoints without parameters
+warmup_requests = []
+
+# Whether to warm up, and whether to replay synthetic requests and not only
+# x-warmup examples
+with_warmup = True
+with_synthetic = False
+
+
+def add_warmup_request(method, path, query=None, body=None, headers=None, auth=False, synthetic=False):
+    """Declare a request to replay during warm-up. Declaring the same request
+    again, as when the generated endpoint code is loaded again, is a no-op"""
+    r = {
+        'method': method,
+        'path': path,
+        'query': query,
+        'body': body,
+        'headers': headers,
+        'auth': auth,
+        'synthetic': synthetic,
+    }
+    if r not in warmup_requests:
+        warmup_requests.append(r)
+
+
+def set_warmup(enabled=True, synthetic=False):
+    global with_warmup
+    global with_synthetic
+    with_warmup = enabled
+    with_synthetic = synthetic
+
+
+def warmup_app(app):
+    """Replay all warm-up requests through the wsgi app, so that lazy imports,
+    pydantic validators, Flask's url map and json encoders are all
+    initialized before the first real request. Never fail: errors are only
+    logged.
+    """
+    if not with_warmup:
+        return
+
+    requests = [r for r in warmup_requests if with_synthetic or not r['synthetic']]
+    if not requests:
+        return
+
+    log.info(f"Warming up with {len(requests)} requests")
+    t0 = time.time()
+
+    client = Client(app, Response)
+    for r in requests:
+        headers = dict(r['headers'] or {})
+        headers[WARMUP_HEADER] = '1'
+        if r['auth']:
+            from pymacaron.auth import generate_token
+            token = generate_token(get_config().default_user_id)
+            headers['Authorization'] = f'Bearer {token}'
+
+        try:
+            resp = client.open(
+                r['path'],
+                method=r['method'],
+                query_string=r['query'],
+                json=r['body'],
+                headers=headers,
+            )
+            log.info(f"Warm-up {r['method']} {r['path']} returned {resp.status_code}")
+        except Exception as e:
+            log.warning(f"Warm-up {r['method']} {r['path']} failed: {e}")
+
+    log.info(f"Warm-up done in {int((time.time() - t0) * 1000)} ms")
@@ -52,7 +52,6 @@ setup(
         'python-dateutil',
         'flask>=1.0.4',
         'flask-cors',
-        'flask-compress',
         'Werkzeug==0.16.0',
         'click',
         'pytz',
@@ -61,6 +60,8 @@ setup(
         'pydantic>=1.8.2',
         'ujson>=5.1.0',
         'MarkupSafe==1.1.1',
+        # Used by pymprofile to measure the memory of gunicorn workers
+        'psutil',
     ],
     tests_require=[
         'psutil',
@@ -70,7 +71,6 @@ setup(
         'pymacaron-unit>=1.0.10',
         'flask>=1.0.4',
         'flask-cors',
-        'flask-compress',
         'click',
         'pytz',
         'PyJWT',
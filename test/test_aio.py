@@ -0,0 +1,60 @@
+import time
+import asyncio
+import unittest
+import threading
+from flask import Flask, request
+from pymacaron.aio import run_coroutine, resolve_async
+from pymacaron.deadline import start_deadline
+from pymacaron.exceptions import DeadlineExceededError
+
+
+async def get_path(delay=0.1):
+    async def fetch(i):
+        await asyncio.sleep(delay)
+        return f'{request.path}:{i}'
+    return await asyncio.gather(fetch(1), fetch(2))
+
+
+async def count(n):
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield i
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_run_in_request_context(self):
+        with self.app.test_request_context('/foo'):
+            t0 = time.time()
+            self.assertEqual(run_coroutine(get_path()), ['/foo:1', '/foo:2'])
+            self.assertTrue(time.time() - t0 < 0.19)
+            self.assertEqual(request.path, '/foo')
+
+    def test_concurrent_requests(self):
+        results = {}
+
+        def call(i):
+            with self.app.test_request_context(f'/{i}'):
+                results[i] = run_coroutine(get_path())
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        for i in range(5):
+            self.assertEqual(results[i], [f'/{i}:1', f'/{i}:2'])
+
+    def test_async_generator(self):
+        with self.app.test_request_context('/'):
+            self.assertEqual(list(resolve_async(count(3))), [0, 1, 2])
+
+    def test_sync_results_unchanged(self):
+        self.assertEqual(resolve_async([1, 2]), [1, 2])
+
+    def test_deadline_cancels_coroutine(self):
+        with self.app.test_request_context('/'):
+            start_deadline(0.1)
+            with self.assertRaises(DeadlineExceededError):
+                run_coroutine(get_path(delay=5))
@@ -0,0 +1,38 @@
+import os
+import gzip
+import json
+import unittest
+from flask import Flask
+from pymacaron.apidoc import render_doc
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.path = os.path.join(os.path.dirname(__file__), '../pymacaron/ping.yaml')
+
+    def test_render_yaml_and_json(self):
+        docs = render_doc(self.path, toc='TABLE OF CONTENT')
+        with self.app.test_request_context('/doc/ping.yaml'):
+            r = docs['yaml'].response()
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue(b'TABLE OF CONTENT' in r.get_data())
+            self.assertEqual(r.headers['Cache-Control'], 'public, max-age=300')
+            self.assertIsNone(r.headers.get('Content-Encoding'))
+
+        with self.app.test_request_context('/doc/ping.json', headers={'Accept-Encoding': 'gzip'}):
+            r = docs['json'].response()
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            d = json.loads(gzip.decompress(r.get_data()))
+            self.assertTrue('paths' in d)
+            self.assertTrue(r.headers['ETag'].endswith(':gzip"'))
+
+    def test_not_modified(self):
+        docs = render_doc(self.path)
+        with self.app.test_request_context('/doc/ping.yaml'):
+            etag = docs['yaml'].response().headers['ETag']
+        with self.app.test_request_context('/doc/ping.yaml', headers={'If-None-Match': etag}):
+            r = docs['yaml'].response()
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.get_data(), b'')
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pymacaron.apiloader import generate_endpoints_v2
+
+
+def get_swagger(method='get', **extensions):
+    endpoint = {
+        'x-bind-server': 'myserver.do_it',
+        'produces': ['application/json'],
+        'responses': {
+            '200': {
+                'description': 'Item',
+                'schema': {'$ref': '#/definitions/Item'},
+            },
+        },
+    }
+    endpoint.update(extensions)
+    return {
+        'paths': {'/v1/items': {method: endpoint}},
+        'definitions': {'Item': {'type': 'object', 'properties': {'item_id': {'type': 'string'}}}},
+    }
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def generate(self, swagger):
+        app_file = os.path.join(self.tmpdir, 'test_app.py')
+        generate_endpoints_v2(swagger, app_file, os.path.join(self.tmpdir, 'test_models.py'), 'test')
+        with open(app_file) as f:
+            code = f.read()
+        compile(code, app_file, 'exec')
+        return code
+
+    def test_cache_varies_on_user_if_decorated(self):
+        code = self.generate(get_swagger(**{'x-cache': {'ttl': 60}}))
+        self.assertIn("vary=['path', 'query'], max_size=1000, auth=False", code)
+        code = self.generate(get_swagger(**{'x-cache': {'ttl': 60}, 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn("vary=['path', 'query', 'user'], max_size=1000, auth=True", code)
+        code = self.generate(get_swagger(**{'x-cache': {'ttl': 60, 'vary': ['path']}, 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn("vary=['path'], max_size=1000, auth=True", code)
+
+    def test_coalesce_authenticates_if_decorated(self):
+        code = self.generate(get_swagger(**{'x-coalesce': True}))
+        self.assertIn("vary=['path', 'query'], timeout=10, auth=False", code)
+        code = self.generate(get_swagger(**{'x-coalesce': {'vary': ['path', 'query']}, 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn("vary=['path', 'query'], timeout=10, auth=True", code)
+        code = self.generate(get_swagger(**{'x-coalesce': {'vary': ['path', 'query'], 'auth': False}, 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn("vary=['path', 'query'], timeout=10, auth=False", code)
+
+    def test_etag_hook_is_authenticated_if_decorated(self):
+        code = self.generate(get_swagger(**{'x-etag': 'myserver.get_version'}))
+        self.assertIn('etag=etag_myserver_get_version,', code)
+        self.assertNotIn('requires_auth(', code)
+        code = self.generate(get_swagger(**{'x-etag': 'myserver.get_version', 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn('etag_myserver_get_version_auth = requires_auth(etag_myserver_get_version)', code)
+        self.assertIn('etag=etag_myserver_get_version_auth,', code)
+
+    def test_offloaded_decorated_handler(self):
+        code = self.generate(get_swagger(**{'x-offload': 'process', 'x-decorate-server': 'myserver.auth'}))
+        self.assertIn('f_myserver_do_it_via_auth = DecoratedHandler(f_myserver_do_it_via_auth, auth)', code)
+        code = self.generate(get_swagger(**{'x-decorate-server': 'myserver.auth'}))
+        self.assertIn('f_myserver_do_it_via_auth = auth(f_myserver_do_it_via_auth)', code)
+        self.assertNotIn('add_offloaded_endpoint("', code)
+        code = self.generate(get_swagger(**{'x-offload': 'process'}))
+        self.assertIn('add_offloaded_endpoint("myserver.do_it")', code)
+
+    def test_coalesce_only_on_get(self):
+        self.assertIn('RequestCoalescer("myserver.do_it"', self.generate(get_swagger(**{'x-coalesce': True})))
+        for method in ('post', 'put', 'patch', 'delete'):
+            with self.assertRaises(AssertionError):
+                self.generate(get_swagger(method, **{'x-coalesce': True}))
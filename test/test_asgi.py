@@ -0,0 +1,284 @@
+import json
+import time
+import asyncio
+import threading
+import unittest
+from typing import Optional
+from flask import Flask, Response, request
+from werkzeug.datastructures import Headers
+from pydantic import BaseModel
+from pymacaron.model import PymacaronBaseModel
+from pymacaron.config import get_config
+from pymacaron.endpoint import pymacaron_flask_endpoint
+from pymacaron.concurrency import get_endpoint_limit
+from pymacaron.auth import requires_auth
+from pymacaron.asgi import AsgiApp
+from pymacaron import drain
+
+
+class Item(PymacaronBaseModel, BaseModel):
+    def get_property_names(self):
+        return ['name']
+
+    def get_model_api(self):
+        return 'test'
+
+    def get_nullable_properties(self):
+        return []
+
+    name: Optional[str] = None
+
+
+class CountQuery(BaseModel):
+    count: Optional[int] = None
+
+
+def do_get_item(name):
+    return Item(name=name)
+
+
+async def do_get_async(name):
+    await asyncio.sleep(0.2)
+    return Item(name=f'{request.path}:{name}')
+
+
+async def do_get_slow(name):
+    await asyncio.sleep(5)
+    return Item(name=name)
+
+
+def do_get_count(name, count=None):
+    return Item(name=f'{name}:{count}')
+
+
+@requires_auth
+def do_get_private(name):
+    return Item(name=name)
+
+
+def do_get_stream(name):
+    for i in range(3):
+        yield Item(name=f'{name}{i}')
+
+
+def do_get_busy(name):
+    time.sleep(0.3)
+    return Item(name=name)
+
+
+etag_threads = []
+
+
+def get_item_version(name):
+    # A version lookup blocking its thread, like a database query
+    etag_threads.append(threading.current_thread())
+    time.sleep(0.05)
+    return 'v1'
+
+
+def create_app():
+    app = Flask(__name__)
+
+    def add_route(f, query_model=None, **kwargs):
+        def endpoint(name):
+            return pymacaron_flask_endpoint(
+                api_name='test',
+                f=f,
+                path_args={'name': name},
+                query_model=query_model,
+                result_models=[Item],
+                **kwargs,
+            )
+        app.add_url_rule(f'/{f.__name__}/<name>', f.__name__, endpoint)
+
+    add_route(do_get_item)
+    add_route(do_get_async)
+    add_route(do_get_slow, timeout=0.2)
+    add_route(do_get_count, query_model=CountQuery)
+    add_route(do_get_private)
+    add_route(do_get_stream, stream='ndjson')
+    app.add_url_rule('/versioned/<name>', 'versioned', lambda name: pymacaron_flask_endpoint(
+        api_name='test',
+        f=do_get_item,
+        path_args={'name': name},
+        result_models=[Item],
+        etag=get_item_version,
+    ))
+    add_route(do_get_busy, concurrency=get_endpoint_limit('do_get_busy', {'limit': 1, 'queue': 0}))
+
+    @app.route('/buffer')
+    def buffer():
+        # Bodies of buffers that aren't bytes
+        return Response([memoryview(b'abc'), bytearray(b'def')], mimetype='application/octet-stream')
+
+    return app
+
+
+def asgi_call(asgi, path, query=b'', headers=[]):
+    """Call an ASGI app as an ASGI server would. Return the response's
+    status, headers and body"""
+    sent = []
+
+    async def receive():
+        if not sent:
+            sent.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client never disconnects
+        await asyncio.Event().wait()
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def call():
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'query_string': query,
+            'root_path': '',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers],
+            'client': ('127.0.0.1', 1234),
+            'server': ('localhost', 80),
+        }
+        await asgi(scope, receive, send)
+        start = messages[0]
+        assert start['type'] == 'http.response.start'
+        assert messages[-1].get('more_body', False) is False
+        assert all(type(m['body']) is bytes for m in messages[1:])
+        body = b''.join(m['body'] for m in messages[1:])
+        return start['status'], Headers([(k.decode(), v.decode()) for k, v in start['headers']]), body
+
+    return call()
+
+
+class AcceptanceTests():
+    """Scenarios run against the flask app, and against it in ASGI mode"""
+
+    def setUp(self):
+        self.app = create_app()
+        conf = get_config()
+        if not hasattr(conf, 'name'):
+            # Error reports need the api's name
+            conf.name = 'test'
+            self.addCleanup(delattr, conf, 'name')
+
+    def assertItem(self, path, name, query=''):
+        status, headers, body = self.get(path, query=query)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(body), {'name': name})
+
+    def assertError(self, path, status, error, query='', headers={}):
+        s, h, body = self.get(path, query=query, headers=headers)
+        self.assertEqual(s, status)
+        self.assertEqual(json.loads(body)['error'], error)
+
+    def test_sync_handler(self):
+        self.assertItem('/do_get_item/foo', 'foo')
+
+    def test_async_handler(self):
+        self.assertItem('/do_get_async/foo', '/do_get_async/foo:foo')
+
+    def test_query_validation(self):
+        self.assertItem('/do_get_count/foo', 'foo:3', query='count=3')
+        self.assertError('/do_get_count/foo', 400, 'INVALID_PARAMETER', query='count=abc')
+
+    def test_auth(self):
+        self.assertError('/do_get_private/foo', 401, 'AUTHORIZATION_HEADER_MISSING')
+
+    def test_deadline(self):
+        t0 = time.time()
+        self.assertError('/do_get_slow/foo', 504, 'DEADLINE_EXCEEDED')
+        self.assertTrue(time.time() - t0 < 1)
+
+    def test_stream(self):
+        status, headers, body = self.get('/do_get_stream/x')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'{"name":"x0"}\n{"name":"x1"}\n{"name":"x2"}\n')
+
+    def test_buffers(self):
+        status, headers, body = self.get('/buffer')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'abcdef')
+
+    def test_etag_hook(self):
+        status, headers, body = self.get('/versioned/foo')
+        self.assertEqual(status, 200)
+        etag = headers['ETag']
+        status, headers, body = self.get('/versioned/foo', headers={'If-None-Match': etag})
+        self.assertEqual(status, 304)
+
+    def test_not_found(self):
+        status, headers, body = self.get('/nowhere')
+        self.assertEqual(status, 404)
+
+
+class WsgiTests(AcceptanceTests, unittest.TestCase):
+
+    def get(self, path, query='', headers={}):
+        r = self.app.test_client().get(path, query_string=query, headers=headers)
+        return r.status_code, r.headers, r.get_data()
+
+
+class AsgiTests(AcceptanceTests, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asgi = AsgiApp(self.app)
+
+    def get(self, path, query='', headers={}):
+        return asyncio.run(asgi_call(self.asgi, path, query.encode(), list(headers.items())))
+
+    def test_concurrent_async_requests(self):
+        async def call_many(n):
+            return await asyncio.gather(*[
+                asgi_call(self.asgi, f'/do_get_async/{i}') for i in range(n)
+            ])
+
+        t0 = time.time()
+        results = asyncio.run(call_many(500))
+        # All requests wait on the same loop, without a thread each
+        self.assertTrue(time.time() - t0 < 2)
+        for i, (status, headers, body) in enumerate(results):
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), {'name': f'/do_get_async/{i}:{i}'})
+
+    def test_etag_hook_off_loop(self):
+        etag_threads.clear()
+        self.get('/versioned/foo')
+        self.assertEqual(len(etag_threads), 1)
+        self.assertIsNot(etag_threads[0], threading.main_thread())
+
+    def test_concurrency_limit_rejects_at_once(self):
+        async def call_two():
+            return await asyncio.gather(
+                asgi_call(self.asgi, '/do_get_busy/a'),
+                asgi_call(self.asgi, '/do_get_busy/b'),
+            )
+
+        statuses = sorted(status for status, headers, body in asyncio.run(call_two()))
+        self.assertEqual(statuses, [200, 503])
+
+    def test_lifespan(self):
+        self.addCleanup(setattr, drain, 'draining', False)
+        conf = get_config()
+        self.assertTrue(conf.asgi_threads > 0)
+
+        async def run():
+            messages = asyncio.Queue()
+            for t in ('lifespan.startup', 'lifespan.shutdown'):
+                messages.put_nowait({'type': t})
+            sent = []
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await self.asgi({'type': 'lifespan'}, messages.get, send)
+            return sent
+
+        self.assertEqual(asyncio.run(run()), ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(drain.is_draining())
@@ -0,0 +1,117 @@
+import time
+import threading
+import unittest
+from unittest.mock import patch
+from flask import Flask, request
+from pymacaron.auth import get_userid
+from pymacaron.config import get_config
+from pymacaron.drain import drain_hooks, flush
+from pymacaron.metrics import get_counter
+from pymacaron.background import background, init_background, wait_for_tasks
+
+
+calls = []
+release = threading.Event()
+
+
+@background
+def record(name):
+    calls.append((name, request.path, request.headers.get('X-Test'), get_userid(), threading.current_thread().name))
+
+
+@background
+def blocked(name):
+    release.wait(2)
+    calls.append(name)
+
+
+@background
+def crash():
+    raise Exception('Boom')
+
+
+@background
+async def record_async(name):
+    calls.append(name)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        calls.clear()
+        release.clear()
+        conf = get_config()
+        if not hasattr(conf, 'name'):
+            conf.name = 'test'
+            self.addCleanup(delattr, conf, 'name')
+        self.app = Flask(__name__)
+        init_background(self.app)
+        self.addCleanup(drain_hooks.remove, wait_for_tasks)
+
+        @self.app.route('/v1/signup')
+        def signup():
+            from flask import _app_ctx_stack
+            _app_ctx_stack.top.current_user = {'sub': 'user123', 'token': 'abc'}
+            blocked('blocked')
+            record('signup')
+            self.assertEqual(calls, [])
+            return 'ok'
+
+    def test_after_request(self):
+        r = self.app.test_client().get('/v1/signup', headers={'X-Test': 'yes'})
+        self.assertEqual(r.get_data(), b'ok')
+        release.set()
+        self.assertTrue(wait_for_tasks(2))
+        self.assertEqual(len(calls), 2)
+        self.assertIn('blocked', calls)
+        name, path, header, userid, thread = [c for c in calls if c != 'blocked'][0]
+        self.assertEqual((name, path, header, userid), ('signup', '/v1/signup', 'yes', 'user123'))
+        self.assertTrue(thread.startswith('pym-background'))
+
+    def test_outside_request(self):
+        record('script')
+        record_async('async')
+        self.assertTrue(wait_for_tasks(2))
+        self.assertEqual(sorted(c if type(c) is str else c[0] for c in calls), ['async', 'script'])
+
+    def test_failure_is_reported(self):
+        with patch('pymacaron.background.postmortem') as postmortem:
+            crash()
+            self.assertTrue(wait_for_tasks(2))
+            self.assertEqual(postmortem.call_count, 1)
+            self.assertEqual(str(postmortem.call_args[1]['exception']), 'Boom')
+        self.assertTrue(get_counter('background.failed', task='crash') >= 1)
+
+    def test_drop_when_full(self):
+        conf = get_config()
+        max_pending = conf.background_max_pending
+        conf.background_max_pending = 1
+        try:
+            blocked('first')
+            blocked('second')
+            self.assertFalse(wait_for_tasks(0.1))
+            release.set()
+            self.assertTrue(wait_for_tasks(2))
+        finally:
+            conf.background_max_pending = max_pending
+        self.assertEqual(calls, ['first'])
+
+    def test_drain_hook(self):
+        self.assertIn(wait_for_tasks, drain_hooks)
+        init_background(self.app)
+        self.assertEqual(drain_hooks.count(wait_for_tasks), 1)
+        blocked('draining')
+        threading.Timer(0.2, release.set).start()
+        t0 = time.time()
+        self.assertTrue(wait_for_tasks())
+        self.assertTrue(time.time() - t0 < 2)
+        self.assertEqual(calls, ['draining'])
+
+    def test_drain_within_flush_timeout(self):
+        blocked('stuck')
+        t0 = time.time()
+        with patch.dict('os.environ', {'PYM_FLUSH_TIMEOUT': '0.2'}):
+            flush()
+        self.assertTrue(time.time() - t0 < 1)
+        release.set()
+        self.assertTrue(wait_for_tasks(2))
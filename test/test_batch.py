@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from flask import Flask, Response, request, jsonify
+import pymacaron
+from pymacaron import apipool
+from pymacaron.auth import generate_token
+from pymacaron.auth import load_auth_token
+from pymacaron.auth import VERIFIED_TOKEN_ENVIRON
+from pymacaron.auth import get_userid
+from pymacaron.config import get_config
+from pymacaron.endpoint import pymacaron_flask_endpoint
+from pymacaron import concurrency
+from pymacaron import sse
+from pymacaron.exceptions import AuthInvalidTokenError
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_reuse_verified_token(self):
+        payload = {'sub': 'u1', 'token': 'abc', 'iss': 'test'}
+        environ = {VERIFIED_TOKEN_ENVIRON: payload}
+        with self.app.test_request_context('/v1/me', environ_base=environ):
+            p = load_auth_token('abc')
+            self.assertEqual(p['sub'], 'u1')
+            self.assertEqual(get_userid(), 'u1')
+
+            # Changes to the sub-request's payload don't leak to others
+            p['token'] = 'other'
+            self.assertEqual(payload['token'], 'abc')
+
+    def test_other_tokens_are_verified(self):
+        conf = get_config()
+        saved = (conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'test'
+        self.addCleanup(lambda: setattr(conf, 'jwt_secret', saved[0]) or setattr(conf, 'jwt_issuer', saved[1]) or setattr(conf, 'jwt_audience', saved[2]))
+        environ = {VERIFIED_TOKEN_ENVIRON: {'sub': 'u1', 'token': 'abc'}}
+        with self.app.test_request_context('/v1/me', environ_base=environ):
+            with self.assertRaises(AuthInvalidTokenError):
+                load_auth_token('not.a.token')
+
+
+class BatchTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.app_pkg = apipool.load_swagger('batch', os.path.join(os.path.dirname(pymacaron.__file__), 'batch.yaml'), dest_dir=cls.tmpdir, create_endpoints=True, force=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        conf = get_config()
+        if not hasattr(conf, 'name'):
+            conf.name = 'test'
+            self.addCleanup(delattr, conf, 'name')
+        saved = (conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'test'
+        self.addCleanup(lambda: setattr(conf, 'jwt_secret', saved[0]) or setattr(conf, 'jwt_issuer', saved[1]) or setattr(conf, 'jwt_audience', saved[2]))
+
+        self.app = Flask(__name__)
+        self.app_pkg.load_endpoints(app=self.app, error_callback=None)
+        self.threads = []
+
+        @self.app.route('/v1/echo/<name>', methods=['GET', 'POST'])
+        def echo(name):
+            self.threads.append(threading.current_thread().name)
+            if name == 'slow':
+                time.sleep(0.3)
+            return jsonify({
+                'name': name,
+                'method': request.method,
+                'query': request.args.get('q'),
+                'body': request.get_json(silent=True),
+                'authorization': request.headers.get('Authorization'),
+                'user_agent': request.headers.get('User-Agent'),
+                'extra': request.headers.get('X-Extra'),
+            })
+
+        def do_get_limited(name):
+            return apipool.batch.SubResponse(status=200, body={'name': name})
+
+        @self.app.route('/v1/limited/<name>')
+        def limited(name):
+            return pymacaron_flask_endpoint(
+                api_name='test',
+                f=do_get_limited,
+                path_args={'name': name},
+                result_models=[apipool.batch.SubResponse],
+            )
+
+        @self.app.route('/v1/events')
+        def events():
+            return sse.sse_response(events, iter([{'n': 1}]), json.dumps)
+
+        self.closed = []
+
+        @self.app.route('/v1/export')
+        def export():
+            r = Response(iter([b'a', b'b']), mimetype='application/json')
+            r.call_on_close(lambda: self.closed.append('export'))
+            return r
+
+        @self.app.route('/v1/missing')
+        def missing():
+            return jsonify({'error': 'NOT_FOUND'}), 404
+
+        self.c = self.app.test_client()
+
+    def batch(self, requests, parallel=False, headers={}):
+        r = self.c.post('/batch', json={'requests': requests, 'parallel': parallel}, headers=headers)
+        return r.status_code, r.get_json()
+
+    def test_responses_in_order(self):
+        status, j = self.batch([
+            {'path': '/v1/echo/a', 'query': {'q': 'x'}},
+            {'path': '/v1/missing'},
+            {'path': '/v1/echo/b', 'method': 'post', 'body': {'k': 1}, 'headers': {'X-Extra': 'yes'}},
+        ])
+        self.assertEqual(status, 200)
+        responses = j['responses']
+        self.assertEqual([r['status'] for r in responses], [200, 404, 200])
+        self.assertEqual(responses[0]['body']['name'], 'a')
+        self.assertEqual(responses[0]['body']['query'], 'x')
+        self.assertEqual(responses[1]['body'], {'error': 'NOT_FOUND'})
+        self.assertEqual(responses[2]['body']['method'], 'POST')
+        self.assertEqual(responses[2]['body']['body'], {'k': 1})
+        self.assertEqual(responses[2]['body']['extra'], 'yes')
+        self.assertEqual(responses[0]['headers'], {'Content-Type': 'application/json'})
+
+    def test_parallel(self):
+        t0 = time.time()
+        status, j = self.batch([{'path': '/v1/echo/slow'}] * 3 + [{'path': '/v1/echo/last'}], parallel=True)
+        self.assertTrue(time.time() - t0 < 0.6)
+        self.assertEqual([r['body']['name'] for r in j['responses']], ['slow', 'slow', 'slow', 'last'])
+        self.assertTrue(all(t.startswith('pym-batch') for t in self.threads))
+
+        self.threads.clear()
+        t0 = time.time()
+        self.batch([{'path': '/v1/echo/slow'}] * 2)
+        self.assertTrue(time.time() - t0 >= 0.6)
+        self.assertEqual(self.threads, [threading.current_thread().name] * 2)
+
+    def test_max_requests(self):
+        max_requests = get_config().batch_max_requests
+        status, j = self.batch([{'path': '/v1/echo/a'}] * max_requests)
+        self.assertEqual(status, 200)
+        status, j = self.batch([{'path': '/v1/echo/a'}] * (max_requests + 1))
+        self.assertEqual(status, 400)
+        self.assertEqual(j['error'], 'INVALID_PARAMETER')
+
+    def test_no_nested_batch(self):
+        for path in ('/batch', '/batch/', '/batch?x=1'):
+            status, j = self.batch([{'path': '/v1/echo/a'}, {'path': path, 'method': 'POST', 'body': {'requests': []}}])
+            self.assertEqual(status, 400)
+            self.assertEqual(j['error'], 'INVALID_PARAMETER')
+
+    def test_auth_headers_forwarded(self):
+        token = generate_token('u1')
+        headers = {'Authorization': f'Bearer {token}', 'User-Agent': 'tests', 'X-Other': 'no'}
+        for parallel in (False, True):
+            status, j = self.batch([{'path': '/v1/echo/a'}, {'path': '/v1/echo/b'}], parallel=parallel, headers=headers)
+            self.assertEqual(status, 200)
+            for r in j['responses']:
+                self.assertEqual(r['body']['authorization'], f'Bearer {token}')
+                self.assertEqual(r['body']['user_agent'], 'tests')
+
+    def test_invalid_token(self):
+        status, j = self.batch([{'path': '/v1/echo/a'}], headers={'Authorization': 'Bearer not.a.token'})
+        self.assertEqual(status, 401)
+
+    def test_subrequests_skip_worker_limit(self):
+        conf = get_config()
+        saved = conf.max_concurrency
+        conf.max_concurrency = 1
+        concurrency.worker_limit = None
+
+        def restore():
+            conf.max_concurrency = saved
+            concurrency.worker_limit = None
+        self.addCleanup(restore)
+
+        self.assertEqual(self.c.get('/v1/limited/a').status_code, 200)
+        for parallel in (False, True):
+            status, j = self.batch([{'path': '/v1/limited/a'}, {'path': '/v1/limited/b'}], parallel=parallel)
+            self.assertEqual(status, 200)
+            self.assertEqual([r['status'] for r in j['responses']], [200, 200])
+            self.assertEqual([r['body']['body']['name'] for r in j['responses']], ['a', 'b'])
+        self.assertEqual(concurrency.worker_limit.running, 0)
+
+    def test_streamed_responses_are_closed(self):
+        conf = get_config()
+        saved = conf.sse_max_streams
+        conf.sse_max_streams = 1
+        self.addCleanup(setattr, conf, 'sse_max_streams', saved)
+
+        for i in range(2):
+            status, j = self.batch([{'path': '/v1/events'}, {'path': '/v1/export'}, {'path': '/v1/echo/a'}])
+            self.assertEqual(status, 200)
+            self.assertEqual([r['status'] for r in j['responses']], [400, 400, 200])
+            self.assertIn('cannot be batched', j['responses'][0]['body']['error_description'])
+            self.assertEqual(sse.open_streams, 0)
+        self.assertEqual(self.closed, ['export', 'export'])
@@ -0,0 +1,84 @@
+import unittest
+from flask import Flask, jsonify
+from pymacaron.auth import generate_token
+from pymacaron.config import get_config
+from pymacaron.cache import ResponseCache
+from pymacaron.cache import invalidate_cache
+from pymacaron.metrics import get_counter, reset_counters
+from pymacaron.exceptions import AuthMissingHeaderError
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        reset_counters()
+
+    def cached_get(self, cache, path, path_args, headers={}, body=None):
+        with self.app.test_request_context(path, headers=headers):
+            key = cache.get_key(path_args)
+            r = cache.get(key)
+            if r:
+                return r
+            r = jsonify(body or path_args)
+            cache.set(key, path_args, r)
+            return r
+
+    def test_hit_and_miss(self):
+        cache = ResponseCache('test.do_get_item', ttl=60)
+        self.assertEqual(self.cached_get(cache, '/items/1', {'item_id': '1'}).headers['X-Cache'], 'MISS')
+        r = self.cached_get(cache, '/items/1', {'item_id': '1'})
+        self.assertEqual(r.headers['X-Cache'], 'HIT')
+        self.assertEqual(r.get_json(), {'item_id': '1'})
+        self.assertEqual(self.cached_get(cache, '/items/1?lang=en', {'item_id': '1'}).headers['X-Cache'], 'MISS')
+        self.assertEqual(get_counter('cache.hit', endpoint='test.do_get_item'), 1)
+        self.assertEqual(get_counter('cache.miss', endpoint='test.do_get_item'), 2)
+
+    def test_max_size(self):
+        cache = ResponseCache('test.do_get_item', ttl=60, max_size=2)
+        for i in range(3):
+            self.cached_get(cache, f'/items/{i}', {'item_id': str(i)})
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(self.cached_get(cache, '/items/0', {'item_id': '0'}).headers['X-Cache'], 'MISS')
+
+    def test_ttl(self):
+        cache = ResponseCache('test.do_get_item', ttl=0.01)
+        self.cached_get(cache, '/items/1', {'item_id': '1'})
+        import time
+        time.sleep(0.02)
+        self.assertEqual(self.cached_get(cache, '/items/1', {'item_id': '1'}).headers['X-Cache'], 'MISS')
+
+    def test_invalidate(self):
+        cache = ResponseCache('test.do_get_item', ttl=60)
+        self.cached_get(cache, '/items/1', {'item_id': '1'})
+        self.cached_get(cache, '/items/2', {'item_id': '2'})
+        invalidate_cache('test.do_get_item', item_id='1')
+        self.assertEqual(self.cached_get(cache, '/items/1', {'item_id': '1'}).headers['X-Cache'], 'MISS')
+        self.assertEqual(self.cached_get(cache, '/items/2', {'item_id': '2'}).headers['X-Cache'], 'HIT')
+        invalidate_cache()
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_vary_by_user_requires_auth(self):
+        cache = ResponseCache('test.do_get_me', ttl=60, vary=['user'])
+        self.assertTrue(cache.auth)
+        with self.app.test_request_context('/me'):
+            with self.assertRaises(AuthMissingHeaderError):
+                cache.get_key({})
+
+    def test_vary_by_user(self):
+        conf = get_config()
+        saved = (conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'test'
+        self.addCleanup(lambda: setattr(conf, 'jwt_secret', saved[0]) or setattr(conf, 'jwt_issuer', saved[1]) or setattr(conf, 'jwt_audience', saved[2]))
+
+        # The default vary of decorated endpoints (see pymacaron.apiloader)
+        cache = ResponseCache('test.do_get_me', ttl=60, vary=['path', 'query', 'user'], auth=True)
+        alice = {'Authorization': 'Bearer ' + generate_token('alice')}
+        bob = {'Authorization': 'Bearer ' + generate_token('bob')}
+        self.cached_get(cache, '/me', {}, headers=alice, body={'user': 'alice'})
+        r = self.cached_get(cache, '/me', {}, headers=bob, body={'user': 'bob'})
+        self.assertEqual(r.headers['X-Cache'], 'MISS')
+        self.assertEqual(r.get_json(), {'user': 'bob'})
+        r = self.cached_get(cache, '/me', {}, headers=alice, body={'user': 'bob'})
+        self.assertEqual(r.headers['X-Cache'], 'HIT')
+        self.assertEqual(r.get_json(), {'user': 'alice'})
@@ -0,0 +1,62 @@
+import time
+import threading
+import unittest
+from pymacaron.coalesce import RequestCoalescer
+from pymacaron.exceptions import CoalesceTimeoutError
+
+
+class Tests(unittest.TestCase):
+
+    def run_concurrently(self, coalescer, f, count=5):
+        results = []
+
+        def call():
+            try:
+                results.append(coalescer.call('key', f))
+            except BaseException as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for t in threads:
+            t.start()
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+        return results
+
+    def test_share_result(self):
+        calls = []
+
+        def f():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+
+        results = self.run_concurrently(RequestCoalescer('test.f'), f)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_share_exception(self):
+        def f():
+            time.sleep(0.2)
+            raise ValueError('boom')
+
+        results = self.run_concurrently(RequestCoalescer('test.f'), f)
+        self.assertEqual(len(results), 5)
+        for r in results:
+            self.assertTrue(isinstance(r, ValueError))
+
+    def test_timeout(self):
+        def f():
+            time.sleep(0.5)
+            return 'result'
+
+        results = self.run_concurrently(RequestCoalescer('test.f', timeout=0.1), f, count=2)
+        self.assertTrue(isinstance(results[0], CoalesceTimeoutError))
+        self.assertEqual(results[1], 'result')
+
+    def test_sequential_calls_are_not_shared(self):
+        c = RequestCoalescer('test.f')
+        self.assertEqual(c.call('key', lambda: 1), 1)
+        self.assertEqual(c.call('key', lambda: 2), 2)
+        self.assertEqual(c.flights, {})
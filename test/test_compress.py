@@ -0,0 +1,69 @@
+import gzip
+import unittest
+from flask import Flask, Response
+from pymacaron.compress import init_compression, set_route_compression, policies, route_policies
+from pymacaron.metrics import get_counter, reset_counters
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        reset_counters()
+        policies.clear()
+        route_policies.clear()
+        self.app = Flask(__name__)
+        init_compression(self.app)
+
+        @self.app.route('/small')
+        def small():
+            return Response('{"a": 1}', mimetype='application/json')
+
+        @self.app.route('/big')
+        def big():
+            return Response('{"a": "%s"}' % ('x' * 5000), mimetype='application/json')
+
+        @self.app.route('/raw')
+        def raw():
+            return Response('{"a": "%s"}' % ('x' * 5000), mimetype='application/json')
+
+        @self.app.route('/png')
+        def png():
+            return Response(b'x' * 5000, mimetype='image/png')
+
+        self.client = self.app.test_client()
+
+    def test_min_size(self):
+        r = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(r.headers['Vary'], 'Accept-Encoding')
+
+    def test_gzip(self):
+        r = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(r.data), b'{"a": "%s"}' % (b'x' * 5000))
+        self.assertEqual(get_counter('compress.responses', encoding='gzip', route='/big'), 1)
+        self.assertEqual(get_counter('compress.bytes_in', encoding='gzip', route='/big'), 5009)
+        self.assertTrue(get_counter('compress.bytes_saved', encoding='gzip', route='/big') > 4900)
+
+    def test_accept_encoding(self):
+        r = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', r.headers)
+        r = self.client.get('/big', headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        r = self.client.get('/big', headers={'Accept-Encoding': 'gzip;q=0.5, br'})
+        self.assertEqual(r.headers['Content-Encoding'], 'br')
+        r = self.client.get('/big', headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+
+    def test_mimetype(self):
+        r = self.client.get('/png', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+
+    def test_route_override(self):
+        set_route_compression('raw', False)
+        r = self.client.get('/raw', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+
+        set_route_compression('big', {'algorithms': ['gzip'], 'min_size': 10})
+        r = self.client.get('/big', headers={'Accept-Encoding': 'br, gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
@@ -0,0 +1,67 @@
+import threading
+import unittest
+from pymacaron.config import get_config
+from pymacaron.exceptions import ServerOverloadedError
+from pymacaron.concurrency import ConcurrencyLimit, concurrency_slots, get_endpoint_limit
+from pymacaron import concurrency
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config()
+        saved = (conf.max_concurrency, conf.endpoint_max_concurrency, conf.max_concurrency_queue)
+
+        def restore():
+            conf.max_concurrency, conf.endpoint_max_concurrency, conf.max_concurrency_queue = saved
+            concurrency.worker_limit = None
+        self.addCleanup(restore)
+        concurrency.worker_limit = None
+
+    def test_reject_beyond_limit(self):
+        lim = ConcurrencyLimit('test', 2, queue=0, retry_after=5)
+        lim.acquire()
+        lim.acquire()
+        with self.assertRaises(ServerOverloadedError) as cm:
+            lim.acquire()
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(cm.exception.headers, {'Retry-After': '5'})
+        lim.release()
+        lim.acquire()
+
+    def test_queue(self):
+        lim = ConcurrencyLimit('test', 1, queue=1, queue_timeout=5)
+        lim.acquire()
+        threading.Timer(0.1, lim.release).start()
+        lim.acquire()
+        self.assertEqual(lim.running, 1)
+
+        lim = ConcurrencyLimit('test', 1, queue=1, queue_timeout=0.1)
+        lim.acquire()
+        with self.assertRaises(ServerOverloadedError):
+            lim.acquire()
+        self.assertEqual(lim.waiting, 0)
+
+    def test_endpoint_limit(self):
+        self.assertIsNone(get_endpoint_limit('my.do_get', None))
+        self.assertEqual(get_endpoint_limit('my.do_get', 3).limit, 3)
+        self.assertEqual(get_endpoint_limit('my.do_get', {'limit': 3, 'queue': 0}).queue, 0)
+        get_config().endpoint_max_concurrency = {'my.do_get': 7}
+        self.assertEqual(get_endpoint_limit('my.do_get', 3).limit, 7)
+
+    def test_slots(self):
+        get_config().max_concurrency = 1
+        get_config().max_concurrency_queue = 0
+        endpoint_limit = ConcurrencyLimit('test', 5)
+        with concurrency_slots('myapi', endpoint_limit):
+            self.assertEqual(endpoint_limit.running, 1)
+            with self.assertRaises(ServerOverloadedError):
+                with concurrency_slots('myapi', endpoint_limit):
+                    pass
+            self.assertEqual(endpoint_limit.running, 1)
+
+            # Ping is exempt
+            with concurrency_slots('ping'):
+                pass
+        self.assertEqual(endpoint_limit.running, 0)
+        self.assertEqual(concurrency.worker_limit.running, 0)
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+from flask import Flask
+from pymacaron.config import get_config
+from pymacaron.cors import CorsPolicy, init_cors
+from pymacaron.lean import lean_route, enable_lean_dispatch
+from pymacaron.asgi import AsgiApp
+from pymacaron import cors
+
+
+PREFLIGHT = {
+    'Origin': 'https://app.example.com',
+    'Access-Control-Request-Method': 'POST',
+    'Access-Control-Request-Headers': 'Content-Type, X-Custom',
+}
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config()
+        saved = {k: getattr(conf, k) for k in ('cors_origins', 'cors_headers', 'cors_credentials', 'cors_expose_headers')}
+
+        def restore():
+            for k, v in saved.items():
+                setattr(conf, k, v)
+            cors.policy = None
+        self.addCleanup(restore)
+
+        self.calls = []
+        self.app = Flask(__name__)
+
+        @self.app.route('/v1/items', methods=['GET', 'POST'])
+        @lean_route(self.app, '/v1/items', 'GET')
+        def endpoint_get__v1_items():
+            self.calls.append('items')
+            return 'items'
+
+    def test_default_policy(self):
+        init_cors(self.app)
+        c = self.app.test_client()
+
+        r = c.options('/v1/items', headers=PREFLIGHT)
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(r.headers['Access-Control-Allow-Methods'], 'GET, HEAD, POST, PUT, PATCH, DELETE')
+        self.assertEqual(r.headers['Access-Control-Allow-Headers'], 'Content-Type, Authorization')
+        self.assertEqual(r.headers['Access-Control-Max-Age'], '86400')
+        self.assertNotIn('Vary', r.headers)
+        # Answered before routing
+        self.assertEqual(self.calls, [])
+        self.assertEqual(c.options('/nowhere', headers=PREFLIGHT).status_code, 204)
+
+        r = c.get('/v1/items', headers={'Origin': 'https://app.example.com'})
+        self.assertEqual(r.get_data(), b'items')
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], '*')
+
+        r = c.get('/v1/items')
+        self.assertNotIn('Access-Control-Allow-Origin', r.headers)
+
+        # OPTIONS without Origin is not a preflight
+        r = c.options('/v1/items')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('POST', r.headers['Allow'])
+
+    def test_restricted_origins(self):
+        conf = get_config()
+        conf.cors_origins = ['https://app.example.com']
+        conf.cors_headers = ['*']
+        conf.cors_credentials = True
+        conf.cors_expose_headers = ['Retry-After']
+        init_cors(self.app)
+        c = self.app.test_client()
+
+        r = c.options('/v1/items', headers=PREFLIGHT)
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], 'https://app.example.com')
+        self.assertEqual(r.headers['Access-Control-Allow-Headers'], 'Content-Type, X-Custom')
+        self.assertEqual(r.headers['Access-Control-Allow-Credentials'], 'true')
+        self.assertEqual(r.headers['Vary'], 'Origin')
+
+        r = c.options('/v1/items', headers=dict(PREFLIGHT, Origin='https://evil.com'))
+        self.assertEqual(r.status_code, 204)
+        self.assertNotIn('Access-Control-Allow-Origin', r.headers)
+
+        r = c.get('/v1/items', headers={'Origin': 'https://app.example.com'})
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], 'https://app.example.com')
+        self.assertEqual(r.headers['Access-Control-Expose-Headers'], 'Retry-After')
+        self.assertEqual(r.headers['Vary'], 'Origin')
+
+        r = c.get('/v1/items', headers={'Origin': 'https://evil.com'})
+        self.assertNotIn('Access-Control-Allow-Origin', r.headers)
+
+    def test_no_cors(self):
+        get_config().cors_origins = []
+        init_cors(self.app)
+        r = self.app.test_client().options('/v1/items', headers=PREFLIGHT)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('Access-Control-Allow-Origin', r.headers)
+
+    def test_lean_dispatch(self):
+        enable_lean_dispatch(self.app)
+        init_cors(self.app)
+        c = self.app.test_client()
+        self.assertEqual(c.options('/v1/items', headers=PREFLIGHT).status_code, 204)
+        r = c.get('/v1/items', headers={'Origin': 'https://app.example.com'})
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(self.calls, ['items'])
+
+    def test_asgi_preflight(self):
+        init_cors(self.app)
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'OPTIONS',
+            'path': '/v1/items',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in PREFLIGHT.items()],
+        }
+        asyncio.run(AsgiApp(self.app)(scope, receive, send))
+        self.assertEqual(sent[0]['status'], 204)
+        self.assertIn((b'access-control-allow-origin', b'*'), sent[0]['headers'])
+        self.assertEqual(self.calls, [])
+
+    def test_policy(self):
+        p = CorsPolicy(origins=['https://a.com'], methods=['GET'], max_age=60)
+        self.assertEqual(p.allow_origin('https://a.com'), 'https://a.com')
+        self.assertIsNone(p.allow_origin('https://b.com'))
+        self.assertIsNone(p.allow_origin(None))
+        self.assertIn(('Access-Control-Max-Age', '60'), p.get_preflight_headers('https://a.com'))
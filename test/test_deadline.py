@@ -0,0 +1,59 @@
+import time
+import unittest
+from flask import Flask
+from pymacaron.auth import add_auth
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron.deadline import start_deadline, set_deadline, remaining_time, check_deadline, DEADLINE_HEADER
+
+
+def call(url, headers=None, timeout=None):
+    return headers, timeout
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_no_deadline(self):
+        with self.app.test_request_context('/'):
+            start_deadline()
+            self.assertIsNone(remaining_time())
+            check_deadline()
+            headers, timeout = add_auth(call)('http://x', timeout=30)
+            self.assertNotIn(DEADLINE_HEADER, headers)
+            self.assertEqual(timeout, 30)
+
+    def test_earliest_deadline_wins(self):
+        with self.app.test_request_context('/', headers={DEADLINE_HEADER: '2000'}):
+            start_deadline(10)
+            self.assertTrue(1.9 < remaining_time() <= 2)
+            set_deadline(1)
+            self.assertTrue(0.9 < remaining_time() <= 1)
+            set_deadline(5)
+            self.assertTrue(remaining_time() <= 1)
+
+    def test_invalid_header(self):
+        with self.app.test_request_context('/', headers={DEADLINE_HEADER: 'soon'}):
+            start_deadline()
+            self.assertIsNone(remaining_time())
+
+    def test_deadline_exceeded(self):
+        with self.app.test_request_context('/'):
+            start_deadline(0.05)
+            check_deadline()
+            time.sleep(0.1)
+            self.assertEqual(remaining_time(), 0)
+            with self.assertRaises(DeadlineExceededError):
+                check_deadline()
+            with self.assertRaises(DeadlineExceededError):
+                add_auth(call)('http://x')
+
+    def test_add_auth_forwards_deadline(self):
+        with self.app.test_request_context('/'):
+            start_deadline(3)
+            headers, timeout = add_auth(call)('http://x', timeout=30)
+            self.assertTrue(2900 < int(headers[DEADLINE_HEADER]) <= 3000)
+            self.assertTrue(timeout <= 3)
+            headers, timeout = add_auth(call)('http://x')
+            self.assertIsNone(timeout)
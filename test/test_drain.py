@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import socket
+import signal
+import tempfile
+import threading
+import unittest
+import subprocess
+from pymacaron import drain
+from pymacaron.drain import inflight_request
+from pymacaron.drain import wait_for_inflight
+from pymacaron.drain import add_drain_hook
+from pymacaron.drain import flush
+
+
+class Tests(unittest.TestCase):
+
+    def tearDown(self):
+        drain.draining = False
+        drain.drain_hooks.clear()
+
+    def test_inflight_count(self):
+        self.assertEqual(drain.inflight, 0)
+        with inflight_request():
+            self.assertEqual(drain.inflight, 1)
+            with inflight_request():
+                self.assertEqual(drain.inflight, 2)
+        self.assertEqual(drain.inflight, 0)
+
+    def test_inflight_count_on_exception(self):
+        with self.assertRaises(ValueError):
+            with inflight_request():
+                raise ValueError()
+        self.assertEqual(drain.inflight, 0)
+
+    def test_wait_for_inflight(self):
+        done = threading.Event()
+
+        def serve():
+            with inflight_request():
+                done.wait()
+
+        t = threading.Thread(target=serve)
+        t.start()
+        while drain.inflight == 0:
+            pass
+        self.assertFalse(wait_for_inflight(0.2))
+        done.set()
+        self.assertTrue(wait_for_inflight(5))
+        t.join()
+
+    def test_flush_calls_hooks(self):
+        called = []
+
+        def failing_hook():
+            raise Exception('boom')
+
+        add_drain_hook(failing_hook)
+        add_drain_hook(lambda: called.append(1))
+        flush()
+        self.assertEqual(called, [1])
+
+
+APP = """
+import time
+from flask import Flask
+from pymacaron.drain import add_drain_hook
+
+app = Flask(__name__)
+
+@app.route('/slow')
+def slow():
+    time.sleep(10)
+    return 'done'
+
+def flushed():
+    with open('flushed', 'w') as f:
+        f.write('yes')
+
+add_drain_hook(flushed)
+"""
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class GunicornTests(unittest.TestCase):
+
+    def test_flush_before_kill(self):
+        # A request outlasting every timeout must not keep the worker from
+        # flushing before the master kills it
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'slowapp.py'), 'w') as f:
+                f.write(APP)
+
+            port = get_free_port()
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                PYM_DRAIN_DELAY='0.2',
+                PYM_DRAIN_TIMEOUT='1',
+                PYM_FLUSH_TIMEOUT='1',
+            )
+            p = subprocess.Popen(
+                [
+                    sys.executable, '-m', 'gunicorn',
+                    '--bind', f'127.0.0.1:{port}',
+                    '--workers', '1',
+                    '--config', 'python:pymacaron.gunicorn',
+                    '--error-logfile', 'gunicorn.log',
+                    '--access-logfile', '/dev/null',
+                    'slowapp:app',
+                ],
+                cwd=d,
+                env=env,
+            )
+            try:
+                t_end = time.time() + 20
+                while True:
+                    try:
+                        c = socket.create_connection(('127.0.0.1', port))
+                        break
+                    except OSError:
+                        self.assertTrue(time.time() < t_end, "gunicorn did not start")
+                        time.sleep(0.1)
+
+                c.sendall(b'GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                time.sleep(0.5)
+                p.send_signal(signal.SIGTERM)
+                p.wait(20)
+                c.close()
+            finally:
+                if p.poll() is None:
+                    p.kill()
+
+            self.assertTrue(os.path.exists(os.path.join(d, 'flushed')))
@@ -0,0 +1,31 @@
+import unittest
+from flask import Flask
+from pymacaron.endpoint import etag_matches
+from pymacaron.endpoint import get_version_etag
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_etag_matches(self):
+        with self.app.test_request_context('/items/1'):
+            self.assertFalse(etag_matches('abc'))
+        with self.app.test_request_context('/items/1', headers={'If-None-Match': '"abc"'}):
+            self.assertTrue(etag_matches('abc'))
+            self.assertFalse(etag_matches('abd'))
+        with self.app.test_request_context('/items/1', headers={'If-None-Match': '"xyz", "abc:gzip"'}):
+            self.assertTrue(etag_matches('abc'))
+        with self.app.test_request_context('/items/1', headers={'If-None-Match': '*'}):
+            self.assertTrue(etag_matches('abc'))
+
+    def test_version_etag_depends_on_url(self):
+        with self.app.test_request_context('/items/1'):
+            e1 = get_version_etag(3)
+        with self.app.test_request_context('/items/1?lang=en'):
+            e2 = get_version_etag(3)
+        with self.app.test_request_context('/items/1'):
+            self.assertEqual(get_version_etag(3), e1)
+            self.assertNotEqual(get_version_etag(4), e1)
+        self.assertNotEqual(e1, e2)
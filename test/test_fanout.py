@@ -0,0 +1,141 @@
+import json
+import time
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flask import Flask, request
+from requests.exceptions import HTTPError
+from pymacaron.auth import get_userid, get_user_token
+from pymacaron.deadline import set_deadline, remaining_time, DEADLINE_HEADER
+from pymacaron.exceptions import DeadlineExceededError
+from pymacaron.fanout import fanout, HttpCall
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({
+            'path': self.path,
+            'authorization': self.headers.get('Authorization'),
+            'deadline': self.headers.get(DEADLINE_HEADER),
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def whoami():
+    return {'userid': get_userid(), 'token': get_user_token(), 'path': request.path}
+
+
+def sleep(seconds):
+    def f():
+        time.sleep(seconds)
+        return seconds
+    return f
+
+
+def crash():
+    raise Exception('Boom')
+
+
+async def compute():
+    return 42
+
+
+class Tests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_concurrent(self):
+        with self.app.test_request_context('/'):
+            t0 = time.time()
+            results = fanout([sleep(0.3), sleep(0.3), sleep(0.3), compute])
+            self.assertEqual(results, [0.3, 0.3, 0.3, 42])
+            self.assertTrue(time.time() - t0 < 0.6)
+
+    def test_request_context(self):
+        with self.app.test_request_context('/v1/me'):
+            stack.top.current_user = {'sub': 'user123', 'token': 'abc'}
+            results = fanout({'me': whoami, 'http': HttpCall('GET', self.url + '/v1/items')})
+            self.assertEqual(results['me'], {'userid': 'user123', 'token': 'abc', 'path': '/v1/me'})
+            self.assertEqual(results['http']['path'], '/v1/items')
+            self.assertEqual(results['http']['authorization'], 'Bearer abc')
+            self.assertIsNone(results['http']['deadline'])
+
+    def test_errors(self):
+        with self.app.test_request_context('/'):
+            ok, error, missing = fanout([compute, crash, HttpCall('GET', self.url + '/missing')])
+            self.assertEqual(ok, 42)
+            self.assertEqual(str(error), 'Boom')
+            self.assertIsInstance(missing, HTTPError)
+
+    def test_deadline(self):
+        with self.app.test_request_context('/'):
+            set_deadline(0.2)
+            t0 = time.time()
+            fast, slow, http = fanout([sleep(0), sleep(1), HttpCall('GET', self.url + '/v1/items')])
+            self.assertTrue(time.time() - t0 < 0.5)
+            self.assertEqual(fast, 0)
+            self.assertIsInstance(slow, DeadlineExceededError)
+            self.assertTrue(0 < int(http['deadline']) <= 200)
+
+            time.sleep(0.2)
+            with self.assertRaises(DeadlineExceededError):
+                fanout([compute])
+
+    def test_timeout(self):
+        results = fanout([sleep(0), sleep(1)], timeout=0.1)
+        self.assertEqual(results[0], 0)
+        self.assertIsInstance(results[1], DeadlineExceededError)
+
+    def test_abandoned_call(self):
+        seen = []
+
+        def slow():
+            time.sleep(0.3)
+            seen.append((request.path, get_userid(), remaining_time(), stack.top))
+
+        with self.app.test_request_context('/v1/me'):
+            stack.top.current_user = {'sub': 'user123', 'token': 'abc'}
+            ctx = stack.top
+            results = fanout([slow], timeout=0.1)
+            self.assertIsInstance(results[0], DeadlineExceededError)
+
+        # The call completes after the request is gone, in its own copy of
+        # the request's context, past its deadline
+        time.sleep(0.5)
+        path, userid, remaining, call_ctx = seen[0]
+        self.assertEqual((path, userid, remaining), ('/v1/me', 'user123', 0))
+        self.assertIsNot(call_ctx, ctx)
+
+    def test_nested(self):
+        with self.app.test_request_context('/'):
+            results = fanout([lambda: fanout([compute, compute]), compute])
+            self.assertEqual(results, [[42, 42], 42])
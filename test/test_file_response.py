@@ -0,0 +1,72 @@
+import io
+import os
+import tempfile
+import unittest
+from flask import Flask
+from werkzeug.test import EnvironBuilder
+from pymacaron.endpoint import file_response, BufferChunks
+from pymacaron.exceptions import BadResponseException
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'0123456789')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def get(self, result, headers={}):
+        with self.app.test_request_context('/download', headers=headers):
+            r = file_response(result, 'application/pdf')
+            r.direct_passthrough = False
+            return r.status_code, r.mimetype, r.get_data()
+
+    def test_all_result_types(self):
+        for result in [
+            self.path,
+            open(self.path, 'rb'),
+            b'0123456789',
+            memoryview(b'0123456789'),
+            io.BytesIO(b'0123456789'),
+        ]:
+            self.assertEqual(self.get(result), (200, 'application/pdf', b'0123456789'))
+
+    def test_range(self):
+        for result in [self.path, open(self.path, 'rb'), b'0123456789', bytearray(b'0123456789'), memoryview(b'0123456789')]:
+            self.assertEqual(self.get(result, {'Range': 'bytes=2-4'}), (206, 'application/pdf', b'234'))
+
+    def test_bad_result(self):
+        with self.assertRaises(BadResponseException):
+            self.get(self.path + '.missing')
+        with self.assertRaises(BadResponseException):
+            self.get(12)
+
+    def test_wsgi_chunks_are_bytes(self):
+        # WSGI servers only accept bytes: iterate the raw app_iter
+        results = {}
+        self.app.add_url_rule('/download', 'download', lambda: file_response(results['result'], 'application/pdf'))
+        for result in [b'0123456789', bytearray(b'0123456789'), memoryview(b'0123456789')]:
+            results['result'] = result
+            for headers, expected in [({}, b'0123456789'), ({'Range': 'bytes=2-4'}, b'234')]:
+                environ = EnvironBuilder(path='/download', headers=headers).get_environ()
+                chunks = list(self.app.wsgi_app(environ, lambda status, headers: None))
+                for chunk in chunks:
+                    self.assertIs(type(chunk), bytes)
+                self.assertEqual(b''.join(chunks), expected)
+
+    def test_buffers_are_not_copied(self):
+        data = bytearray(b'0123456789')
+        with self.app.test_request_context('/download'):
+            r = file_response(data, 'application/pdf')
+            # The response holds a view of the buffer, not a copy
+            data[0:1] = b'X'
+            self.assertEqual(b''.join(r.response), b'X123456789')
+
+        chunks = BufferChunks(memoryview(b'0123456789'), chunk_size=4)
+        self.assertEqual(list(chunks), [b'0123', b'4567', b'89'])
+        chunks.seek(5)
+        self.assertEqual(list(chunks), [b'5678', b'9'])
@@ -0,0 +1,71 @@
+import unittest
+from flask import Flask, request, jsonify, url_for
+from pymacaron.lean import lean_route, enable_lean_dispatch, get_dispatcher
+
+
+def create_app():
+    app = Flask(__name__)
+    calls = []
+
+    @app.route("/v1/items/<string:item_id>", methods=["GET"])
+    @lean_route(app, "/v1/items/<string:item_id>", "GET")
+    def endpoint_get__v1_items_item_id(item_id):
+        calls.append(request.endpoint)
+        return jsonify({
+            'item_id': item_id,
+            'url': url_for('endpoint_get__v1_items_item_id', item_id='x'),
+        })
+
+    @app.route("/v1/crash", methods=["GET"])
+    @lean_route(app, "/v1/crash", "GET")
+    def endpoint_get__v1_crash():
+        raise Exception("Boom")
+
+    @app.route("/other")
+    def other():
+        calls.append('other')
+        return 'other'
+
+    @app.before_request
+    def before():
+        calls.append('before')
+
+    @app.after_request
+    def after(r):
+        r.headers['X-After'] = 'yes'
+        return r
+
+    enable_lean_dispatch(app)
+    return app, calls
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app, self.calls = create_app()
+        self.c = self.app.test_client()
+
+    def test_lean_route(self):
+        r = self.c.get('/v1/items/abc')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json(), {'item_id': 'abc', 'url': '/v1/items/x'})
+        self.assertEqual(r.headers['X-After'], 'yes')
+        self.assertEqual(self.calls, ['before', 'endpoint_get__v1_items_item_id'])
+
+    def test_other_routes_go_to_flask(self):
+        r = self.c.get('/other')
+        self.assertEqual(r.get_data(), b'other')
+        self.assertEqual(r.headers['X-After'], 'yes')
+        self.assertEqual(self.c.get('/nowhere').status_code, 404)
+        self.assertEqual(self.c.post('/v1/items/abc').status_code, 405)
+
+    def test_exception(self):
+        r = self.c.get('/v1/crash')
+        self.assertEqual(r.status_code, 500)
+
+    def test_enable_twice(self):
+        enable_lean_dispatch(self.app)
+        d = get_dispatcher(self.app)
+        self.assertIs(self.app.wsgi_app, d)
+        self.assertIsNot(d.flask_wsgi_app, d)
+        self.assertEqual(self.c.get('/v1/items/abc').status_code, 200)
@@ -0,0 +1,63 @@
+import os
+import unittest
+from pymacaron import lifecycle
+from pymacaron.lifecycle import resources
+from pymacaron.lifecycle import add_worker_start_hook
+from pymacaron.lifecycle import add_worker_stop_hook
+from pymacaron.lifecycle import start_worker
+from pymacaron.lifecycle import stop_worker
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def open_pool(r):
+            self.calls.append('open')
+            r.pool = 'pool'
+
+        def close_pool(r):
+            self.calls.append('close %s' % r.pool)
+
+        add_worker_start_hook(open_pool)
+        add_worker_stop_hook(close_pool)
+
+    def tearDown(self):
+        stop_worker()
+        lifecycle.worker_start_hooks.clear()
+        lifecycle.worker_stop_hooks.clear()
+
+    def test_start_stop(self):
+        self.assertFalse(resources.is_started())
+        with self.assertRaises(AttributeError):
+            resources.pool
+        self.assertFalse(hasattr(resources, 'pool'))
+
+        start_worker()
+        start_worker()
+        self.assertEqual(resources.pool, 'pool')
+        self.assertTrue('pool' in resources)
+        self.assertIsNone(resources.get('other'))
+        with self.assertRaises(AttributeError):
+            resources.other
+        self.assertEqual(getattr(resources, 'other', 'default'), 'default')
+
+        stop_worker()
+        stop_worker()
+        self.assertEqual(self.calls, ['open', 'close pool'])
+        self.assertFalse('pool' in resources)
+
+    def test_forked_worker_gets_its_own_resources(self):
+        start_worker()
+        pid = os.fork()
+        if pid == 0:
+            # In the child, resources opened by the parent are not reachable
+            ok = not resources.is_started() and 'pool' not in resources
+            start_worker()
+            ok = ok and resources.pool == 'pool'
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertEqual(resources.pool, 'pool')
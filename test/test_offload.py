@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import unittest
+from unittest.mock import patch
+from flask import Flask, request
+from pymacaron.auth import get_userid, requires_auth, generate_token
+from pymacaron.config import get_config
+from pymacaron.deadline import set_deadline
+from pymacaron.exceptions import DeadlineExceededError, UnhandledServerError, ServerNotReadyError, AuthMissingHeaderError
+from pymacaron.endpoint import HandlerCall
+from pymacaron import offload
+from pymacaron.offload import start_offload_pool, stop_offload_pool, run_in_process, DecoratedHandler, is_offload_enabled
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+def fibonacci(n):
+    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)
+
+
+def compute(n, unit='none'):
+    return {'pid': os.getpid(), 'result': fibonacci(n), 'unit': unit}
+
+
+def whoami():
+    return {
+        'path': request.path,
+        'query': request.args.get('q'),
+        'header': request.headers.get('X-Test'),
+        'userid': get_userid(),
+    }
+
+
+async def compute_async(n):
+    await asyncio.sleep(0)
+    return fibonacci(n)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return 'done'
+
+
+def crash():
+    os._exit(1)
+
+
+class Tests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_offload_pool(processes=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_offload_pool()
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_run_in_process(self):
+        with self.app.test_request_context('/'):
+            r = run_in_process(compute, [20], {'unit': 'n'})
+            self.assertEqual(r['result'], 6765)
+            self.assertEqual(r['unit'], 'n')
+            self.assertNotEqual(r['pid'], os.getpid())
+
+    def test_handler_call(self):
+        with self.app.test_request_context('/'):
+            r = HandlerCall(compute, [10], {}, offload='process').run()
+            self.assertEqual(r['result'], 55)
+            self.assertNotEqual(r['pid'], os.getpid())
+            self.assertEqual(HandlerCall(compute_async, [10], {}, offload='process').run(), 55)
+
+    def test_request_context(self):
+        with self.app.test_request_context('/v1/me?q=abc', headers={'X-Test': 'yes'}):
+            stack.top.current_user = {'sub': 'user123'}
+            r = run_in_process(whoami, [], {})
+            self.assertEqual(r, {'path': '/v1/me', 'query': 'abc', 'header': 'yes', 'userid': 'user123'})
+
+    def test_deadline(self):
+        with self.app.test_request_context('/'):
+            set_deadline(0.2)
+            with self.assertRaises(DeadlineExceededError):
+                run_in_process(sleep, [0.5], {})
+
+    def test_decorated_handler(self):
+        conf = get_config()
+        saved = (conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'test'
+        self.addCleanup(lambda: setattr(conf, 'jwt_secret', saved[0]) or setattr(conf, 'jwt_issuer', saved[1]) or setattr(conf, 'jwt_audience', saved[2]))
+        # Fork the pool again with this config
+        stop_offload_pool()
+        start_offload_pool(processes=2)
+
+        f = DecoratedHandler(whoami, requires_auth)
+        self.assertEqual(f.__name__, 'whoami')
+        headers = {'Authorization': 'Bearer ' + generate_token('user123')}
+        with self.app.test_request_context('/v1/me', headers=headers):
+            r = HandlerCall(f, [], {}, offload='process').run()
+            self.assertEqual(r['userid'], 'user123')
+        with self.app.test_request_context('/v1/me'):
+            with self.assertRaises(AuthMissingHeaderError):
+                run_in_process(f, [], {})
+
+    def test_enabled(self):
+        with patch.object(offload, 'offloaded_endpoints', set()):
+            self.assertFalse(is_offload_enabled())
+            offload.add_offloaded_endpoint('myserver.do_it')
+            self.assertTrue(is_offload_enabled())
+            with patch.dict('os.environ', {'PYM_OFFLOAD_PROCESS_COUNT': '0'}):
+                self.assertFalse(is_offload_enabled())
+
+    def test_disabled(self):
+        with patch.dict('os.environ', {'PYM_OFFLOAD_PROCESS_COUNT': '0'}):
+            with self.app.test_request_context('/'):
+                self.assertEqual(run_in_process(compute, [10], {})['pid'], os.getpid())
+                self.assertEqual(HandlerCall(compute_async, [10], {}, offload='process').run(), 55)
+
+    def test_crash(self):
+        stop_offload_pool()
+        start_offload_pool(processes=2, recycle=True)
+        limit = offload.pool_limit
+        try:
+            with self.app.test_request_context('/'):
+                with patch('pymacaron.offload.recycle_worker') as recycle_worker:
+                    with self.assertRaises(UnhandledServerError):
+                        run_in_process(crash, [], {})
+                    self.assertEqual(recycle_worker.call_count, 1)
+                self.assertEqual(limit.running, 0)
+
+                # The pool is not forked again: the worker gets recycled
+                with self.assertRaises(ServerNotReadyError):
+                    run_in_process(compute, [10], {})
+                self.assertIs(offload.pool_limit, limit)
+                self.assertEqual(limit.running, 0)
+        finally:
+            stop_offload_pool()
+            start_offload_pool(processes=2)
@@ -0,0 +1,119 @@
+import os
+import time
+import unittest
+from flask import Flask
+from pymacaron.config import get_config
+from pymacaron.auth import generate_token
+from pymacaron.exceptions import RateLimitedError
+from pymacaron.ratelimit import SharedBuckets, LocalBuckets, RateLimiter
+from pymacaron import ratelimit
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        def restore():
+            ratelimit.shared_buckets = None
+            ratelimit.local_buckets = None
+        self.addCleanup(restore)
+        restore()
+
+    def test_local_buckets(self):
+        buckets = LocalBuckets(2)
+        self.assertEqual(buckets.take('a', 0.001, 2)[0], True)
+        self.assertEqual(buckets.take('a', 0.001, 2)[0], True)
+        self.assertEqual(buckets.take('a', 0.001, 2)[0], False)
+        self.assertEqual(buckets.take('b', 0.001, 2)[0], True)
+        self.assertEqual(buckets.take('c', 0.001, 2)[0], True)
+        # 'a' was evicted
+        self.assertEqual(buckets.take('a', 0.001, 2)[0], True)
+
+    def test_shared_buckets_across_processes(self):
+        buckets = SharedBuckets(16)
+        pid = os.fork()
+        if pid == 0:
+            for i in range(3):
+                buckets.take('a', 0.001, 5)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        allowed, tokens = buckets.take('a', 0.001, 5)
+        self.assertTrue(allowed)
+        self.assertEqual(int(tokens), 1)
+
+    def test_shared_buckets_eviction(self):
+        buckets = SharedBuckets(4)
+        for i in range(20):
+            self.assertTrue(buckets.take(f'key{i}', 0.001, 1)[0])
+
+    def test_rate_limiter(self):
+        ratelimit.init_shared_buckets(64)
+        limiter = RateLimiter('my.do_get', 2, period=60, key='ip')
+        with self.app.test_request_context('/', environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+            self.assertEqual(limiter.check()['X-RateLimit-Remaining'], '1')
+            self.assertEqual(limiter.check()['X-RateLimit-Remaining'], '0')
+            with self.assertRaises(RateLimitedError) as cm:
+                limiter.check()
+            self.assertEqual(cm.exception.status, 429)
+            self.assertEqual(cm.exception.headers['Retry-After'], '30')
+
+        with self.app.test_request_context('/', environ_base={'REMOTE_ADDR': '5.6.7.8'}):
+            limiter.check()
+
+    def test_client_ip(self):
+        conf = get_config()
+        saved = conf.trusted_proxy_count
+        self.addCleanup(setattr, conf, 'trusted_proxy_count', saved)
+        environ = {'REMOTE_ADDR': '10.0.0.1'}
+        headers = {'X-Forwarded-For': '6.6.6.6, 1.2.3.4, 10.0.0.2'}
+
+        conf.trusted_proxy_count = 0
+        with self.app.test_request_context('/', environ_base=environ, headers=headers):
+            self.assertEqual(ratelimit.get_client_ip(), '10.0.0.1')
+        conf.trusted_proxy_count = 2
+        with self.app.test_request_context('/', environ_base=environ, headers=headers):
+            self.assertEqual(ratelimit.get_client_ip(), '1.2.3.4')
+        with self.app.test_request_context('/', environ_base=environ, headers={'X-Forwarded-For': '1.2.3.4'}):
+            self.assertEqual(ratelimit.get_client_ip(), '1.2.3.4')
+        with self.app.test_request_context('/', environ_base=environ):
+            self.assertEqual(ratelimit.get_client_ip(), '10.0.0.1')
+
+    def test_client_key(self):
+        conf = get_config()
+        saved = (conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'test'
+        self.addCleanup(lambda: setattr(conf, 'jwt_secret', saved[0]) or setattr(conf, 'jwt_issuer', saved[1]) or setattr(conf, 'jwt_audience', saved[2]))
+        environ = {'REMOTE_ADDR': '1.2.3.4'}
+
+        token = generate_token('user123')
+        with self.app.test_request_context('/', environ_base=environ, headers={'Authorization': f'Bearer {token}'}):
+            self.assertEqual(ratelimit.get_client_key('user'), 'user:user123')
+            self.assertEqual(ratelimit.get_client_key('ip'), 'ip:1.2.3.4')
+
+        # Public endpoints don't fail on credentials they don't need
+        expired = generate_token('user123', expire_in=-3600)
+        for authorization in ('Basic dXNlcjpwYXNz', 'Bearer not.a.token', f'Bearer {expired}'):
+            with self.app.test_request_context('/', environ_base=environ, headers={'Authorization': authorization}):
+                self.assertEqual(ratelimit.get_client_key('user'), 'ip:1.2.3.4')
+
+    def test_spoofed_forwarded_for(self):
+        limiter = RateLimiter('my.do_get', 1, period=60, key='ip')
+        with self.app.test_request_context('/', environ_base={'REMOTE_ADDR': '1.2.3.4'}, headers={'X-Forwarded-For': '9.9.9.1'}):
+            limiter.check()
+        with self.app.test_request_context('/', environ_base={'REMOTE_ADDR': '1.2.3.4'}, headers={'X-Forwarded-For': '9.9.9.2'}):
+            with self.assertRaises(RateLimitedError):
+                limiter.check()
+
+    def test_locked_table(self):
+        ratelimit.init_shared_buckets(64)
+        buckets = ratelimit.shared_buckets
+        # A worker died holding the lock
+        buckets.lock.acquire()
+        self.addCleanup(buckets.lock.release)
+        t0 = time.time()
+        self.assertTrue(ratelimit.take_token('a', 0.001, 2)[0])
+        self.assertIsNone(ratelimit.shared_buckets)
+        self.assertTrue(ratelimit.take_token('a', 0.001, 2)[0])
+        self.assertFalse(ratelimit.take_token('a', 0.001, 2)[0])
+        self.assertTrue(time.time() - t0 < 0.2)
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+from pymacaron.recycle import WorkerHealthMonitor, get_lock_path, STREAMED_ENVIRON
+from pymacaron.recycle import percentile
+
+
+class Tests(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(percentile([5], 99), 5)
+
+    def test_healthy_worker(self):
+        m = WorkerHealthMonitor(window=100, check_every=10)
+        for i in range(1000):
+            self.assertIsNone(m.record(0.2))
+
+    def test_latency_drift(self):
+        m = WorkerHealthMonitor(window=100, check_every=10, latency_drift=2.0, latency_floor_ms=100)
+        for i in range(100):
+            self.assertIsNone(m.record(0.2))
+        self.assertEqual(m.baseline_p99, 0.2)
+
+        reasons = [m.record(0.5) for i in range(100)]
+        self.assertTrue([r for r in reasons if r and 'p99 latency' in r])
+
+    def test_baseline_ignores_fast_burst(self):
+        m = WorkerHealthMonitor(window=100, check_every=10, latency_drift=2.0, latency_floor_ms=100)
+        for i in range(500):
+            self.assertIsNone(m.record(0.2))
+        for i in range(100):
+            self.assertIsNone(m.record(0.01))
+        self.assertEqual(m.baseline_p99, 0.2)
+        for i in range(500):
+            self.assertIsNone(m.record(0.2))
+
+    def test_latency_drift_below_floor(self):
+        m = WorkerHealthMonitor(window=100, check_every=10, latency_drift=2.0, latency_floor_ms=100)
+        for i in range(100):
+            m.record(0.001)
+        for i in range(200):
+            self.assertIsNone(m.record(0.05))
+
+    def test_max_rss(self):
+        m = WorkerHealthMonitor(max_rss_mb=1, window=100, check_every=1)
+        self.assertTrue('rss' in m.record(0.1))
+
+    def test_one_recycle_at_a_time(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'recycle.lock')
+            m1 = WorkerHealthMonitor(lock_path=path, min_interval=0)
+            m2 = WorkerHealthMonitor(lock_path=path, min_interval=0)
+            self.assertTrue(m1.acquire_recycle_slot())
+            self.assertTrue(m1.acquire_recycle_slot())
+            self.assertFalse(m2.acquire_recycle_slot())
+
+            # Once the first worker exits, the next one must still wait min_interval
+            os.close(m1.lock_fd)
+            m3 = WorkerHealthMonitor(lock_path=path, min_interval=3600)
+            self.assertFalse(m3.acquire_recycle_slot())
+            self.assertTrue(m2.acquire_recycle_slot())
+
+    def test_lock_per_master(self):
+        self.assertEqual(get_lock_path(), f'/tmp/pym-gunicorn-recycle-{os.getppid()}.lock')
+        self.assertEqual(WorkerHealthMonitor().lock_path, get_lock_path())
+
+    def test_streams_are_not_latency(self):
+        from pymacaron import gunicorn
+        req = SimpleNamespace(pym_t0=0)
+        with patch('pymacaron.recycle.check_worker_health') as check_worker_health:
+            gunicorn.post_request(None, req, {STREAMED_ENVIRON: True}, None)
+            self.assertEqual(check_worker_health.call_count, 0)
+            gunicorn.post_request(None, req, {}, None)
+            self.assertEqual(check_worker_health.call_count, 1)
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import yaml
+import subprocess
+import tempfile
+import unittest
+from pymacaron.resources import get_memory_limit
+from pymacaron.resources import load_memory_profile
+from pymacaron.resources import compile_memory_profile
+from pymacaron.resources import measure_gunicorn_memory, measure_process_memory
+from pymacaron.resources import GUNICORN_WORKER_MEM
+from pymacaron.resources import CELERY_WORKER_MEM
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.pop('PYM_GUNICORN_WORKERS_COUNT', None)
+
+    def test_memory_limit_without_profile(self):
+        limit = get_memory_limit(default_celery_worker_count=2, cpu_count=1, profile={})
+        self.assertEqual(limit, 3 * GUNICORN_WORKER_MEM + 2 * CELERY_WORKER_MEM)
+
+    def test_compile_memory_profile(self):
+        master = {'rss_mb': 120.2, 'uss_mb': 100.0, 'pss_mb': 60.0}
+        baseline = {
+            1: {'rss_mb': 125.0, 'uss_mb': 10.0, 'pss_mb': 50.0},
+            2: {'rss_mb': 126.0, 'uss_mb': 12.0, 'pss_mb': 51.0},
+        }
+        warm = {
+            1: {'rss_mb': 150.0, 'uss_mb': 30.0, 'pss_mb': 70.0},
+            2: {'rss_mb': 160.0, 'uss_mb': 40.0, 'pss_mb': 80.0},
+        }
+        profile = compile_memory_profile(master, baseline, warm, headroom=0.5)
+        p = profile['gunicorn']
+        self.assertEqual(p['shared_mb'], 121)
+        self.assertEqual(p['worker_mb'], 60)
+        self.assertEqual(p['measured']['baseline']['uss_mb'], 12.0)
+        self.assertEqual(p['measured']['warm']['pss_mb'], 80.0)
+        self.assertEqual(p['measured']['worker_count'], 2)
+
+        limit = get_memory_limit(default_celery_worker_count=2, cpu_count=1, profile=profile)
+        self.assertEqual(limit, 121 + 3 * 60 + 2 * CELERY_WORKER_MEM)
+
+    def test_load_memory_profile(self):
+        profile = {'gunicorn': {'shared_mb': 100, 'worker_mb': 50}, 'celery': {'worker_mb': 80}}
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'pym-memory.yaml'), 'w') as f:
+                yaml.dump(profile, f)
+            loaded = load_memory_profile(path=d)
+        self.assertEqual(loaded, profile)
+        self.assertEqual(get_memory_limit(default_celery_worker_count=1, cpu_count=1, profile=loaded), 100 + 3 * 50 + 80)
+
+    def test_worker_memory_includes_its_children(self):
+        # A 'worker' forking an offload process of its own
+        code = 'import subprocess, sys, time; subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"]); time.sleep(10)'
+        worker = subprocess.Popen([sys.executable, '-c', code])
+        self.addCleanup(worker.kill)
+        import psutil
+        while not psutil.Process(worker.pid).children():
+            time.sleep(0.05)
+        child = psutil.Process(worker.pid).children()[0]
+        self.addCleanup(child.kill)
+
+        master, workers = measure_gunicorn_memory(os.getpid())
+        own = measure_process_memory(worker.pid)
+        self.assertTrue(workers[worker.pid]['uss_mb'] > own['uss_mb'])
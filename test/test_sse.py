@@ -0,0 +1,101 @@
+import time
+import threading
+import unittest
+from typing import Optional
+from flask import Flask, request
+from pydantic import BaseModel
+from pymacaron.model import PymacaronBaseModel
+from pymacaron.config import get_config
+from pymacaron.endpoint import serialize_item
+from pymacaron.exceptions import TooManyStreamsError
+from pymacaron.recycle import STREAMED_ENVIRON
+from pymacaron import sse
+
+
+class Item(PymacaronBaseModel, BaseModel):
+    def get_property_names(self):
+        return ['name']
+
+    def get_model_api(self):
+        return 'test'
+
+    def get_nullable_properties(self):
+        return []
+
+    name: Optional[str] = None
+
+
+def do_events(n=2):
+    for i in range(n):
+        yield Item(name=str(i))
+
+
+def do_wait_events():
+    # Blocks between events until its client is gone
+    yield Item(name='0')
+    while not sse.is_stream_closed():
+        time.sleep(0.05)
+
+
+def serialize(item):
+    return serialize_item(item, [Item])
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        conf = get_config()
+        max_streams = conf.sse_max_streams
+
+        def restore():
+            conf.sse_max_streams = max_streams
+        self.addCleanup(restore)
+
+    def test_events(self):
+        with self.app.test_request_context('/events'):
+            r = sse.sse_response(do_events, do_events(), serialize)
+            self.assertEqual(r.mimetype, 'text/event-stream')
+            self.assertTrue(request.environ[STREAMED_ENVIRON])
+            self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+            self.assertEqual(
+                b''.join(r.iter_encoded()),
+                b': connected\n\ndata: {"name":"0"}\n\ndata: {"name":"1"}\n\n',
+            )
+            r.close()
+        self.assertEqual(sse.open_streams, 0)
+
+    def test_max_streams(self):
+        get_config().sse_max_streams = 1
+        with self.app.test_request_context('/events'):
+            r = sse.sse_response(do_events, do_events(), serialize)
+            with self.assertRaises(TooManyStreamsError):
+                sse.sse_response(do_events, do_events(), serialize)
+            r.close()
+            r = sse.sse_response(do_events, do_events(), serialize)
+            r.close()
+        self.assertEqual(sse.open_streams, 0)
+
+    def test_slot_held_until_producer_exits(self):
+        with self.app.test_request_context('/events'):
+            r = sse.sse_response(do_wait_events, do_wait_events(), serialize)
+            it = r.iter_encoded()
+            self.assertEqual(next(it), b': connected\n\n')
+            self.assertEqual(next(it), b'data: {"name":"0"}\n\n')
+            self.assertEqual(sse.open_streams, 1)
+            producers = [t for t in threading.enumerate() if t.name == 'pym-sse']
+            self.assertEqual(len(producers), 1)
+
+            # The client disconnects
+            it.close()
+            r.close()
+            producers[0].join(2)
+            self.assertFalse(producers[0].is_alive())
+        self.assertEqual(sse.open_streams, 0)
+
+    def test_closed_before_start(self):
+        with self.app.test_request_context('/events'):
+            r = sse.sse_response(do_events, do_events(), serialize)
+            self.assertEqual(sse.open_streams, 1)
+            r.close()
+        self.assertEqual(sse.open_streams, 0)
@@ -0,0 +1,63 @@
+import json
+import unittest
+from typing import Optional
+from flask import Flask, request
+from pydantic import BaseModel
+from pymacaron.model import PymacaronBaseModel
+from pymacaron.endpoint import stream_response
+from pymacaron.exceptions import BadResponseException
+from pymacaron.recycle import STREAMED_ENVIRON
+
+
+class Item(PymacaronBaseModel, BaseModel):
+    def get_property_names(self):
+        return ['name']
+
+    def get_model_api(self):
+        return 'test'
+
+    def get_nullable_properties(self):
+        return []
+
+    name: Optional[str] = None
+
+
+def do_export(n=3):
+    for i in range(n):
+        yield Item(name=str(i))
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_ndjson(self):
+        with self.app.test_request_context('/export'):
+            r = stream_response(do_export, do_export(), [Item], 'ndjson')
+            self.assertEqual(r.mimetype, 'application/x-ndjson')
+            self.assertTrue(request.environ[STREAMED_ENVIRON])
+            self.assertEqual(b''.join(r.iter_encoded()), b'{"name":"0"}\n{"name":"1"}\n{"name":"2"}\n')
+
+    def test_array(self):
+        with self.app.test_request_context('/export'):
+            r = stream_response(do_export, do_export(), [Item], 'array')
+            self.assertEqual(json.loads(b''.join(r.iter_encoded())), [{'name': '0'}, {'name': '1'}, {'name': '2'}])
+            r = stream_response(do_export, do_export(0), [Item], 'array')
+            self.assertEqual(b''.join(r.iter_encoded()), b'[]')
+
+    def test_early_errors_are_raised(self):
+        def do_fail():
+            raise ValueError('boom')
+            yield Item()
+
+        def do_bad_item():
+            yield 'not a model'
+
+        with self.app.test_request_context('/export'):
+            with self.assertRaises(ValueError):
+                stream_response(do_fail, do_fail(), [Item], 'ndjson')
+            with self.assertRaises(BadResponseException):
+                stream_response(do_bad_item, do_bad_item(), [Item], 'ndjson')
+            with self.assertRaises(BadResponseException):
+                stream_response(do_export, Item(), [Item], 'ndjson')
@@ -0,0 +1,43 @@
+import io
+import unittest
+from flask import Flask
+from pymacaron.upload import parse_upload
+from pymacaron.exceptions import RequestTooLargeError
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def context(self, size):
+        return self.app.test_request_context(
+            '/upload',
+            method='POST',
+            data={'name': 'foo', 'file': (io.BytesIO(b'x' * size), 'f.bin')},
+            content_type='multipart/form-data',
+        )
+
+    def test_spooled_files(self):
+        with self.context(100):
+            form, files = parse_upload(max_size=10000, spool_size=1000)
+            self.assertEqual(form['name'], 'foo')
+            self.assertFalse(files['file'].stream._rolled)
+            self.assertEqual(len(files['file'].read()), 100)
+
+        with self.context(5000):
+            form, files = parse_upload(max_size=10000, spool_size=1000)
+            self.assertTrue(files['file'].stream._rolled)
+            self.assertEqual(len(files['file'].read()), 5000)
+
+    def test_max_size(self):
+        with self.context(20000):
+            with self.assertRaises(RequestTooLargeError):
+                parse_upload(max_size=10000)
+
+    def test_max_size_without_content_length(self):
+        with self.context(20000) as ctx:
+            del ctx.request.environ['CONTENT_LENGTH']
+            ctx.request.environ['wsgi.input_terminated'] = True
+            with self.assertRaises(RequestTooLargeError):
+                parse_upload(max_size=10000)
@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import patch
+from flask import Flask, request
+from pymacaron import warmup
+from pymacaron.warmup import add_warmup_request, set_warmup, warmup_app, WARMUP_HEADER
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        saved = list(warmup.warmup_requests)
+        warmup.warmup_requests.clear()
+        self.addCleanup(warmup.warmup_requests.extend, saved)
+        self.addCleanup(set_warmup, warmup.with_warmup, warmup.with_synthetic)
+        set_warmup()
+
+        self.calls = []
+        self.app = Flask(__name__)
+
+        @self.app.route('/v1/items', methods=['GET', 'POST'])
+        def items():
+            self.calls.append((request.method, request.path, request.args.get('lang'), request.get_json(silent=True), request.headers.get(WARMUP_HEADER)))
+            return 'ok'
+
+        @self.app.route('/v1/crash')
+        def crash():
+            self.calls.append('crash')
+            raise Exception('Boom')
+
+    def test_warmup_app(self):
+        add_warmup_request('GET', '/v1/items', query={'lang': 'en'})
+        add_warmup_request('POST', '/v1/items', body={'name': 'foo'})
+        warmup_app(self.app)
+        self.assertEqual(self.calls, [
+            ('GET', '/v1/items', 'en', None, '1'),
+            ('POST', '/v1/items', None, {'name': 'foo'}, '1'),
+        ])
+
+    def test_no_duplicates(self):
+        # The generated endpoint code declares its requests each time it is loaded
+        for i in range(2):
+            add_warmup_request('GET', '/v1/items', query={'lang': 'en'})
+            add_warmup_request('GET', '/v1/items', synthetic=True)
+        self.assertEqual(len(warmup.warmup_requests), 2)
+        set_warmup(synthetic=True)
+        warmup_app(self.app)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_synthetic(self):
+        add_warmup_request('GET', '/v1/items', synthetic=True)
+        warmup_app(self.app)
+        self.assertEqual(self.calls, [])
+
+        set_warmup(synthetic=True)
+        warmup_app(self.app)
+        self.assertEqual(len(self.calls), 1)
+
+        set_warmup(enabled=False, synthetic=True)
+        warmup_app(self.app)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_failures_are_logged(self):
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        add_warmup_request('GET', '/v1/crash')
+        add_warmup_request('GET', '/v1/missing')
+        add_warmup_request('GET', '/v1/items')
+        with patch.object(warmup.log, 'warning') as warning:
+            warmup_app(self.app)
+        self.assertEqual(self.calls[0], 'crash')
+        self.assertEqual(len(self.calls), 2)
+        self.assertIn('Boom', warning.call_args[0][0])